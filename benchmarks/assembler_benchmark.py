@@ -0,0 +1,74 @@
+"""Compares building query results from model instances (`generate_result_objects`) with the tuple rows of the
+`RowAssembler`.
+
+Both variants execute the same query on an in-memory SQLite database, so the numbers contain the query time and
+the row materialization, but no network. Run with `python -m benchmarks.assembler_benchmark`.
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+
+from peewee import SqliteDatabase
+
+for name in ('PSQL_NAME', 'PSQL_USER', 'PSQL_PASSWORD'):
+    os.environ.setdefault(name, 'benchmark')
+
+from server.models import Comment, Commit, CommitRelationship, Project, ProjectCommitRelationship, User, mr
+from server.query.builder import QueryBuilder
+from server.query.cache import CompiledQueryCache
+from server.query.result import generate_result_objects
+
+
+MODELS = [User, Project, Commit, ProjectCommitRelationship, CommitRelationship, Comment]
+
+QUERIES = {
+    'narrow': 'MODEL: commit SELECT: (sha)',
+    'n:1': 'MODEL: commit SELECT: (sha, created_at, author.login, committer.login)',
+    'wide n:1': 'MODEL: comment SELECT: (body, line, position, created_at, '
+                'author.login, author.company, author.state, author.city, author.location, author.created_at, '
+                'commit.sha, commit.created_at, commit.author.login, commit.author.company, commit.author.city, '
+                'commit.committer.login, commit.committer.company, commit.committer.city)',
+    'wide 1:n': 'MODEL: commit SELECT: (sha, created_at, author.login, author.company, author.city, '
+                'comments.body, comments.line, comments.author.login)',
+}
+
+
+def setup(rows):
+    database = SqliteDatabase(':memory:')
+    database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    database.create_tables(MODELS)
+    created_at = datetime(2019, 1, 1)
+    with database.atomic():
+        users = [User.create(login=f'user{i}', company='company', state='state', city='city', location='location',
+                             created_at=created_at) for i in range(100)]
+        commits = [Commit.create(sha=f'{i:040x}', author=users[i % 100], committer=users[(i + 1) % 100],
+                                 created_at=created_at) for i in range(rows)]
+        for i, commit in enumerate(commits):
+            Comment.create(commit=commit, author=users[i % 100], body=f'comment {i}', line=i, position=i,
+                           created_at=created_at)
+
+
+def measure(function, repeat=5):
+    number, _ = timeit.Timer(function).autorange()
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def main(rows=2000):
+    setup(rows)
+    compiled_queries = CompiledQueryCache(mr)
+
+    print(f'{"query":<12}{"rows":>8}{"models [ms]":>14}{"tuples [ms]":>14}{"speedup":>10}')
+    for name, text in QUERIES.items():
+        query, query_tree = QueryBuilder(mr)(text)
+        compiled = compiled_queries(text)
+        assembler = compiled.assembler
+        assert generate_result_objects(query, query_tree) == assembler.assemble(assembler.execute(compiled.query))
+
+        models = measure(lambda: generate_result_objects(query.clone(), query_tree))
+        tuples = measure(lambda: assembler.assemble(assembler.execute(compiled.query)))
+        print(f'{name:<12}{rows:>8}{models * 1000:>14.3f}{tuples * 1000:>14.3f}{models / tuples:>9.1f}x')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""A seeded synthetic GitHub dataset for the models of `server.models`.
+
+The same `scale` and `seed` always produce the same rows, so benchmark results of different runs are comparable.
+At scale 1 the dataset contains 200 users, 40 projects, 2000 commits, 1000 comments, 120 issues and about 1000
+followers; all numbers grow linearly with the scale.
+"""
+import os
+import random
+from datetime import datetime, timedelta
+
+for name in ('PSQL_NAME', 'PSQL_USER', 'PSQL_PASSWORD'):
+    os.environ.setdefault(name, 'benchmark')
+
+from server.models import (Comment, Commit, CommitRelationship, Followers, Issue, Project, ProjectCommitRelationship,
+                           ProjectMembers, User)
+
+
+MODELS = [User, Project, Commit, ProjectCommitRelationship, CommitRelationship, Comment, ProjectMembers, Followers,
+          Issue]
+
+USERS = 200
+PROJECTS = 40
+COMMITS = 2000
+COMMENTS_PER_COMMIT = 0.5
+ISSUES_PER_PROJECT = 3
+FOLLOWS_PER_USER = 5
+MEMBERS_PER_PROJECT = 4
+FORK_RATIO = 0.25
+MERGE_RATIO = 0.1
+
+CITIES = ['Berlin', 'Potsdam', 'San Francisco', 'New York', 'London', 'Tokyo', 'Paris', 'Zurich']
+COMPANIES = ['', 'HPI', 'GitHub', 'Google', 'Microsoft', 'SAP']
+WORDS = ['fix', 'add', 'remove', 'refactor', 'test', 'parser', 'query', 'server', 'model', 'cache', 'typo', 'docs']
+
+# Older SQLite versions allow at most 999 parameters per statement.
+MAX_PARAMETERS = 999
+
+
+def bind(database):
+    """Binds all models to `database` and creates their tables."""
+    database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    database.create_tables(MODELS)
+
+
+def generate(database, scale=1, seed=0):
+    """Fills the (empty) tables of the models bound to `database` and returns the number of rows per table.
+
+    Commits form a DAG: every commit has a parent among the earlier commits of its project, some of them are merges
+    with a second parent. A quarter of the projects are forks, which share the commits of the forked project.
+    """
+    rnd = random.Random(seed)
+    start = datetime(2015, 1, 1)
+
+    def created_at(i, count):
+        return start + timedelta(days=1500 * i / count, seconds=rnd.randrange(86400))
+
+    user_count = max(2, int(USERS * scale))
+    users = [
+        {'id': i + 1, 'login': f'user{i}', 'company': rnd.choice(COMPANIES), 'state': '', 'city': rnd.choice(CITIES),
+         'location': rnd.choice(CITIES), 'created_at': created_at(i, user_count)}
+        for i in range(user_count)
+    ]
+
+    project_count = max(1, int(PROJECTS * scale))
+    projects = []
+    for i in range(project_count):
+        owner = rnd.randrange(user_count) + 1
+        # The schema does not allow NULL, original projects are "forked" from themselves.
+        forked_from = rnd.randrange(i) + 1 if i and rnd.random() < FORK_RATIO else i + 1
+        projects.append({'id': i + 1, 'url': f'https://api.github.com/repos/user{owner - 1}/project{i}',
+                         'owner': owner, 'name': f'project{i}', 'description': ' '.join(rnd.sample(WORDS, 4)),
+                         'forked_from': forked_from, 'created_at': created_at(i, project_count)})
+    originals = [project['id'] for project in projects if project['forked_from'] == project['id']]
+
+    commit_count = max(1, int(COMMITS * scale))
+    commits = []
+    commit_parents = []
+    project_commits = []
+    project_heads = {project_id: [] for project_id in originals}
+    for i in range(commit_count):
+        commit_id = i + 1
+        author = rnd.randrange(user_count) + 1
+        committer = author if rnd.random() < 0.8 else rnd.randrange(user_count) + 1
+        commits.append({'id': commit_id, 'sha': f'{rnd.getrandbits(160):040x}', 'author': author,
+                        'committer': committer, 'created_at': created_at(i, commit_count)})
+        project_id = rnd.choice(originals)
+        history = project_heads[project_id]
+        if history:
+            commit_parents.append({'parent': history[-1], 'child': commit_id})
+            if len(history) > 1 and rnd.random() < MERGE_RATIO:
+                commit_parents.append({'parent': rnd.choice(history[:-1]), 'child': commit_id})
+        history.append(commit_id)
+        project_commits.append({'project': project_id, 'commit': commit_id})
+    for project in projects:
+        if project['forked_from'] != project['id']:
+            original = project['forked_from']
+            while projects[original - 1]['forked_from'] != original:
+                original = projects[original - 1]['forked_from']
+            project_commits.extend({'project': project['id'], 'commit': commit_id}
+                                   for commit_id in project_heads[original])
+
+    comments = [
+        {'id': i + 1, 'commit': rnd.randrange(commit_count) + 1, 'author': rnd.randrange(user_count) + 1,
+         'body': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 20))), 'line': rnd.randint(1, 500),
+         'position': rnd.randint(1, 50), 'created_at': created_at(i, commit_count)}
+        for i in range(int(commit_count * COMMENTS_PER_COMMIT))
+    ]
+
+    issues = [
+        {'id': i + 1, 'project': rnd.randrange(project_count) + 1, 'reporter': rnd.randrange(user_count) + 1,
+         'assignee': rnd.randrange(user_count) + 1, 'created_at': created_at(i, project_count * ISSUES_PER_PROJECT)}
+        for i in range(project_count * ISSUES_PER_PROJECT)
+    ]
+
+    followers = set()
+    for user in users:
+        for _ in range(rnd.randint(0, 2 * FOLLOWS_PER_USER)):
+            followed = rnd.randrange(user_count) + 1
+            if followed != user['id']:
+                followers.add((user['id'], followed))
+
+    members = set()
+    for project in projects:
+        members.add((project['id'], project['owner']))
+        for _ in range(rnd.randint(0, 2 * MEMBERS_PER_PROJECT)):
+            members.add((project['id'], rnd.randrange(user_count) + 1))
+
+    tables = [
+        (User, users),
+        (Project, projects),
+        (Commit, commits),
+        (CommitRelationship, commit_parents),
+        (ProjectCommitRelationship, project_commits),
+        (Comment, comments),
+        (Issue, issues),
+        (Followers, [{'follower': follower, 'user': user} for follower, user in sorted(followers)]),
+        (ProjectMembers, [{'project': project, 'member': member} for project, member in sorted(members)]),
+    ]
+    with database.atomic():
+        for model, rows in tables:
+            batch_size = MAX_PARAMETERS // len(rows[0]) if rows else 1
+            for i in range(0, len(rows), batch_size):
+                model.insert_many(rows[i:i + batch_size]).execute()
+    return {model._meta.table_name: len(rows) for model, rows in tables}
@@ -0,0 +1,74 @@
+"""Compares the pyPEG grammar of `server.parser` with the hand-written parser of `server.fast_parser`.
+
+Run with `python -m benchmarks.parser_benchmark`.
+"""
+import sys
+import timeit
+
+import pypeg2
+
+from server import fast_parser, parser
+
+
+QUERIES = {
+    'test_query': '''
+    MODEL: modelname
+    SELECT: (
+        abc,
+        field2,
+        abc.field3,
+        SUM: field.field
+        )
+    GROUPBY: (
+        field2.abc2 )
+    ORDERBY: (
+        field2 )
+    WHERE: abc <= "asfd" AND (abc.field != 2)
+    ''',
+    'example_query': '''
+    MODEL: commit
+    SELECT: (
+        id,
+        sha,
+        children.id,
+        children.sha,
+        author.login
+        )
+    WHERE: author.login >= 'a' AND author.login <= 'b'
+    ''',
+    'nested_where': 'MODEL: commit SELECT: (sha) '
+                    'WHERE: abc.test == abc AND ((abc.test <= abc OR abc2.test2 >= abc) OR test.abc == abc)',
+}
+
+
+def long_where_query(length):
+    comparisions = ' OR '.join(f'author.login == "user{i}"' for i in range(length))
+    return f'MODEL: commit SELECT: (sha, author.login) WHERE: {comparisions}'
+
+
+def measure(parse, text, repeat=5):
+    try:
+        number, _ = timeit.Timer(lambda: parse(text)).autorange()
+        best = min(timeit.repeat(lambda: parse(text), number=number, repeat=repeat))
+    except RecursionError:
+        return None
+    return best / number
+
+
+def main():
+    queries = dict(QUERIES)
+    for length in (10, 100, 1000, 5000):
+        queries[f'where_{length}'] = long_where_query(length)
+
+    print(f'{"query":<16}{"pypeg2 [ms]":>14}{"fast [ms]":>14}{"speedup":>10}')
+    for name, text in queries.items():
+        fast = measure(fast_parser.parse, text)
+        # pyPEG needs several recursion levels per operand and fails on long WHERE clauses.
+        pypeg = measure(lambda t: pypeg2.parse(t, parser.Query), text)
+        pypeg_text = f'{pypeg * 1000:>14.3f}' if pypeg is not None else f'{"failed":>14}'
+        speedup_text = f'{pypeg / fast:>9.1f}x' if pypeg is not None else f'{"-":>10}'
+        print(f'{name:<16}{pypeg_text}{fast * 1000:>14.3f}{speedup_text}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+"""Benchmarks the stages of `/query` for a fixed set of CQL queries on the synthetic dataset of
+`benchmarks.dataset` in SQLite, and compares the results with a stored baseline.
+
+The stages are measured like in the server: `parse` (`fast_parser`), `build` (the query and the row assembler),
+`execute` (the projected query, until all rows are fetched), `materialize` (the result objects, including the
+queries of the selected 1:n and n:m relations) and `serialize` (JSON). Every number is the best time of several
+repetitions in seconds.
+
+Run with `python -m benchmarks.suite`. The results are written to `--output`. If the baseline file exists, every
+stage which got slower than the baseline by more than `--tolerance` fails the run with exit code 1, just like a
+query which returns a different number of results. `--update-baseline` stores the results as the new baseline.
+Timings are only comparable on the same machine, so the baseline has to be updated when the machine changes.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import time
+import timeit
+
+from peewee import SqliteDatabase
+
+from benchmarks import dataset
+from server import fast_parser, metrics
+from server.models import mr
+from server.query.cache import CompiledQueryCache
+from server.views import JsonEncoder
+
+
+QUERIES = {
+    'narrow': 'MODEL: commit SELECT: (sha)',
+    'n:1': 'MODEL: commit SELECT: (sha, created_at, author.login, committer.login)',
+    'where': "MODEL: commit SELECT: (sha, author.login) "
+             "WHERE: author.login >= 'user1' AND author.login < 'user2' OR committer.city == 'Berlin'",
+    'order': 'MODEL: comment SELECT: (body, line, author.login) ORDERBY: (line)',
+    '1:n': 'MODEL: user SELECT: (login, authored_commits.sha, comments.body)',
+    'n:m': 'MODEL: project SELECT: (name, owner.login, commits.sha, members.login)',
+    'dag': 'MODEL: commit SELECT: (sha, parents.sha, children.sha, children.author.login)',
+    'wide': 'MODEL: comment SELECT: (body, line, position, created_at, author.login, author.company, author.city, '
+            'commit.sha, commit.created_at, commit.author.login, commit.committer.login)',
+    'followers': 'MODEL: user SELECT: (login, follows.login, follower.login) WHERE: city == "Potsdam"',
+}
+
+STAGES = ('parse', 'build', 'execute', 'materialize', 'serialize')
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def measure(function, repeat=5):
+    number, _ = timeit.Timer(function).autorange()
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def measure_build(text, repeat=5):
+    """Times the compilation of a query without the parse time, which the builder records as a separate stage."""
+    def build():
+        with metrics.track_request() as request_metrics:
+            start = time.perf_counter()
+            compiled_queries._compile(text)
+            return time.perf_counter() - start - request_metrics.stages['parse']
+
+    compiled_queries = CompiledQueryCache(mr)
+    return min(build() for _ in range(repeat * 20))
+
+
+def run_query(text, repeat=5):
+    compiled = CompiledQueryCache(mr)(text)
+    assembler = compiled.assembler
+    rows = list(assembler.execute(compiled.query.clone()))
+    result = assembler.assemble(rows)
+    return {
+        'results': len(result),
+        'parse': measure(lambda: fast_parser.parse(text), repeat),
+        'build': measure_build(text, repeat),
+        'execute': measure(lambda: list(assembler.execute(compiled.query.clone())), repeat),
+        'materialize': measure(lambda: assembler.assemble(rows), repeat),
+        'serialize': measure(lambda: json.dumps(result, cls=JsonEncoder), repeat),
+    }
+
+
+def run(scale=1, seed=0, repeat=5, database=':memory:'):
+    database = SqliteDatabase(database)
+    dataset.bind(database)
+    tables = dataset.generate(database, scale, seed)
+    return {
+        'scale': scale,
+        'seed': seed,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'tables': tables,
+        'queries': {name: run_query(text, repeat) for name, text in QUERIES.items()},
+    }
+
+
+def compare(results, baseline, tolerance=1.0, min_difference=0.0001):
+    """Returns the regressions of `results` compared with `baseline`. A stage regressed if it is more than
+    `tolerance` (relative) and `min_difference` seconds (absolute) slower than in the baseline."""
+    if (results['scale'], results['seed']) != (baseline['scale'], baseline['seed']):
+        return [f'The baseline was measured with scale {baseline["scale"]} and seed {baseline["seed"]}.']
+    regressions = []
+    for name, result in results['queries'].items():
+        expected = baseline['queries'].get(name)
+        if expected is None:
+            continue
+        if result['results'] != expected['results']:
+            regressions.append(f'{name}: {result["results"]} results instead of {expected["results"]}')
+        for stage_name in STAGES:
+            seconds, expected_seconds = result[stage_name], expected[stage_name]
+            if seconds > expected_seconds * (1 + tolerance) and seconds - expected_seconds > min_difference:
+                regressions.append(f'{name}: {stage_name} took {seconds * 1000:.3f} ms instead of '
+                                   f'{expected_seconds * 1000:.3f} ms')
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f'{"query":<12}{"results":>8}' + ''.join(f'{stage_name + " [ms]":>17}' for stage_name in STAGES))
+    for name, result in results['queries'].items():
+        expected = baseline['queries'].get(name) if baseline else None
+        cells = []
+        for stage_name in STAGES:
+            cell = f'{result[stage_name] * 1000:.3f}'
+            if expected:
+                cell += f' {result[stage_name] / expected[stage_name]:>4.1f}x'
+            cells.append(f'{cell:>17}')
+        print(f'{name:<12}{result["results"]:>8}' + ''.join(cells))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    arg_parser.add_argument('--scale', type=float, default=1)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--database', default=':memory:', help='SQLite database file, must not exist yet')
+    arg_parser.add_argument('--output', default='benchmark_results.json')
+    arg_parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    arg_parser.add_argument('--tolerance', type=float, default=1.0)
+    arg_parser.add_argument('--update-baseline', action='store_true')
+    args = arg_parser.parse_args(argv)
+
+    results = run(args.scale, args.seed, args.repeat, args.database)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print_results(results)
+        return 0
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+    if baseline is None:
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryTooExpensive(Exception):
+    pass
+
+
+class BudgetExhausted(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CostBudgets:
+    """Limits the estimated cost of the queries a client can run.
+
+    A single query may cost at most `max_cost` and at most `budget`. Every client has a budget of `budget` cost
+    units, which queries consume and which refills completely within `window` seconds. A value of 0 disables the
+    respective check. Only the `max_clients` most recently seen clients are remembered.
+    """
+
+    def __init__(self, max_cost=0, budget=0, window=60, max_clients=10000):
+        self.max_cost = max_cost
+        self.budget = budget
+        self.window = window
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.admitted = 0
+        self.rejected = 0
+
+    def admit(self, client, cost):
+        """Charges `cost` to the budget of `client`. Raises a `QueryTooExpensive` or `BudgetExhausted` if the
+        query can not be run. Queries without a cost estimate are always admitted."""
+        with self._lock:
+            if cost is None:
+                self.admitted += 1
+                return
+            limit = min(limit for limit in (self.max_cost, self.budget, float('inf')) if limit)
+            if cost > limit:
+                self.rejected += 1
+                raise QueryTooExpensive(f'The estimated cost {cost:.0f} of the query exceeds the limit {limit:.0f}.')
+            if self.budget:
+                remaining = self._refill(client)
+                if cost > remaining:
+                    self.rejected += 1
+                    retry_after = (cost - remaining) * self.window / self.budget
+                    raise BudgetExhausted(f'The estimated cost {cost:.0f} of the query exceeds the remaining budget '
+                                          f'{remaining:.0f}.', retry_after)
+                self._clients[client] = (remaining - cost, time.monotonic())
+            self.admitted += 1
+
+    def remaining(self, client):
+        with self._lock:
+            return self._refill(client) if self.budget else None
+
+    def _refill(self, client):
+        remaining, updated = self._clients.pop(client, (self.budget, None))
+        now = time.monotonic()
+        if updated is not None:
+            remaining = min(self.budget, remaining + (now - updated) * self.budget / self.window)
+        self._clients[client] = (remaining, now)
+        while len(self._clients) > self.max_clients:
+            self._clients.popitem(last=False)
+        return remaining
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_cost': self.max_cost,
+                'budget': self.budget,
+                'window': self.window,
+                'clients': len(self._clients),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+            }
@@ -0,0 +1,406 @@
+"""Error-recovering, incremental analysis of partial CQL queries, like the ones an editor sends on every keystroke.
+
+A query is tokenized with the tokenizer of `server.fast_parser` and parsed clause by clause. A clause with a syntax
+error is reported and the parts of it which can be parsed are kept, e.g. the valid fields of a `SELECT:` list or
+the valid comparisons of a `WHERE:` expression, so the result is the AST so far. The syntactic context at the
+cursor tells what can be typed there.
+
+Analyses of the same session reuse the previous one: the tokens before the first changed character and the
+tokens after the last changed character (once the tokenizer is back in sync) are kept, and clauses whose tokens
+did not change are not parsed again.
+"""
+import re
+from collections import namedtuple
+
+from server import fast_parser, parser
+from server.fast_parser import Token
+from server.query.cache import LRUCache
+
+
+COMMANDS = ['MODEL:', 'SELECT:', 'GROUPBY:', 'ORDERBY:', 'WHERE:', 'SAMPLE:']
+
+ParseError = namedtuple('ParseError', ['message', 'start', 'end'])
+
+# `kind` is what can be typed at the cursor: `command` (one of `commands`), `model`, `selection` (a field path or
+# an aggregator), `field`, `value` (a value or a field path compared with the field path `field`), `operator` or
+# `None`. `path` contains the relations of a field path before the cursor, `prefix` the characters of the token at
+# the cursor which were already typed, from the position `start` on.
+Context = namedtuple('Context', ['clause', 'kind', 'model', 'path', 'prefix', 'start', 'field', 'commands'])
+
+Analysis = namedtuple('Analysis', ['query', 'errors', 'context', 'tokens', 'reused_tokens', 'reused_clauses'])
+
+_Session = namedtuple('_Session', ['text', 'tokens', 'clauses'])
+
+_CLAUSE_RULES = {
+    'MODEL:': fast_parser.Parser.model,
+    'SELECT:': fast_parser.Parser.select,
+    'GROUPBY:': fast_parser.Parser.group_by,
+    'ORDERBY:': fast_parser.Parser.order_by,
+    'WHERE:': fast_parser.Parser.where,
+    'SAMPLE:': fast_parser.Parser.sample,
+}
+
+_LIST_CLAUSES = {'SELECT:': parser.Select, 'GROUPBY:': parser.GroupBy, 'ORDERBY:': parser.OrderBy}
+
+_QUERY_ATTRIBUTES = {'MODEL:': 'model', 'SELECT:': 'select', 'GROUPBY:': 'group_by', 'ORDERBY:': 'order_by',
+                     'WHERE:': 'where', 'SAMPLE:': 'sample'}
+
+# The parts of a query which can be completed at the cursor.
+_COMPLETABLE = ('identifier', 'string', 'partial_string', 'command', 'aggregator')
+
+
+class Analyzer:
+    """Analyzes partial queries. The last analysis of the `max_sessions` most recent sessions is kept."""
+
+    def __init__(self, max_sessions=1024):
+        self._sessions = LRUCache(max_sessions)
+
+    def analyze(self, text, offset=None, session=None):
+        """Returns the `Analysis` of `text` with the context at the position `offset` (by default the end). If a
+        `session` is given, the previous analysis of the session is reused."""
+        offset = len(text) if offset is None else max(0, min(offset, len(text)))
+        previous = self._sessions.get(session) if session is not None else None
+        if previous is not None:
+            tokens, reused_tokens = retokenize(previous.text, previous.tokens, text)
+        else:
+            tokens, reused_tokens = list(_tokenize(text)), 0
+        previous_clauses = previous.clauses if previous is not None else {}
+
+        errors = [ParseError(f'Unexpected character {token.value!r}.', token.start, token.end)
+                  for token in tokens if token.type == 'error']
+        query = parser.Query()
+        for attribute in _QUERY_ATTRIBUTES.values():
+            setattr(query, attribute, None)
+        clauses = {}
+        reused_clauses = 0
+        last_index = -1
+        for clause_tokens in _split_clauses(tokens):
+            command = clause_tokens[0]
+            if command.type != 'command':
+                errors.append(ParseError('Expected MODEL:.', command.start, clause_tokens[-1].end))
+                continue
+            index = COMMANDS.index(command.value)
+            if index <= last_index:
+                errors.append(ParseError(f'Unexpected {command.value}.', command.start, command.end))
+                continue
+            last_index = index
+            # Clauses are parsed independently, so a clause with the same tokens has the same result.
+            key = tuple((token.type, token.value) for token in clause_tokens)
+            result = previous_clauses.get(key)
+            if result is None:
+                result = _parse_clause(clause_tokens)
+            else:
+                reused_clauses += 1
+            clauses[key] = result
+            part, clause_errors = result
+            setattr(query, _QUERY_ATTRIBUTES[command.value], part)
+            for message, i in clause_errors:
+                if i < len(clause_tokens):
+                    errors.append(ParseError(message, clause_tokens[i].start, clause_tokens[i].end))
+                else:
+                    errors.append(ParseError(message, clause_tokens[-1].end, clause_tokens[-1].end))
+        if last_index < 1:
+            missing = COMMANDS[last_index + 1]
+            errors.append(ParseError(f'The query has no {missing} clause.', len(text), len(text)))
+
+        if session is not None:
+            self._sessions.put(session, _Session(text, tokens, clauses))
+        return Analysis(query, errors, cursor_context(tokens, offset), tokens, reused_tokens, reused_clauses)
+
+
+def retokenize(previous_text, previous_tokens, text):
+    """Returns the tokens of `text` and how many of them were reused from `previous_tokens`, the tokens of
+    `previous_text`."""
+    length = min(len(previous_text), len(text))
+    prefix = _common_prefix(previous_text, text, length)
+    suffix = _common_suffix(previous_text, text, length - prefix)
+
+    # The tokenizer looks at most at the two characters after a token (an integer could continue as a decimal like
+    # `1.5`), so a token which ends before them is the same in the new text.
+    kept = 0
+    while kept < len(previous_tokens) and previous_tokens[kept].end < prefix - 1:
+        kept += 1
+    tokens = previous_tokens[:kept]
+
+    # A token depends only on the text from its start on. Once a new token starts where a token of the unchanged
+    # suffix of the previous text started, all following tokens are the same, shifted by the change in length.
+    delta = len(text) - len(previous_text)
+    suffix_start = len(previous_text) - suffix
+    starts = {token.start: i for i, token in enumerate(previous_tokens) if token.start >= suffix_start}
+    for token in _tokenize(text, tokens[-1].end if tokens else 0):
+        i = starts.get(token.start - delta)
+        if i is not None:
+            reused = previous_tokens[i:]
+            if delta:
+                reused = [old._replace(start=old.start + delta, end=old.end + delta) for old in reused]
+            tokens.extend(reused)
+            return tokens, kept + len(reused)
+        tokens.append(token)
+    return tokens, kept
+
+
+def cursor_context(tokens, offset):
+    """Returns the `Context` at the position `offset` of a query with the tokens `tokens`."""
+    tokens = [token for token in tokens if token.start < offset]
+    prefix = ''
+    if tokens and tokens[-1].end >= offset and tokens[-1].type in _COMPLETABLE:
+        token = tokens.pop()
+        prefix = token.value[:offset - token.start]
+    start = offset - len(prefix)
+    model = tokens[1].value if len(tokens) > 1 and tokens[0].value == 'MODEL:' and \
+        tokens[1].type == 'identifier' else None
+
+    def context(kind, clause=None, path=(), field=None, commands=()):
+        return Context(clause, kind, model, list(path), prefix, start, field, list(commands))
+
+    commands = [i for i, token in enumerate(tokens) if token.type == 'command']
+    if not commands:
+        return context('command', commands=COMMANDS[:1])
+    command = tokens[commands[-1]].value
+    clause = tokens[commands[-1] + 1:]
+    if command == 'MODEL:':
+        if not clause:
+            return context('model', command)
+        return context('command', command, commands=COMMANDS[1:2])
+
+    if command == 'SAMPLE:':
+        return context(None, command)
+    path, before = _path(clause)
+    previous = before[-1] if before else None
+    if command != 'WHERE:':
+        if previous is not None and previous.value == ')' and _closed(clause):
+            return context('command', command, commands=COMMANDS[COMMANDS.index(command) + 1:])
+        if previous is None or previous.value in ('(', ',') or previous.type == 'aggregator':
+            selection = command == 'SELECT:' and not path and previous is not None and previous.type != 'aggregator'
+            return context('selection' if selection else 'field', command, path)
+        return context(None, command, path)
+
+    if previous is not None and previous.type == 'comparator':
+        return context('value', command, path, field=_operand(before[:-1]) or None)
+    if previous is None or previous.value == '(' or previous.value in fast_parser.LOGICAL_OPERATORS:
+        return context('field', command, path)
+    if not path and (previous.type in ('string', 'integer', 'identifier') or previous.value == ')'):
+        # After a comparison.
+        return context('operator', command, commands=COMMANDS[COMMANDS.index(command) + 1:])
+    return context(None, command, path)
+
+
+def describe_context(context):
+    """Describes a context for humans, e.g. "field inside SELECT: after `author.`"."""
+    description = context.kind or 'nothing'
+    if context.clause is not None:
+        description += f' inside {context.clause}'
+    if context.field:
+        description += f' after `{".".join(context.field)}`'
+    elif context.path:
+        description += f' after `{".".join(context.path)}.`'
+    return description
+
+
+def describe_query(query):
+    """Returns the parts of a (partial) query as dicts for JSON, missing parts as `None`."""
+    def describe_list(part):
+        return [_describe_selection(item) for item in part] if part is not None else None
+
+    return {
+        'model': query.model.name if query.model is not None else None,
+        'select': describe_list(query.select),
+        'group_by': describe_list(query.group_by),
+        'order_by': describe_list(query.order_by),
+        'where': _describe_expression(query.where.expression) if query.where is not None else None,
+        'sample': {'percentage': query.sample.percentage, 'method': _SAMPLE_METHOD_NAMES[query.sample.method],
+                   'seed': query.sample.seed} if query.sample is not None else None,
+    }
+
+
+def _describe_selection(selection):
+    if isinstance(selection, parser.Aggregation):
+        return {'aggregator': _AGGREGATOR_NAMES[selection.aggregator], 'field': _field_path(selection.field)}
+    return {'field': _field_path(selection)}
+
+
+def _describe_expression(expression):
+    if expression.is_logical_expression:
+        return {'operator': _OPERATOR_NAMES[expression.logical_operator],
+                'first': _describe_expression(expression.first),
+                'second': _describe_expression(expression.second)}
+    return {'comparator': _COMPARATOR_NAMES[expression.comparator],
+            'first': _describe_operand(expression.first),
+            'second': _describe_operand(expression.second)}
+
+
+def _describe_operand(operand):
+    if isinstance(operand, parser.FieldName):
+        return {'field': _field_path(operand)}
+    return {'value': operand.value}
+
+
+def _field_path(field_name):
+    return '.'.join(name if depth is None else f'{name}(depth<={depth})'
+                    for name, depth in zip(field_name.values, field_name.depths))
+
+
+_AGGREGATOR_NAMES = {aggregator: name[:-1] for name, aggregator in fast_parser.AGGREGATORS.items()}
+_COMPARATOR_NAMES = {comparator: name for name, comparator in fast_parser.COMPARATORS.items()}
+_OPERATOR_NAMES = {operator: name for name, operator in fast_parser.LOGICAL_OPERATORS.items()}
+_SAMPLE_METHOD_NAMES = {method: name for name, method in fast_parser.SAMPLE_METHODS.items()}
+
+
+def _tokenize(text, position=0):
+    """Tokenizes a partial query. Characters which do not start a token become tokens of type `error`."""
+    while True:
+        try:
+            for token in fast_parser.iter_tokens(text, position, partial=True):
+                yield token
+                position = token.end
+            return
+        except SyntaxError:
+            position += len(text[position:]) - len(text[position:].lstrip())
+            yield Token('error', text[position], position, position + 1)
+            position += 1
+
+
+def _common_prefix(first, second, length):
+    # Binary search with slice comparisons, which compare in C.
+    low, high = 0, length
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[:middle] == second[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _common_suffix(first, second, length):
+    low, high = 0, length
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[len(first) - middle:] == second[len(second) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _split_clauses(tokens):
+    """Splits tokens into clauses, which start with a command (except tokens before the first command)."""
+    clauses = []
+    for token in tokens:
+        if token.type == 'command' or not clauses:
+            clauses.append([])
+        clauses[-1].append(token)
+    return clauses
+
+
+def _parse_clause(tokens):
+    """Parses a clause. Returns the parsed part of the query, or the parts which can be parsed if the clause has a
+    syntax error, and the errors as (message, index of the token)."""
+    command = tokens[0].value
+    rule = _CLAUSE_RULES[command]
+    end = tokens[-1].end
+    p = fast_parser.Parser(None, tokens + [Token('end', '', end, end)])
+    try:
+        return p.parse(lambda: rule(p)), []
+    except SyntaxError as e:
+        # The position is stored as the index of the token, since a reused clause can move.
+        error = (re.sub(r' at position \d+', '', str(e)), p.position)
+    if command == 'MODEL:':
+        part = fast_parser.Model(tokens[1].value) if len(tokens) > 1 and tokens[1].type == 'identifier' else None
+    elif command == 'WHERE:':
+        part = _recover_expression(tokens[1:])
+    elif command == 'SAMPLE:':
+        part = None
+    else:
+        rule = fast_parser.Parser.selection if command == 'SELECT:' else fast_parser.Parser.field_name
+        items = [_parse_tokens(rule, item_tokens) for item_tokens in _list_items(tokens[1:])]
+        part = _LIST_CLAUSES[command]([item for item in items if item is not None])
+    return part, [error]
+
+
+def _parse_tokens(rule, tokens):
+    end = tokens[-1].end
+    p = fast_parser.Parser(None, tokens + [Token('end', '', end, end)])
+    try:
+        return p.parse(lambda: rule(p))
+    except SyntaxError:
+        return None
+
+
+def _list_items(tokens):
+    """Splits the tokens of a bracket list at the commas between its items."""
+    items = [[]]
+    depth = 0 if tokens and tokens[0].value == '(' else 1
+    for token in tokens:
+        if token.type == 'punctuation' and token.value == '(':
+            depth += 1
+            if depth == 1:
+                continue
+        elif token.type == 'punctuation' and token.value == ')':
+            depth -= 1
+            if depth == 0:
+                break
+        elif token.type == 'punctuation' and token.value == ',' and depth == 1:
+            items.append([])
+            continue
+        items[-1].append(token)
+    return [item for item in items if item]
+
+
+def _recover_expression(tokens):
+    """Returns the valid comparisons of an expression, combined with the logical operators between them. The
+    brackets are dropped."""
+    operands = []
+    operators = []
+    operator = None
+    segment = []
+    depth_bracket = False
+    for i, token in enumerate(tokens + [None]):
+        if token is not None and not (token.type == 'identifier' and token.value in fast_parser.LOGICAL_OPERATORS):
+            if token.type == 'punctuation' and token.value in ('(', ')'):
+                # Keep the brackets of depths like `parents(depth<=3)`.
+                if token.value == '(' and i + 1 < len(tokens) and tokens[i + 1].value == 'depth':
+                    depth_bracket = True
+                elif not (token.value == ')' and depth_bracket):
+                    continue
+                else:
+                    depth_bracket = False
+            segment.append(token)
+            continue
+        comparision = _parse_tokens(fast_parser.Parser.comparision, segment) if segment else None
+        if comparision is not None:
+            if operands:
+                operators.append(operator)
+            operands.append(comparision)
+        if token is not None:
+            operator = fast_parser.LOGICAL_OPERATORS[token.value]
+        segment = []
+    if not operands:
+        return None
+    return parser.Where(expression=fast_parser._fold_expression(operands, operators))
+
+
+def _path(tokens):
+    """Splits the relation path `a.b.` at the end of `tokens` off, returns its names and the tokens before."""
+    path = []
+    end = len(tokens)
+    while end >= 2 and tokens[end - 1].value == '.' and tokens[end - 2].type == 'identifier':
+        path.insert(0, tokens[end - 2].value)
+        end -= 2
+    return path, tokens[:end]
+
+
+def _operand(tokens):
+    """Returns the names of the field path `a.b.c` at the end of `tokens`."""
+    if not tokens or tokens[-1].type != 'identifier':
+        return []
+    path, _ = _path(tokens[:-1])
+    return path + [tokens[-1].value]
+
+
+def _closed(clause):
+    """True if the brackets of a clause are balanced."""
+    depth = 0
+    for token in clause:
+        depth += {'(': 1, ')': -1}.get(token.value, 0) if token.type == 'punctuation' else 0
+    return depth == 0
@@ -0,0 +1,209 @@
+"""Completions for partial CQL queries, like the ones of an editor while the user types.
+
+Field paths are completed from the relations of the model register, literal values of some fields from a prefix
+index of their most frequent values, which is loaded from a sample of the tables in the background. A completion
+never queries the database.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from heapq import nlargest
+
+from peewee import SQL, fn
+
+from server import fast_parser
+from server.analysis import COMMANDS, Analyzer
+from server.statistics import sample
+
+
+Completion = namedtuple('Completion', ['text', 'kind', 'detail'])
+
+
+class PrefixIndex:
+    """Returns the keys of a dict of keys and weights which start with a prefix, highest weight first.
+
+    The keys are kept sorted, so the keys with a prefix are a range found by binary search. The results of all
+    prefixes up to `precomputed_length` characters, whose ranges are the largest, are computed in advance.
+    """
+
+    def __init__(self, weights, size=10, precomputed_length=2):
+        self.size = size
+        self.precomputed_length = precomputed_length
+        self._keys = sorted(weights)
+        self._weights = [weights[key] for key in self._keys]
+        self._precomputed = {}
+        prefixes = {key[:length] for key in self._keys for length in range(precomputed_length + 1)}
+        for prefix in prefixes:
+            self._precomputed[prefix] = self._top(prefix, size)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def complete(self, prefix, limit=10):
+        if limit <= self.size and len(prefix) <= self.precomputed_length:
+            return self._precomputed.get(prefix, [])[:limit]
+        return self._top(prefix, limit)
+
+    def _top(self, prefix, limit):
+        start = bisect_left(self._keys, prefix)
+        # Every key with the prefix sorts before the prefix followed by the largest character.
+        end = bisect_left(self._keys, prefix + '\U0010ffff', start)
+        # Ties keep the alphabetical order of the keys.
+        top = nlargest(limit, range(start, end), key=lambda i: (self._weights[i], -i))
+        return [self._keys[i] for i in top]
+
+
+class PathIndex:
+    """The field paths of the models of a model register.
+
+    Every model has a prefix index of the names of its fields and relations (fields first). All paths which end at
+    the same model share its node, so a path like `parents.parents.author` is resolved by following the relations
+    from the start model, and cycles in the relations do not blow up the index.
+    """
+
+    def __init__(self, mr):
+        self._names = {}
+        self._details = {}
+        self._targets = {}
+        for model_name, model in mr.items():
+            weights = {}
+            for field_name, field in mr.fields(model).items():
+                weights[field_name] = 2
+                self._details[(model_name, field_name)] = ('field', field.__class__.__name__)
+            relations = dict(mr.relations(model), **mr.recursive_relations(model))
+            for relation_name, relation in relations.items():
+                weights.setdefault(relation_name, 1)
+                self._details.setdefault((model_name, relation_name), ('relation', relation.target._name))
+                self._targets.setdefault((model_name, relation_name), relation.target._name)
+            self._names[model_name] = PrefixIndex(weights)
+
+    def resolve(self, model_name, path):
+        """Returns the name of the model at the end of the relation path `path`, or `None`."""
+        for name in path:
+            model_name = self._targets.get((model_name, name))
+            if model_name is None:
+                return None
+        return model_name
+
+    def complete(self, model_name, path, prefix, limit=10):
+        model_name = self.resolve(model_name, path)
+        if model_name not in self._names:
+            return []
+        return [Completion(name, *self._details[(model_name, name)])
+                for name in self._names[model_name].complete(prefix, limit)]
+
+    def field(self, model_name, path):
+        """Returns the (model name, field name) of a path to a field, or `None`."""
+        if not path:
+            return None
+        model_name = self.resolve(model_name, path[:-1])
+        if self._details.get((model_name, path[-1]), (None,))[0] != 'field':
+            return None
+        return model_name, path[-1]
+
+
+class Completer:
+    """Completes partial CQL queries of the models of `mr`. The values of the fields `value_fields`, a list of
+    (model, field name), are completed from the most frequent values in a sample of their tables, see
+    `load_values`."""
+
+    def __init__(self, mr, value_fields=()):
+        self.mr = mr
+        self.analyzer = Analyzer()
+        self.paths = PathIndex(mr)
+        self.models = PrefixIndex({model_name: 1 for model_name in mr.keys()})
+        self.commands = PrefixIndex({command: -i for i, command in enumerate(COMMANDS)})
+        self.aggregators = PrefixIndex({aggregator: 1 for aggregator in fast_parser.AGGREGATORS})
+        self.operators = PrefixIndex({operator: 1 for operator in fast_parser.LOGICAL_OPERATORS})
+        self.value_fields = list(value_fields)
+        self.values = {}
+        self.values_loaded_at = None
+        self.load_error = None
+        self._loader = None
+        self._lock = threading.Lock()
+
+    def load_values(self, sample_percent=None, limit=10000):
+        """Loads the `limit` most frequent values of every value field. On Postgres only `sample_percent` percent
+        of the pages of the tables are read (`TABLESAMPLE SYSTEM`)."""
+        values = {}
+        for model, field_name in self.value_fields:
+            field = getattr(model, field_name)
+            count = fn.COUNT(SQL('*'))
+            query = model \
+                .select(field, count) \
+                .from_(sample(model, sample_percent)) \
+                .where(field.is_null(False) & (field != '')) \
+                .group_by(field) \
+                .order_by(count.desc()) \
+                .limit(limit)
+            values[(model._name, field_name)] = PrefixIndex(dict(query.tuples()))
+        # The completions use the new indexes once all of them are loaded.
+        self.values = values
+        self.values_loaded_at = time.time()
+        self.load_error = None
+
+    def start_loading(self, connection, sample_percent=None, limit=10000, interval=3600):
+        """Loads the values in a background thread, and again every `interval` seconds. `connection` returns a
+        context manager which provides a database connection. Does nothing if the thread is running already."""
+        def load():
+            while True:
+                try:
+                    with connection():
+                        self.load_values(sample_percent, limit)
+                except Exception as e:
+                    # The old values are kept until the next try.
+                    self.load_error = str(e)
+                time.sleep(interval)
+
+        with self._lock:
+            if self._loader is None and self.value_fields:
+                self._loader = threading.Thread(target=load, name='completion-values', daemon=True)
+                self._loader.start()
+
+    def complete(self, text, offset=None, limit=10, session=None):
+        """Returns the completions for the position `offset` (by default the end) of `text` as a dict with the
+        completions and the range `start`-`end` of `text` which they replace. The analysis of the query reuses the
+        previous one of the same `session`."""
+        context = self.analyzer.analyze(text, offset, session).context
+        completions = self._complete(context, limit)
+        return {
+            'start': context.start,
+            'end': context.start + len(context.prefix),
+            'completions': [dict(completion._asdict()) for completion in completions],
+        }
+
+    def _complete(self, context, limit):
+        prefix = context.prefix
+        if context.kind == 'command':
+            return [Completion(command, 'command', None) for command in self.commands.complete(prefix, limit)
+                    if command in context.commands]
+        elif context.kind == 'model':
+            return [Completion(name, 'model', None) for name in self.models.complete(prefix, limit)]
+        elif context.kind == 'operator':
+            completions = [Completion(operator, 'operator', None) for operator in self.operators.complete(prefix, limit)]
+            completions += [Completion(command, 'command', None) for command in self.commands.complete(prefix, limit)
+                            if command in context.commands]
+            return completions[:limit]
+        elif context.kind not in ('selection', 'field', 'value'):
+            return []
+        completions = self.paths.complete(context.model, context.path, prefix, limit)
+        if context.kind == 'selection':
+            completions += [Completion(aggregator, 'aggregator', None)
+                            for aggregator in self.aggregators.complete(prefix, limit)]
+        elif context.kind == 'value' and not context.path and context.field:
+            completions = self._values(context.model, context.field, prefix, limit) + completions
+        return completions[:limit]
+
+    def _values(self, model_name, path, prefix, limit):
+        field = self.paths.field(model_name, path)
+        index = self.values.get(field)
+        if index is None:
+            return []
+        if prefix[:1] in ('"', "'"):
+            quote, prefix = prefix[0], prefix[1:].replace('\\' + prefix[0], prefix[0])
+        else:
+            quote = '"'
+        return [Completion(quote + value.replace(quote, '\\' + quote) + quote, 'value', '.'.join(field))
+                for value in index.complete(prefix, limit)]
+
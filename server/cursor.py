@@ -0,0 +1,87 @@
+import base64
+import binascii
+import json
+import operator
+from datetime import datetime
+from functools import reduce
+
+from peewee import SQL, Tuple
+
+
+def encode_cursor(values):
+    """Encodes a list of key values into an opaque, url safe cursor token."""
+    data = json.dumps(values, default=_default, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decodes a cursor token created by `encode_cursor`. Raises a `ValueError` for invalid tokens."""
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(data.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f'Invalid cursor {token!r}.')
+    if not isinstance(values, list):
+        raise ValueError(f'Invalid cursor {token!r}.')
+    return values
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return str(obj)
+    raise TypeError(f'Object of type {obj.__class__.__name__} can not be used in a cursor.')
+
+
+def _nullable(key):
+    # Only primary keys are never NULL, the other columns of the existing tables can contain NULL even if their
+    # fields are declared as not null.
+    return not getattr(key, 'primary_key', False)
+
+
+def order_keys(keys):
+    """Returns the ascending orderings of `keys` for `seek`, with NULL values last on all databases."""
+    return [key.asc(nulls='LAST') if _nullable(key) else key.asc() for key in keys]
+
+
+def seek(query, keys, cursor):
+    """Restricts `query`, which is ordered by `order_keys(keys)`, to the rows after the position stored in
+    `cursor`."""
+    values = decode_cursor(cursor)
+    if len(values) != len(keys) or any(value is None for key, value in zip(keys, values) if not _nullable(key)):
+        raise ValueError(f'Invalid cursor {cursor!r}.')
+    if not any(map(_nullable, keys)):
+        if len(keys) == 1:
+            return query.where(keys[0] > values[0])
+        return query.where(Tuple(*keys) > Tuple(*values))
+
+    # A row comparison is NULL if any of the values is NULL, so the rows after the cursor are the rows which are
+    # equal in the first i - 1 keys and greater in the i-th key, for any i. NULL is greater than all other values.
+    conditions = []
+    equal = []
+    for key, value in zip(keys, values):
+        if value is None:
+            # No value is greater than NULL.
+            equal.append(key.is_null())
+            continue
+        greater = (key > value) | key.is_null() if _nullable(key) else key > value
+        conditions.append(reduce(operator.and_, equal + [greater]))
+        equal.append(key == value)
+    if not conditions:
+        return query.where(SQL('1 = 0'))
+    return query.where(reduce(operator.or_, conditions))
+
+
+def paginate(query, keys, cursor=None, limit=50):
+    """Returns the query for the page after `cursor`. One additional row is fetched to detect the last page."""
+    if cursor is not None:
+        query = seek(query, keys, cursor)
+    return query.limit(limit + 1)
+
+
+def split_page(rows, limit, key_values):
+    """Splits the rows of a paginated query into the rows of the page and the cursor of the next page (or `None`).
+    `key_values` returns the values of the page keys of a row."""
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    return rows[:limit], encode_cursor(key_values(rows[limit - 1]))
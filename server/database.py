@@ -1,9 +1,118 @@
 import os
+import threading
+import time
+from contextlib import contextmanager
+
+from playhouse.pool import MaxConnectionsExceeded, PooledSqliteDatabase
+from playhouse.postgres_ext import PooledPostgresqlExtDatabase, PostgresqlExtDatabase, ServerSide
+
+from server import metrics
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+
+class CountingPoolMixin:
+    """Mixin for pooled databases which counts the statements a thread executes within `count_statements`.
+
+    Connections are checked out of the pool per request with `request_connection`. Connections which are older
+    than `stale_timeout` seconds or were closed by the server are discarded instead of being reused.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._counters = threading.local()
+        self._waits = 0
+        self._timeouts = 0
+
+    def connect(self, reuse_if_open=False):
+        with self._pool_lock:
+            if self.is_closed() and not self._connections and self._max_connections and \
+                    len(self._in_use) >= self._max_connections:
+                self._waits += 1
+        try:
+            return super().connect(reuse_if_open)
+        except MaxConnectionsExceeded:
+            with self._pool_lock:
+                self._timeouts += 1
+            raise
+
+    @contextmanager
+    def request_connection(self):
+        """Checks out a connection for the current thread and returns it to the pool afterwards. A connection which
+        is broken after an error is closed instead, so the next request gets a working one."""
+        opened = self.connect(reuse_if_open=True)
+        try:
+            yield
+        except Exception:
+            if not self.is_closed() and self._is_closed(self.connection()):
+                self.manual_close()
+            raise
+        finally:
+            if opened and not self.is_closed():
+                self.close()
+
+    def pool_stats(self):
+        with self._pool_lock:
+            return {
+                'max_connections': self._max_connections,
+                'in_use': len(self._in_use),
+                'idle': len(self._connections),
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+            }
+
+    def execute_sql(self, sql, *args, **kwargs):
+        for counter in getattr(self._counters, 'active', ()):
+            counter.count += 1
+        params = args[0] if args else kwargs.get('params')
+        start = time.perf_counter()
+        cursor = None
+        try:
+            cursor = super().execute_sql(sql, *args, **kwargs)
+            return cursor
+        finally:
+            metrics.add_statement(sql, params, start, time.perf_counter() - start, cursor)
+
+    @contextmanager
+    def count_statements(self):
+        if not hasattr(self._counters, 'active'):
+            self._counters.active = []
+        counter = StatementCounter()
+        self._counters.active.append(counter)
+        try:
+            yield counter
+        finally:
+            self._counters.active.remove(counter)
+
+
+class CountingPostgresqlDatabase(CountingPoolMixin, PooledPostgresqlExtDatabase):
+    pass
+
+
+class CountingSqliteDatabase(CountingPoolMixin, PooledSqliteDatabase):
+    """The pooled database of `CountingPostgresqlDatabase` on SQLite, e.g. for tests of the views."""
+
+
+def iterate(query, array_size=500):
+    """Iterates over the rows of a select query without keeping them in memory. On Postgres the rows are fetched
+    in batches of `array_size` through a named server-side cursor, which has to live in a transaction."""
+    database = query._database
+    if isinstance(database, PostgresqlExtDatabase):
+        with database.atomic():
+            yield from ServerSide(query, array_size=array_size)
+    else:
+        yield from query.iterator()
 
-from peewee import PostgresqlDatabase
 
 db_name = os.environ['PSQL_NAME']
 user = os.environ['PSQL_USER']
 password = os.environ['PSQL_PASSWORD']
 
-db = PostgresqlDatabase(db_name, user=user, password=password)
+db = CountingPostgresqlDatabase(
+    db_name, user=user, password=password,
+    max_connections=int(os.environ.get('DB_POOL_SIZE', 20)),
+    stale_timeout=int(os.environ.get('DB_POOL_MAX_AGE', 300)),
+    timeout=int(os.environ.get('DB_POOL_TIMEOUT', 10)))
@@ -0,0 +1,89 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorSaturated(Exception):
+    pass
+
+
+class BoundedExecutor:
+    """Runs blocking functions, like peewee queries, on a fixed number of worker threads.
+
+    At most `max_workers` functions run at the same time and at most `max_queue` further functions wait for a
+    worker. When the queue is full `run` raises an `ExecutorSaturated` instead of queueing even more work, so a
+    burst of slow requests can not exhaust the memory or the database.
+    """
+
+    def __init__(self, max_workers=8, max_queue=32):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db-worker')
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._max_queued = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def submit(self, func, *args, **kwargs):
+        """Schedules `func(*args, **kwargs)` on a worker thread and returns a `concurrent.futures.Future`."""
+        with self._lock:
+            if self._queued + self._running >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                raise ExecutorSaturated(f'All {self.max_workers} workers are busy and {self._queued} requests wait.')
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        return self._executor.submit(self._job, time.perf_counter(), func, args, kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        """Runs `func(*args, **kwargs)` on a worker thread and returns its result."""
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def _job(self, submitted, func, args, kwargs):
+        wait = time.perf_counter() - submitted
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    def stats(self):
+        with self._lock:
+            started = self._completed + self._running
+            return {
+                'workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'running': self._running,
+                'queued': self._queued,
+                'max_queued': self._max_queued,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'wait_seconds_total': self._wait_total,
+                'wait_seconds_max': self._wait_max,
+                'wait_seconds_avg': self._wait_total / started if started else 0.0,
+            }
+
+    def offload(self, view, on_saturated):
+        """Turns the synchronous responder view `view` into an asynchronous one, which runs it on this executor.
+        `on_saturated(resp, error)` is called instead if the executor is saturated."""
+        @functools.wraps(view)
+        async def offloaded_view(req, resp, *args, **kwargs):
+            try:
+                await self.run(view, req, resp, *args, **kwargs)
+            except ExecutorSaturated as e:
+                on_saturated(resp, e)
+        return offloaded_view
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
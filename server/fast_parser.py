@@ -0,0 +1,342 @@
+"""Hand-written tokenizer and parser for CQL.
+
+Produces the same objects as the pyPEG grammar in `server.parser` (or subclasses of them), but reads the query in
+a single pass without backtracking. Logical expressions are parsed iteratively, so long AND/OR chains and deeply
+nested brackets neither backtrack nor hit the recursion limit.
+"""
+import re
+from collections import namedtuple
+
+from server import parser
+
+
+Token = namedtuple('Token', ['type', 'value', 'start', 'end'])
+
+AGGREGATORS = {
+    'SUM:': parser.SumAggregator,
+    'AVG:': parser.AvgAggregator,
+    'COUNT:': parser.CountAggregator,
+    'MIN:': parser.MinAggregator,
+    'MAX:': parser.MaxAggregator,
+}
+
+COMPARATORS = {
+    '==': parser.EqComparator,
+    '>=': parser.GeqComparator,
+    '<=': parser.LeqComparator,
+    '>': parser.GreaterComparator,
+    '<': parser.LessComparator,
+    '!=': parser.NeqComparator,
+}
+
+LOGICAL_OPERATORS = {
+    'AND': parser.AndOperator,
+    'OR': parser.OrOperator,
+    'XOR': parser.XorOperator,
+}
+
+SAMPLE_METHODS = {
+    'SYSTEM': parser.SystemMethod,
+    'BERNOULLI': parser.BernoulliMethod,
+}
+
+_token_regex = re.compile(r'''
+    (?P<whitespace>\s+)
+  | (?P<command>(?:MODEL|SELECT|GROUPBY|ORDERBY|WHERE|SAMPLE):)
+  | (?P<aggregator>(?:SUM|AVG|COUNT|MIN|MAX):)
+  | (?P<string>(?P<quote>["'])(?:(?=(?P<escape>\\?))(?P=escape).)*?(?P=quote))
+  | (?P<decimal>(?:0|[1-9][0-9]*)\.[0-9]+)
+  | (?P<integer>-?[1-9][0-9]*)
+  | (?P<identifier>[a-zA-Z][a-zA-Z0-9_]*)
+  | (?P<comparator>==|>=|<=|!=|>|<)
+  | (?P<punctuation>[(),.])
+''', re.VERBOSE)
+
+
+def tokenize(text, position=0, partial=False):
+    """Splits `text` into tokens. The last token is always of type `end`. With `partial`, an unterminated string
+    at the end of `text`, like in a query which is still being typed, becomes a token of type `partial_string`."""
+    tokens = list(iter_tokens(text, position, partial))
+    tokens.append(Token('end', '', len(text), len(text)))
+    return tokens
+
+
+def iter_tokens(text, position=0, partial=False):
+    """Generates the tokens of `text` from `position` on, without the `end` token."""
+    length = len(text)
+    match = _token_regex.match
+    while position < length:
+        m = match(text, position)
+        if m is None and partial and text[position] in '"\'':
+            yield Token('partial_string', text[position:], position, length)
+            return
+        if m is None:
+            raise SyntaxError(f'Unexpected character {text[position]!r} at position {position}.')
+        token_type = m.lastgroup
+        if token_type != 'whitespace':
+            yield Token(token_type, m.group(token_type), m.start(), m.end())
+        position = m.end()
+
+
+class Model(parser.Model):
+    name = None
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FieldName(parser.FieldName):
+    values = None
+    depths = None
+
+    def __init__(self, values, depths=None):
+        self.values = values
+        self.depths = depths if depths is not None else [None] * len(values)
+
+
+class Integer(parser.Integer):
+    value = None
+
+    def __init__(self, value):
+        self.value = value
+
+
+class String(parser.String):
+    value = None
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Aggregation(parser.Aggregation):
+    aggregator = None
+
+    def __init__(self, aggregator, field):
+        self.aggregator = aggregator
+        self.field = field
+
+
+class Comparision(parser.Comparision):
+    comparator = None
+
+    def __init__(self, first, comparator, second):
+        self.first = first
+        self.comparator = comparator
+        self.second = second
+
+
+class Sample(parser.Sample):
+    percentage = None
+    method = None
+    seed = None
+
+    def __init__(self, percentage, method, seed):
+        self.percentage = percentage
+        self.method = method
+        self.seed = seed
+
+
+class LogicalExpression(parser.Expression):
+    is_comparision = False
+    is_logical_expression = True
+    first = None
+    second = None
+    comparator = None
+    logical_operator = None
+
+    def __init__(self, first, logical_operator, second):
+        self.first = first
+        self.logical_operator = logical_operator
+        self.second = second
+
+
+class Parser:
+    def __init__(self, text, tokens=None):
+        self.text = text
+        self.tokens = tokenize(text) if tokens is None else tokens
+        self.position = 0
+
+    @property
+    def token(self):
+        return self.tokens[self.position]
+
+    def error(self, expected):
+        token = self.token
+        found = repr(token.value) if token.type != 'end' else 'end of query'
+        return SyntaxError(f'Expected {expected} at position {token.start}, found {found}.')
+
+    def accept(self, token_type, value=None):
+        token = self.tokens[self.position]
+        if token.type == token_type and (value is None or token.value == value):
+            self.position += 1
+            return token
+        return None
+
+    def expect(self, token_type, value=None, expected=None):
+        token = self.accept(token_type, value)
+        if token is None:
+            if expected is None:
+                expected = repr(value) if value is not None else token_type
+            raise self.error(expected)
+        return token
+
+    def parse(self, rule):
+        result = rule()
+        self.expect('end', expected='end of query')
+        return result
+
+    def query(self):
+        query = parser.Query()
+        query.model = self.model()
+        query.select = self.select()
+        query.group_by = self.group_by() if self.token.value == 'GROUPBY:' else None
+        query.order_by = self.order_by() if self.token.value == 'ORDERBY:' else None
+        query.where = self.where() if self.token.value == 'WHERE:' else None
+        query.sample = self.sample() if self.token.value == 'SAMPLE:' else None
+        return query
+
+    def model(self):
+        self.expect('command', 'MODEL:')
+        return Model(self.expect('identifier', expected='model name').value)
+
+    def select(self):
+        self.expect('command', 'SELECT:')
+        return parser.Select(self._bracket_list(self.selection))
+
+    def group_by(self):
+        self.expect('command', 'GROUPBY:')
+        return parser.GroupBy(self._bracket_list(self.field_name))
+
+    def order_by(self):
+        self.expect('command', 'ORDERBY:')
+        return parser.OrderBy(self._bracket_list(self.field_name))
+
+    def where(self):
+        self.expect('command', 'WHERE:')
+        return parser.Where(expression=self.expression())
+
+    def sample(self):
+        self.expect('command', 'SAMPLE:')
+        percentage = self.token
+        if percentage.type not in ('decimal', 'integer') or not 0 < float(percentage.value) <= 100:
+            raise self.error('percentage greater than 0 and at most 100')
+        self.position += 1
+        method = self.accept('identifier', 'SYSTEM') or self.accept('identifier', 'BERNOULLI')
+        seed = None
+        if self.accept('identifier', 'SEED'):
+            seed = int(self.expect('integer', expected='seed').value)
+        return Sample(float(percentage.value), SAMPLE_METHODS[method.value] if method else parser.SystemMethod, seed)
+
+    def _bracket_list(self, item):
+        self.expect('punctuation', '(')
+        items = [item()]
+        while self.accept('punctuation', ','):
+            items.append(item())
+        self.expect('punctuation', ')')
+        return items
+
+    def selection(self):
+        if self.token.type == 'aggregator':
+            return self.aggregation()
+        return self.field_name()
+
+    def aggregation(self):
+        aggregator = AGGREGATORS[self.expect('aggregator').value]
+        return Aggregation(aggregator, self.field_name())
+
+    def field_name(self):
+        values = []
+        depths = []
+        while True:
+            values.append(self.expect('identifier', expected='field name').value)
+            depths.append(self.depth() if self.accept('punctuation', '(') else None)
+            if not self.accept('punctuation', '.'):
+                return FieldName(values, depths)
+
+    def depth(self):
+        # The opening bracket was already accepted.
+        self.expect('identifier', 'depth')
+        self.expect('comparator', '<=')
+        token = self.expect('integer', expected='depth')
+        self.expect('punctuation', ')')
+        return int(token.value)
+
+    def value(self):
+        token = self.token
+        if token.type == 'identifier':
+            return self.field_name()
+        elif token.type == 'integer':
+            self.position += 1
+            return Integer(int(token.value))
+        elif token.type == 'string':
+            self.position += 1
+            return String(token.value[1:-1])
+        raise self.error('field name, integer or string')
+
+    def comparision(self):
+        start = self.token.start
+        first = self.value()
+        comparator = COMPARATORS[self.expect('comparator').value]
+        second = self.value()
+        if not isinstance(first, FieldName) and not isinstance(second, FieldName):
+            raise SyntaxError(f'Comparision at position {start} does not contain a field name.')
+        return Comparision(first, comparator, second)
+
+    def expression(self):
+        # All logical operators have the same precedence and are right associative, like in the pyPEG grammar.
+        # Every open bracket pushes a frame of operands and operators onto an explicit stack.
+        stack = [([], [])]
+        expect_operand = True
+        while True:
+            token = self.token
+            if expect_operand:
+                if token.type == 'punctuation' and token.value == '(':
+                    self.position += 1
+                    stack.append(([], []))
+                    continue
+                stack[-1][0].append(self.comparision())
+                expect_operand = False
+            elif token.type == 'identifier' and token.value in LOGICAL_OPERATORS:
+                self.position += 1
+                stack[-1][1].append(LOGICAL_OPERATORS[token.value])
+                expect_operand = True
+            elif token.type == 'punctuation' and token.value == ')' and len(stack) > 1:
+                self.position += 1
+                operands, operators = stack.pop()
+                stack[-1][0].append(_fold_expression(operands, operators))
+            else:
+                break
+        if len(stack) > 1:
+            raise self.error("')'")
+        return _fold_expression(*stack[0])
+
+
+def _fold_expression(operands, operators):
+    expression = operands[-1]
+    for operand, operator in zip(reversed(operands[:-1]), reversed(operators)):
+        expression = LogicalExpression(operand, operator, expression)
+    return expression
+
+
+_rules = {
+    parser.Query: Parser.query,
+    parser.Model: Parser.model,
+    parser.Select: Parser.select,
+    parser.GroupBy: Parser.group_by,
+    parser.OrderBy: Parser.order_by,
+    parser.Where: Parser.where,
+    parser.Sample: Parser.sample,
+    parser.Expression: Parser.expression,
+    parser.Comparision: Parser.comparision,
+    parser.Aggregation: Parser.aggregation,
+    parser.FieldName: Parser.field_name,
+}
+
+
+def parse(text, thing=parser.Query):
+    """Parses `text` as `thing`, which is one of the grammar classes of `server.parser`. Raises a `SyntaxError`
+    on invalid input, just like `pypeg2.parse`."""
+    if thing not in _rules:
+        raise ValueError(f'{thing.__name__} can not be parsed by the fast parser.')
+    p = Parser(text)
+    return p.parse(lambda: _rules[thing](p))
@@ -0,0 +1,509 @@
+"""An in-memory index of graphs stored as edge tables, like the commit DAG (`commit_parents`) and the follower
+graph (`followers`), for traversals which would need one join per step in SQL.
+
+A graph is stored in compressed sparse row (CSR) form: the ids of its nodes in ascending order, and for every
+node the offsets of its neighbours in an int32 array of node indexes, once for the outgoing and once for the
+incoming edges. A snapshot of the arrays can be written to disk and memory-mapped when the server starts.
+"""
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from itertools import chain
+
+from server.database import iterate
+
+
+DIRECTIONS = ('out', 'in', 'both')
+
+_REVERSE = {'out': 'in', 'in': 'out', 'both': 'both'}
+
+# The marks of `CSRGraph._paint_down`.
+_FIRST, _SECOND, _STALE = 1, 2, 4
+_BOTH = _FIRST | _SECOND
+
+_HEADER = struct.Struct('<8sqqq')
+_MAGIC = b'CSRGRPH1'
+
+
+class CSRGraph:
+    """A directed graph with the node ids `ids` (int64, ascending) and the edges of the node with the index `i`
+    at `targets[offsets[i]:offsets[i + 1]]` (int32). `reverse_offsets` and `reverse_targets` contain the incoming
+    edges. `watermark` is the largest source id of the loaded edges.
+
+    All methods take and return node ids, not indexes. `direction` is one of `out`, `in` and `both`.
+    """
+
+    def __init__(self, ids, offsets, targets, reverse_offsets, reverse_targets, watermark=0, snapshot=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.targets = targets
+        self.reverse_offsets = reverse_offsets
+        self.reverse_targets = reverse_targets
+        self.watermark = watermark
+        # The memory map of a loaded snapshot, which has to stay open while the arrays are used.
+        self._snapshot = snapshot
+        self._degrees = {}
+        self._generations = {}
+
+    @classmethod
+    def from_edges(cls, edges, watermark=0):
+        """Builds a graph from (source id, target id) pairs. Duplicate edges are dropped."""
+        edges = set(edges)
+        ids = array('q', sorted({node_id for edge in edges for node_id in edge}))
+        index = {node_id: i for i, node_id in enumerate(ids)}
+        pairs = [(index[source], index[target]) for source, target in edges]
+        offsets, targets = _csr(len(ids), pairs)
+        reverse_offsets, reverse_targets = _csr(len(ids), [(target, source) for source, target in pairs])
+        return cls(ids, offsets, targets, reverse_offsets, reverse_targets, watermark)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a snapshot written by `save`."""
+        with open(path, 'rb') as file:
+            snapshot = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, node_count, edge_count, watermark = _HEADER.unpack_from(snapshot)
+        if magic != _MAGIC:
+            snapshot.close()
+            raise ValueError(f'{path} is not a graph snapshot.')
+        view = memoryview(snapshot)
+        arrays = []
+        position = _HEADER.size
+        for typecode, length in (('q', node_count), ('i', node_count + 1), ('i', edge_count),
+                                 ('i', node_count + 1), ('i', edge_count)):
+            size = length * array(typecode).itemsize
+            arrays.append(view[position:position + size].cast(typecode))
+            position += size
+        return cls(*arrays, watermark=watermark, snapshot=snapshot)
+
+    def save(self, path):
+        """Writes a snapshot of the graph to `path`, which replaces an existing file atomically."""
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(_HEADER.pack(_MAGIC, self.node_count, self.edge_count, self.watermark))
+            for values in (self.ids, self.offsets, self.targets, self.reverse_offsets, self.reverse_targets):
+                file.write(values.tobytes())
+        os.replace(temporary_path, path)
+
+    @property
+    def node_count(self):
+        return len(self.ids)
+
+    @property
+    def edge_count(self):
+        return len(self.targets)
+
+    def edges(self):
+        ids, offsets, targets = self.ids, self.offsets, self.targets
+        for i in range(len(ids)):
+            for j in range(offsets[i], offsets[i + 1]):
+                yield ids[i], ids[targets[j]]
+
+    def with_edges(self, edges, watermark):
+        """Returns a new graph with the edges of this graph and `edges`.
+
+        If all new nodes have larger ids than the existing ones, like new commits, the existing nodes keep their
+        indexes: the arrays are copied in slices and only the lists of nodes with new edges are rebuilt. Otherwise
+        the graph is built again from all edges.
+        """
+        edges = {(source, target) for source, target in set(edges) if not self._has_edge(source, target)}
+        watermark = max(self.watermark, watermark)
+        new_ids = sorted({node_id for edge in edges for node_id in edge if node_id not in self})
+        if new_ids and self.node_count and new_ids[0] < self.ids[-1]:
+            return CSRGraph.from_edges(chain(self.edges(), edges), watermark)
+
+        old_count = self.node_count
+        new_index = {node_id: old_count + i for i, node_id in enumerate(new_ids)}
+        pairs = [(self._index(source) if source in self else new_index[source],
+                  self._index(target) if target in self else new_index[target]) for source, target in edges]
+        node_count = old_count + len(new_ids)
+        ids = array('q', self.ids)
+        ids.extend(new_ids)
+        offsets, targets = _extend_csr(self.offsets, self.targets, node_count, pairs)
+        reverse_offsets, reverse_targets = _extend_csr(
+            self.reverse_offsets, self.reverse_targets, node_count, [(target, source) for source, target in pairs])
+        graph = CSRGraph(ids, offsets, targets, reverse_offsets, reverse_targets, watermark)
+
+        # The generation numbers of the existing nodes stay valid if none of them got new neighbours.
+        for direction, gained in (('out', {source for source, _ in pairs}), ('in', {target for _, target in pairs})):
+            if direction in self._generations:
+                known = self._generations[direction]
+                if known is None:
+                    graph._generations[direction] = None
+                elif all(i >= old_count for i in gained):
+                    graph._generations[direction] = _generations(graph, direction, known)
+        return graph
+
+    def __contains__(self, node_id):
+        return self._index(node_id) is not None
+
+    def degree(self, node_id, direction='out'):
+        i = self._index(node_id)
+        if i is None:
+            return 0
+        return sum(offsets[i + 1] - offsets[i] for offsets, _ in self._adjacency(direction))
+
+    def top_degree(self, k, direction='in'):
+        """Returns the `k` nodes with the highest degree as (id, degree) pairs."""
+        if direction not in self._degrees:
+            adjacency = self._adjacency(direction)
+            self._degrees[direction] = array('i', (
+                sum(offsets[i + 1] - offsets[i] for offsets, _ in adjacency) for i in range(self.node_count)))
+        degrees = self._degrees[direction]
+        top = heapq.nlargest(k, range(len(degrees)), key=degrees.__getitem__)
+        return [(self.ids[i], degrees[i]) for i in top]
+
+    def neighbourhood(self, node_id, hops=1, direction='out', limit=None):
+        """Returns the nodes within `hops` steps of `node_id`, nearest first, as an OrderedDict which maps their
+        ids to their distance. At most `limit` nodes are returned."""
+        start = self._index(node_id)
+        result = OrderedDict()
+        if start is None:
+            return result
+        visited = {start}
+        frontier = [start]
+        for distance in range(1, hops + 1):
+            next_frontier = []
+            for i in frontier:
+                for neighbour in self._neighbours(i, direction):
+                    if neighbour in visited:
+                        continue
+                    visited.add(neighbour)
+                    next_frontier.append(neighbour)
+                    result[self.ids[neighbour]] = distance
+                    if limit is not None and len(result) >= limit:
+                        return result
+            frontier = next_frontier
+        return result
+
+    def shortest_path(self, source_id, target_id, direction='out', max_hops=None):
+        """Returns the ids of a shortest path from `source_id` to `target_id`, or `None` if there is none within
+        `max_hops` steps."""
+        # Bidirectional breadth first search, which always expands the smaller frontier by one level.
+        source, target = self._index(source_id), self._index(target_id)
+        if source is None or target is None:
+            return None
+        if source == target:
+            return [source_id]
+        forward, backward = {source: None}, {target: None}
+        forward_frontier, backward_frontier = [source], [target]
+        hops = 0
+        while forward_frontier and backward_frontier and (max_hops is None or hops < max_hops):
+            hops += 1
+            if len(forward_frontier) <= len(backward_frontier):
+                forward_frontier, meeting = self._expand(forward_frontier, forward, backward, direction)
+            else:
+                backward_frontier, meeting = self._expand(backward_frontier, backward, forward, _REVERSE[direction])
+            if meeting is not None:
+                path = _walk(forward, meeting)[::-1] + _walk(backward, backward[meeting])
+                return [self.ids[i] for i in path]
+        return None
+
+    def common_ancestors(self, first_id, second_id, direction='out'):
+        """Returns the best common ancestors of two nodes, i.e. the nodes reachable from both (or one of them
+        itself) which are not reachable from another common ancestor, like `git merge-base --all` for commits.
+
+        Like git, the nodes are visited in the order of their generation numbers, which decrease along every edge,
+        so the search stops below the best common ancestors instead of visiting the whole history. Graphs with a
+        cycle in `direction` have no generation numbers, there all nodes reachable from both nodes are visited.
+        """
+        first, second = self._index(first_id), self._index(second_id)
+        if first is None or second is None:
+            return []
+        generations = self.generations(direction)
+        if generations is None:
+            common = self._reachable([first], direction) & self._reachable([second], direction)
+        else:
+            common = self._paint_down(first, second, direction, generations)
+        # Everything reachable from a common ancestor is a common ancestor as well, but not one of the best. Nodes
+        # with a smaller generation number than all common ancestors can not reach any of them.
+        min_generation = min(generations[i] for i in common) if generations is not None and common else 0
+        redundant = self._reachable(
+            [neighbour for i in common for neighbour in self._neighbours(i, direction)], direction,
+            generations, min_generation)
+        return sorted(self.ids[i] for i in common - redundant)
+
+    def generations(self, direction='out'):
+        """Returns the generation number of every node by index: 1 for nodes without neighbours in `direction`,
+        otherwise one more than the largest generation number of their neighbours. Returns `None` if the edges of
+        `direction` contain a cycle."""
+        if direction not in self._generations:
+            self._generations[direction] = _generations(self, direction)
+        return self._generations[direction]
+
+    def _has_edge(self, source_id, target_id):
+        source, target = self._index(source_id), self._index(target_id)
+        return source is not None and target is not None and target in self._neighbours(source, 'out')
+
+    def _index(self, node_id):
+        i = bisect_left(self.ids, node_id)
+        return i if i < len(self.ids) and self.ids[i] == node_id else None
+
+    def _adjacency(self, direction):
+        assert direction in DIRECTIONS, f'direction must be one of {", ".join(DIRECTIONS)}.'
+        adjacency = []
+        if direction != 'in':
+            adjacency.append((self.offsets, self.targets))
+        if direction != 'out':
+            adjacency.append((self.reverse_offsets, self.reverse_targets))
+        return adjacency
+
+    def _neighbours(self, i, direction):
+        for offsets, targets in self._adjacency(direction):
+            yield from targets[offsets[i]:offsets[i + 1]]
+
+    def _expand(self, frontier, visited, other, direction):
+        next_frontier = []
+        for i in frontier:
+            for neighbour in self._neighbours(i, direction):
+                if neighbour not in visited:
+                    visited[neighbour] = i
+                    if neighbour in other:
+                        return next_frontier, neighbour
+                    next_frontier.append(neighbour)
+        return next_frontier, None
+
+    def _reachable(self, starts, direction, generations=None, min_generation=0):
+        """Returns the nodes reachable from `starts`, without the nodes with a generation number below
+        `min_generation` (and the nodes only reachable through them)."""
+        reached = {i for i in starts if generations is None or generations[i] >= min_generation}
+        pending = list(reached)
+        while pending:
+            for neighbour in self._neighbours(pending.pop(), direction):
+                if neighbour not in reached and (generations is None or generations[neighbour] >= min_generation):
+                    reached.add(neighbour)
+                    pending.append(neighbour)
+        return reached
+
+    def _paint_down(self, first, second, direction, generations):
+        """Returns the common ancestors of two nodes which are not reachable from another common ancestor through
+        the nodes visited so far, i.e. the best common ancestors and possibly some which are not (git's
+        `paint_down_to_common`)."""
+        # Nodes are marked with the nodes they are reachable from. A common ancestor marks the nodes below it as
+        # stale, the search stops once only stale nodes are left.
+        flags = {first: _FIRST}
+        flags[second] = flags.get(second, 0) | _SECOND
+        queue = [(-generations[first], first), (-generations[second], second)]
+        common = set()
+        while any(not flags[i] & _STALE for _, i in queue):
+            _, i = heapq.heappop(queue)
+            flag = flags[i]
+            if flag & _BOTH == _BOTH and not flag & _STALE:
+                common.add(i)
+                flag |= _STALE
+                flags[i] = flag
+            for neighbour in self._neighbours(i, direction):
+                if flags.get(neighbour, 0) & flag != flag:
+                    flags[neighbour] = flags.get(neighbour, 0) | flag
+                    heapq.heappush(queue, (-generations[neighbour], neighbour))
+        return common
+
+
+def _generations(graph, direction, known=None):
+    """Computes the generation numbers of the nodes of `graph` (see `CSRGraph.generations`) in topological order.
+    The first nodes keep the generation numbers `known`, if their neighbours did not change."""
+    start = len(known) if known is not None else 0
+    generations = array('i', known if known is not None else ())
+    generations.frombytes(bytes(generations.itemsize * (graph.node_count - start)))
+    # The number of neighbours of every node whose generation number is still unknown.
+    pending = {i: sum(1 for neighbour in graph._neighbours(i, direction) if neighbour >= start)
+               for i in range(start, graph.node_count)}
+    ready = [i for i, count in pending.items() if not count]
+    done = 0
+    while ready:
+        i = ready.pop()
+        done += 1
+        generations[i] = 1 + max((generations[neighbour] for neighbour in graph._neighbours(i, direction)), default=0)
+        for predecessor in graph._neighbours(i, _REVERSE[direction]):
+            if predecessor >= start:
+                pending[predecessor] -= 1
+                if not pending[predecessor]:
+                    ready.append(predecessor)
+    return generations if done == len(pending) else None
+
+
+def _extend_csr(offsets, targets, node_count, pairs):
+    """Returns the CSR arrays `offsets` and `targets` with the edges `pairs` of (source, target) indexes added, for
+    `node_count` nodes. Nodes after the existing ones have no other edges."""
+    added = {}
+    for source, target in pairs:
+        added.setdefault(source, []).append(target)
+    old_count = len(offsets) - 1
+    end = offsets[old_count]
+    new_offsets = array('i')
+    new_targets = array('i')
+    position = 0
+    shift = 0
+    for source in sorted(added):
+        # The nodes before `source` keep their edges, which move by the number of edges added before them.
+        new_offsets.extend(map(shift.__add__, offsets[position:min(source, old_count)]))
+        new_offsets.extend([end + shift] * (source - max(position, old_count)))
+        start, stop = (offsets[source], offsets[source + 1]) if source < old_count else (end, end)
+        new_targets.extend(targets[offsets[min(position, old_count)]:start])
+        new_offsets.append(start + shift)
+        new_targets.extend(sorted(chain(targets[start:stop], added[source])))
+        shift += len(added[source])
+        position = source + 1
+    new_offsets.extend(map(shift.__add__, offsets[position:]))
+    new_offsets.extend([end + shift] * (node_count + 1 - len(new_offsets)))
+    new_targets.extend(targets[offsets[min(position, old_count)]:end])
+    return new_offsets, new_targets
+
+
+def _csr(node_count, pairs):
+    pairs = sorted(pairs)
+    offsets = array('i', bytes(4 * (node_count + 1)))
+    for source, _ in pairs:
+        offsets[source + 1] += 1
+    for i in range(node_count):
+        offsets[i + 1] += offsets[i]
+    return offsets, array('i', (target for _, target in pairs))
+
+
+def _walk(parents, i):
+    path = []
+    while i is not None:
+        path.append(i)
+        i = parents[i]
+    return path
+
+
+class GraphSource(namedtuple('GraphSource', ['source', 'target', 'incremental'])):
+    """The edge table of a graph: every row is an edge from the foreign key `source` to the foreign key `target`.
+
+    If `incremental` is set, rows are only ever added with a source larger than all existing ones, like the parents
+    of new commits. A refresh then only loads the rows after the largest known source, otherwise the whole table.
+    """
+    __slots__ = ()
+
+    @property
+    def table(self):
+        return self.source.model._meta.table_name
+
+
+class GraphIndex:
+    """Loads the graphs of `sources` (a dict of name and `GraphSource`) on first use.
+
+    If `snapshot_dir` is set, the graphs are stored there after they were loaded, and snapshots are memory-mapped
+    instead of reading the tables again. `invalidate` marks the graphs of changed tables as stale, they are
+    refreshed on their next use. Graphs of incremental sources are also refreshed after loading a snapshot.
+
+    Graphs are loaded without holding the lock of the index, which only guards swapping them in. While a graph is
+    refreshed, other requests keep using the old one; only the first load of a graph is waited for.
+    """
+
+    def __init__(self, sources, snapshot_dir=None):
+        self.sources = sources
+        self.snapshot_dir = snapshot_dir
+        self._graphs = {}
+        self._stale = set()
+        self._lock = threading.Lock()
+        self._loading = {name: threading.Lock() for name in sources}
+
+        self.loads = 0
+        self.refreshes = 0
+        self.load_seconds = 0.0
+
+    def __contains__(self, name):
+        return name in self.sources
+
+    def get(self, name):
+        with self._lock:
+            graph = self._graphs.get(name)
+            if graph is not None and name not in self._stale:
+                return graph
+        loading = self._loading[name]
+        if not loading.acquire(blocking=graph is None):
+            # Another request refreshes the graph.
+            return graph
+        try:
+            with self._lock:
+                graph = self._graphs.get(name)
+                if graph is not None and name not in self._stale:
+                    # Loaded by the request we waited for.
+                    return graph
+                # Cleared before reading the table, so an invalidation during the refresh is not lost.
+                self._stale.discard(name)
+            start = time.perf_counter()
+            try:
+                graph = self._load(name) if graph is None else self._refresh(name, graph)
+            except Exception:
+                with self._lock:
+                    if name in self._graphs:
+                        self._stale.add(name)
+                raise
+            # Computed here, so the first request which needs them does not wait for them.
+            graph.generations()
+            with self._lock:
+                self._graphs[name] = graph
+                self.load_seconds += time.perf_counter() - start
+            return graph
+        finally:
+            loading.release()
+
+    def invalidate(self, tables=None):
+        """Marks the graphs read from `tables` as stale, all graphs if `tables` is `None`. Returns their names."""
+        with self._lock:
+            names = [name for name, source in self.sources.items() if tables is None or source.table in tables]
+            self._stale.update(name for name in names if name in self._graphs)
+            return names
+
+    def stats(self):
+        with self._lock:
+            graphs = {
+                name: {'nodes': graph.node_count, 'edges': graph.edge_count, 'watermark': graph.watermark,
+                       'stale': name in self._stale}
+                for name, graph in self._graphs.items()
+            }
+            return {'graphs': graphs, 'loads': self.loads, 'refreshes': self.refreshes,
+                    'load_seconds': self.load_seconds}
+
+    def _load(self, name):
+        path = self._snapshot_path(name)
+        if path is not None and os.path.exists(path):
+            graph = CSRGraph.load(path)
+            if self.sources[name].incremental:
+                return self._refresh(name, graph)
+            return graph
+        with self._lock:
+            self.loads += 1
+        edges, watermark = self._read_edges(self.sources[name])
+        graph = CSRGraph.from_edges(edges, watermark)
+        self._save(name, graph)
+        return graph
+
+    def _refresh(self, name, graph):
+        source = self.sources[name]
+        with self._lock:
+            self.refreshes += 1
+        if source.incremental:
+            edges, watermark = self._read_edges(source, after=graph.watermark)
+            if not edges:
+                return graph
+            new_graph = graph.with_edges(edges, watermark)
+        else:
+            new_graph = CSRGraph.from_edges(*self._read_edges(source))
+        # Requests which still use the old graph keep it, a replaced snapshot stays mapped until it is released.
+        self._save(name, new_graph)
+        return new_graph
+
+    def _read_edges(self, source, after=None):
+        query = source.source.model.select(source.source, source.target)
+        if after is not None:
+            query = query.where(source.source > after)
+        edges = [edge for edge in iterate(query.tuples(), 10000) if None not in edge]
+        watermark = max((edge[0] for edge in edges), default=after or 0)
+        return edges, watermark
+
+    def _save(self, name, graph):
+        path = self._snapshot_path(name)
+        if path is not None:
+            graph.save(path)
+
+    def _snapshot_path(self, name):
+        return os.path.join(self.snapshot_dir, f'{name}.csr') if self.snapshot_dir is not None else None
@@ -0,0 +1,157 @@
+from collections import defaultdict
+
+from peewee import SQL, fn
+
+from server.cursor import encode_cursor, paginate, split_page
+
+
+MAX_EXPAND_DEPTH = 3
+
+
+class RelationLoader:
+    """Loads objects of a model as dicts together with the relations chosen by the client.
+
+    Every relation is loaded with one query per expanded level for all parent objects. Lists of 1:n and n:m
+    relations are capped at `limit` objects per parent. For each list the total count and a cursor for the next
+    page are stored under the key `_relations` of the parent.
+    """
+
+    def __init__(self, mr, limit=20, max_limit=1000):
+        self.mr = mr
+        self.limit = limit
+        self.max_limit = max_limit
+
+    def parse_expand(self, model, expand=None):
+        """Converts comma separated relation paths like `commits.author,projects` into a nested dict. `*` stands
+        for all relations of a model, no expand parameter for all relations of the requested object."""
+        paths = [path.strip() for path in expand.split(',') if path.strip()] if expand is not None else ['*']
+        tree = {}
+        for path in paths:
+            names = path.split('.')
+            if len(names) > MAX_EXPAND_DEPTH:
+                raise ValueError(f'Relations can be expanded at most {MAX_EXPAND_DEPTH} levels deep.')
+            self._add_expand_path(model, tree, names)
+        return tree
+
+    def _add_expand_path(self, model, tree, names):
+        name, *names = names
+        if name == '*':
+            if names:
+                raise ValueError('* can only be used at the end of a relation path.')
+            for relation_name in self.mr.relations(model):
+                tree.setdefault(relation_name, {})
+            return
+        relation = self.mr.relation(model, name)
+        if relation is None:
+            raise ValueError(f'Relation {name} of model {model._name} does not exist.')
+        subtree = tree.setdefault(name, {})
+        if names:
+            self._add_expand_path(relation.target, subtree, names)
+
+    def clamp_limit(self, limit=None):
+        if limit is None:
+            return self.limit
+        return max(1, min(int(limit), self.max_limit))
+
+    def load(self, model, id_, expand=None, limit=None):
+        """Returns the object with the primary key `id_` and its expanded relations. `expand` is a nested dict
+        created by `parse_expand`."""
+        primary_key = model._meta.primary_key
+        rows = list(model.select().where(primary_key == id_).dicts())
+        if not rows:
+            raise model.DoesNotExist(f'{model._name} {id_} does not exist.')
+        results = [self._fields_dict(model, row) for row in rows]
+        self._expand(model, rows, results, expand if expand is not None else self.parse_expand(model),
+                     self.clamp_limit(limit))
+        return results[0]
+
+    def load_page(self, model, id_, relation_name, cursor=None, limit=None):
+        """Returns one page of a 1:n or n:m relation of a single object, ordered by primary key."""
+        relation = self.mr.relation(model, relation_name)
+        if relation is None or relation.kind == 'n:1':
+            raise ValueError(f'{relation_name} is not a 1:n or n:m relation of model {model._name}.')
+        target = relation.target
+        limit = self.clamp_limit(limit)
+
+        target_key = target._meta.primary_key
+        query = target.select(target)
+        if relation.join_field is not None:
+            query = query.join(relation.join_model, on=_join_condition(relation))
+        query = paginate(query.where(relation.field == id_).order_by(target_key).dicts(), [target_key], cursor, limit)
+
+        rows, next_cursor = split_page(query, limit, lambda row: [row[target_key.name]])
+        return {'items': [self._fields_dict(target, row) for row in rows], 'cursor': next_cursor}
+
+    def _expand(self, model, rows, results, expand, limit):
+        relations = self.mr.relations(model)
+        for name, subtree in expand.items():
+            relation = relations[name]
+            if relation.kind == 'n:1':
+                child_rows, child_results = self._expand_n1(rows, results, relation)
+            else:
+                child_rows, child_results = self._expand_list(rows, results, relation, limit)
+            if subtree and child_rows:
+                self._expand(relation.target, child_rows, child_results, subtree, limit)
+
+    def _expand_n1(self, rows, results, relation):
+        name, field, target = relation.name, relation.field, relation.target
+        keys = {row[field.name] for row in rows} - {None}
+        target_rows = {}
+        if keys:
+            query = target.select().where(field.rel_field.in_(list(keys))).dicts()
+            target_rows = {row[field.rel_field.name]: row for row in query}
+        target_results = {key: self._fields_dict(target, row) for key, row in target_rows.items()}
+        for row, result in zip(rows, results):
+            result[name] = target_results.get(row[field.name])
+        return list(target_rows.values()), list(target_results.values())
+
+    def _expand_list(self, rows, results, relation, limit):
+        name, key, target = relation.name, relation.field, relation.target
+        parent_field = key.rel_field.name
+        keys = {row[parent_field] for row in rows} - {None}
+
+        target_key = target._meta.primary_key
+        children = defaultdict(list)
+        totals = {}
+        last_keys = {}
+        child_rows = []
+        child_results = []
+        if keys:
+            partition = {'partition_by': [key]}
+            ranked = target.select(
+                target,
+                key.alias('_key'),
+                fn.ROW_NUMBER().over(order_by=[target_key], **partition).alias('_rank'),
+                fn.COUNT(SQL('*')).over(**partition).alias('_total'))
+            if relation.join_field is not None:
+                ranked = ranked.join(relation.join_model, on=_join_condition(relation))
+            ranked = ranked.where(key.in_(list(keys))).alias('ranked')
+            query = target \
+                .select(SQL('*')) \
+                .from_(ranked) \
+                .where(ranked.c._rank <= limit) \
+                .order_by(ranked.c._key, ranked.c._rank) \
+                .dicts()
+            for row in query:
+                child_result = self._fields_dict(target, row)
+                children[row['_key']].append(child_result)
+                totals[row['_key']] = row['_total']
+                last_keys[row['_key']] = row[target_key.name]
+                child_rows.append(row)
+                child_results.append(child_result)
+
+        for row, result in zip(rows, results):
+            parent_key = row[parent_field]
+            result[name] = children.get(parent_key, [])
+            count = totals.get(parent_key, 0)
+            cursor = encode_cursor([last_keys[parent_key]]) if count > len(result[name]) else None
+            result.setdefault('_relations', {})[name] = {'count': count, 'cursor': cursor}
+        return child_rows, child_results
+
+    def _fields_dict(self, model, row):
+        return {field_name: row.get(field_name) for field_name in self.mr.fields(model)}
+
+
+def _join_condition(relation):
+    """Joins the nm-relation of a n:m relation to its target."""
+    return relation.join_field == relation.join_field.rel_field
@@ -0,0 +1,188 @@
+"""Request metrics in the Prometheus text format.
+
+Stages of a request (parsing, building, SQL, ...) are timed with `stage`, which records into the metrics of the
+request the current thread is working on, if any. That way deeply nested code like the query builder can be timed
+without passing the request around.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_local = threading.local()
+
+Statement = namedtuple('Statement', ['sql', 'params', 'start', 'duration', 'rows'])
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.rows = 0
+        self.statements = []
+
+    def add_time(self, stage_name, seconds):
+        self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+
+    def merge(self, other):
+        """Adds the stages, rows and statements of `other`, e.g. of a part of the request which ran on another
+        thread."""
+        for stage_name, seconds in other.stages.items():
+            self.add_time(stage_name, seconds)
+        self.rows += other.rows
+        self.statements.extend(other.statements)
+
+    def server_timing(self):
+        """Returns the value of a `Server-Timing` header with the duration of all stages in milliseconds."""
+        return ', '.join(f'{name};dur={seconds * 1000:.3f}' for name, seconds in self.stages.items())
+
+
+@contextmanager
+def track_request():
+    """Makes a new `RequestMetrics` the current one of this thread."""
+    previous = getattr(_local, 'current', None)
+    _local.current = RequestMetrics()
+    try:
+        yield _local.current
+    finally:
+        _local.current = previous
+
+
+def current():
+    return getattr(_local, 'current', None)
+
+
+@contextmanager
+def stage(stage_name):
+    """Adds the time spent in the block to the stage `stage_name` of the current request."""
+    request_metrics = current()
+    if request_metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request_metrics.add_time(stage_name, time.perf_counter() - start)
+
+
+def add_time(stage_name, seconds):
+    request_metrics = current()
+    if request_metrics is not None:
+        request_metrics.add_time(stage_name, seconds)
+
+
+def add_statement(sql, params, start, duration, cursor=None):
+    """Records an executed SQL statement in the current request. The number of rows is only known for cursors
+    which report it."""
+    request_metrics = current()
+    if request_metrics is not None:
+        request_metrics.add_time('sql', duration)
+        rows = getattr(cursor, 'rowcount', -1)
+        request_metrics.statements.append(
+            Statement(sql, list(params or ()), start, duration, rows if rows is not None and rows >= 0 else None))
+
+
+def add_rows(count):
+    request_metrics = current()
+    if request_metrics is not None:
+        request_metrics.rows += count
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        assert set(labels) == set(self.labelnames), f'{self.name} expects the labels {self.labelnames}.'
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        labels = list(zip(self.labelnames, key)) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            for key in sorted(self._values):
+                lines.extend(self._render_value(key, self._values[key]))
+        return lines
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{self._labels(key)} {value}']
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                # The counts of the buckets (the last one is +Inf) and the sum of all values.
+                self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts, _ = self._values[key]
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key][1] += value
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{self.name}_bucket{self._labels(key, [("le", le)])} {cumulative}')
+        lines.append(f'{self.name}_sum{self._labels(key)} {total}')
+        lines.append(f'{self.name}_count{self._labels(key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
@@ -1,4 +1,8 @@
+from collections import namedtuple
 from enum import Enum
+from types import MappingProxyType
+
+import peewee
 
 from server.common import camel_to_snake
 
@@ -17,10 +21,31 @@ def _relation_other_field_name(cls, field_name):
     return field_names[0] if field_name == field_names[1] else field_names[1]
 
 
+class Relation(namedtuple('Relation', ['name', 'kind', 'model', 'target', 'field', 'join_field'])):
+    """A relation `name` of `model` to `target`. `kind` is one of `n:1`, `1:n` and `n:m`.
+
+    `field` is the foreign key which connects both models: for n:1 relations the foreign key of `model`, for 1:n
+    relations the foreign key of `target` and for n:m relations the foreign key of the nm-relation which points to
+    `model`. `join_field` is the foreign key of the nm-relation which points to `target`, `None` otherwise.
+    """
+    __slots__ = ()
+
+    @property
+    def join_model(self):
+        return self.field.model if self.join_field is not None else None
+
+    @property
+    def shadow_name(self):
+        return self.join_field.name if self.join_field is not None else None
+
+
 class ModelRegister:
     def __init__(self):
         self._models = {}
         self._nm_relations = {}
+        self._recursive_relations = {}
+        self._fields = MappingProxyType({})
+        self._relations = MappingProxyType({})
 
     def add_model(self, model):
         name = camel_to_snake(model.__name__)
@@ -29,6 +54,7 @@ class ModelRegister:
         model._type = ModelType.MODEL
 
         self._models[name] = model
+        self._build_index()
         return model
 
     def add_nm(self, nm_relation):
@@ -44,8 +70,61 @@ class ModelRegister:
         nm_relation._other_field_name = classmethod(_relation_other_field_name)
 
         self._nm_relations[name] = nm_relation
+        self._build_index()
         return nm_relation
 
+    def add_recursive(self, model, name, relation_name):
+        """Adds the transitive relation `name` of `model`, which follows the self-referencing relation
+        `relation_name` repeatedly, e.g. `ancestors` for `parents`."""
+        relation = self.relation(model, relation_name)
+        assert relation is not None and relation.target is model, \
+            f'Relation {relation_name} of model {model._name} does not reference the model itself.'
+        self._recursive_relations.setdefault(model._name, {})[name] = relation._replace(name=name)
+
+    def recursive_relation(self, model, name, default=None):
+        """Returns a transitive relation added with `add_recursive` as the `Relation` which it follows."""
+        return self._recursive_relations.get(model._name, {}).get(name, default)
+
+    def recursive_relations(self, model):
+        return MappingProxyType(self._recursive_relations.get(model._name, {}))
+
+    def _build_index(self):
+        # Backrefs are only complete once the referencing models are defined, so the index is rebuilt for every
+        # registered model. The index is replaced as a whole and never modified, readers need no lock.
+        fields = {}
+        relations = {}
+        for name, model in self._models.items():
+            fields[name] = MappingProxyType({
+                field_name: field for field_name, field in model._meta.fields.items()
+                if not isinstance(field, peewee.ForeignKeyField)
+            })
+            model_relations = {}
+            for field_name, field in model._meta.fields.items():
+                if isinstance(field, peewee.ForeignKeyField):
+                    model_relations[field_name] = Relation(field_name, 'n:1', model, field.rel_model, field, None)
+            for backref, backref_model in model._meta.backrefs.items():
+                backref_type = getattr(backref_model, '_type', None)
+                if backref_type is ModelType.MODEL:
+                    model_relations[backref.backref] = Relation(
+                        backref.backref, '1:n', model, backref_model, backref, None)
+                elif backref_type is ModelType.NM_RELATION:
+                    other_field = backref_model._other_field(backref)
+                    model_relations[backref.backref] = Relation(
+                        backref.backref, 'n:m', model, other_field.rel_model, backref, other_field)
+            relations[name] = MappingProxyType(model_relations)
+        self._fields = MappingProxyType(fields)
+        self._relations = MappingProxyType(relations)
+
+    def fields(self, model):
+        """Returns the fields of a model (or model alias) which are no foreign keys, by name."""
+        return self._fields[model._name]
+
+    def relations(self, model):
+        """Returns the relations of a model (or model alias) as `Relation` by name."""
+        return self._relations[model._name]
+
+    def relation(self, model, name, default=None):
+        return self._relations[model._name].get(name, default)
 
     def __contains__(self, item):
         return item in self._models
@@ -76,35 +155,25 @@ class ModelRegister:
         # model_desc = self.model_desc(model_name)
 
         result = {}
-        for field_name, field in model._meta.fields.items():
-        # for field_name, field_desc in model_desc['fields'].items():
-            if field.__class__.__name__ == 'ForeignKeyField':
-                continue
+        for field_name in self.fields(model):
             result[field_name] = query.__data__.get(field_name)
 
         if depth > 0:
-            for field_name, field in model._meta.fields.items():
-                # n:1
-                if field.__class__.__name__ != 'ForeignKeyField':
-                    continue
-                if query.__data__.get(field_name):
-                    relation_query = getattr(query, field_name)
-                    result[field_name] = self.query_dict(relation_query, depth - 1)
+            for relation_name, relation in self.relations(model).items():
+                if relation.kind == 'n:1':
+                    if query.__data__.get(relation_name):
+                        relation_query = getattr(query, relation_name)
+                        result[relation_name] = self.query_dict(relation_query, depth - 1)
+                    else:
+                        result[relation_name] = None
+                elif relation.kind == '1:n':
+                    relation_queries = getattr(query, relation_name)
+                    result[relation_name] = [self.query_dict(relation_query, depth - 1) for relation_query in relation_queries]
                 else:
-                    result[field_name] = None
-            for backref, backref_model in model._meta.backrefs.items():
-                if backref_model._type is ModelType.MODEL:
-                    # 1:n
-                    relation_queries = getattr(query, backref.backref)
-                    result[backref.backref] = [self.query_dict(relation_query, depth - 1) for relation_query in relation_queries]
-                elif backref_model._type is ModelType.NM_RELATION:
-                    # n:m
-                    relation_queries = getattr(query, backref.backref)
-                    accum = []
-                    for relation_query in relation_queries:
-                        other_field = backref_model._other_field(backref).name
-                        accum.append(self.query_dict(getattr(relation_query, other_field), depth - 1))
-                    result[backref.backref] = accum
+                    relation_queries = getattr(query, relation_name)
+                    result[relation_name] = [
+                        self.query_dict(getattr(relation_query, relation.shadow_name), depth - 1)
+                        for relation_query in relation_queries]
         return result
 
 class ModelType(Enum):
@@ -113,3 +113,7 @@ class Issue(Model):
     class Meta:
         database = db
         table_name = 'issues'
+
+
+mr.add_recursive(Commit, 'ancestors', 'parents')
+mr.add_recursive(Commit, 'descendants', 'children')
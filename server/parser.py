@@ -16,6 +16,9 @@ class OrderCommand(str):
 class WhereCommand(str):
     grammar = 'WHERE:'
 
+class SampleCommand(str):
+    grammar = 'SAMPLE:'
+
 class SumAggregator(str):
     grammar = 'SUM:'
 
@@ -52,6 +55,14 @@ class String:
     def value(self):
         return self._value[1:-1]
 
+class Percentage:
+    # Greater than 0 and at most 100.
+    grammar = attr('_value', re.compile(r'100(?:\.0+)?|[1-9][0-9]?(?:\.[0-9]+)?|0\.[0-9]*[1-9][0-9]*'))
+
+    @property
+    def value(self):
+        return float(self._value)
+
 class Identifier:
     grammar = attr('value', re.compile(r'[a-zA-Z][a-zA-Z0-9_]*'))
 
@@ -96,6 +107,26 @@ class LogicalOperator:
     def type(self):
         return type(self._type)
 
+class SystemMethod(str):
+    grammar = 'SYSTEM'
+
+class BernoulliMethod(str):
+    grammar = 'BERNOULLI'
+
+class SampleMethod:
+    grammar = attr('_type', [SystemMethod, BernoulliMethod])
+
+    @property
+    def type(self):
+        return type(self._type)
+
+class Seed:
+    grammar = 'SEED', attr('_value', Integer)
+
+    @property
+    def value(self):
+        return self._value.value
+
 class ModelName:
     grammar = attr('_value', Identifier)
 
@@ -103,12 +134,27 @@ class ModelName:
     def value(self):
         return self._value.value
 
+class Depth:
+    grammar = '(', 'depth', '<=', attr('_value', Integer), ')'
+
+    @property
+    def value(self):
+        return self._value.value
+
+class PathElement:
+    grammar = attr('_name', Identifier), attr('depth', optional(Depth))
+
 class FieldName:
-    grammar = attr('_values', csl(Identifier, separator='.'))
+    grammar = attr('_values', csl(PathElement, separator='.'))
 
     @property
     def values(self):
-        return [v.value for v in self._values]
+        return [v._name.value for v in self._values]
+
+    @property
+    def depths(self):
+        """The depth bounds of recursive relations like `ancestors(depth<=10)`, `None` for the other elements."""
+        return [v.depth.value if v.depth is not None else None for v in self._values]
 
 class Aggregation:
     grammar = attr('_aggregator', Aggregator), attr('field', FieldName)
@@ -203,9 +249,28 @@ class OrderBy(List):
 class Where(List):
     grammar = ignore(WhereCommand), attr('expression', Expression)
 
+class Sample:
+    grammar = ignore(SampleCommand), attr('_percentage', Percentage), attr('_method', optional(SampleMethod)),\
+              attr('_seed', optional(Seed))
+
+    @property
+    def percentage(self):
+        return self._percentage.value
+
+    @property
+    def method(self):
+        """The sampling method, `SystemMethod` (sample pages) if none is given, or `BernoulliMethod` (sample
+        rows)."""
+        return self._method.type if self._method is not None else SystemMethod
+
+    @property
+    def seed(self):
+        return self._seed.value if self._seed is not None else None
+
 class Query:
     grammar = attr('model', Model),\
               attr('select', Select),\
               attr('group_by', optional(GroupBy)),\
               attr('order_by', optional(OrderBy)),\
-              attr('where', optional(Where))
+              attr('where', optional(Where)),\
+              attr('sample', optional(Sample))
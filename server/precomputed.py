@@ -0,0 +1,51 @@
+import gzip
+import hashlib
+
+from responder import status_codes
+
+
+class PrecomputedBody:
+    """A response body which does not change while the server runs, like `/meta`.
+
+    The body is encoded and gzip compressed once. Responses carry a strong ETag derived from the content, so
+    clients can revalidate their copy with `If-None-Match` and get a `304 Not Modified` without a body.
+
+    The GZip middleware of the API leaves responses with a `Content-Encoding` alone, so the compressed body is sent
+    as it is. Other responses are left to the middleware, which adds `Vary` to the ones it would compress.
+    """
+
+    def __init__(self, content, content_type='application/json', max_age=300):
+        self.content = content.encode('utf-8') if isinstance(content, str) else content
+        self.gzipped = gzip.compress(self.content, compresslevel=9, mtime=0)
+        self.content_type = content_type
+        self.cache_control = f'public, max-age={max_age}'
+        digest = hashlib.sha256(self.content).hexdigest()[:32]
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gzip"'
+
+    def not_modified(self, if_none_match):
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        tags = {tag.strip() for tag in if_none_match.split(',')}
+        # If-None-Match uses the weak comparison, so a W/ prefix still matches.
+        tags |= {tag[2:] for tag in tags if tag.startswith('W/')}
+        return self.etag in tags or self.gzip_etag in tags
+
+    def respond(self, req, resp):
+        use_gzip = 'gzip' in req.headers.get('Accept-Encoding', '')
+        resp.headers['ETag'] = self.gzip_etag if use_gzip else self.etag
+        resp.headers['Cache-Control'] = self.cache_control
+        if use_gzip:
+            resp.headers['Vary'] = 'Accept-Encoding'
+        if self.not_modified(req.headers.get('If-None-Match')):
+            resp.status_code = status_codes.HTTP_304
+            resp.content = b''
+            return
+        resp.headers['Content-Type'] = self.content_type
+        if use_gzip:
+            resp.headers['Content-Encoding'] = 'gzip'
+            resp.content = self.gzipped
+        else:
+            resp.content = self.content
@@ -0,0 +1,96 @@
+import peewee
+
+from server.query.builder import QueryCommand
+from server.query.result import generate_result_object, load_relation, prefetch_relations, relation_key
+
+
+class RowAssembler:
+    """Turns the rows of a built query into result objects without creating model instances.
+
+    The query is projected to the selected fields of the root model and of the n:1 relations joined to it, followed
+    by the page keys, and returns plain tuples. A function generated for the query tree builds the nested result
+    object of a row directly from its tuple. Only fields whose database values need a conversion, like dates, are
+    converted. Selected 1:n and n:m relations are prefetched with one query per node, just like by
+    `generate_result_objects`.
+    """
+
+    def __init__(self, query_tree, page_keys):
+        self.query_tree = query_tree
+        self.columns = []
+        self._column_indexes = {}
+        self._many = []
+        self._namespace = {'_many': _many}
+
+        expression = self._node_expression(query_tree.root)
+        self._page_start = len(self.columns)
+        self.columns.extend(page_keys)
+
+        source = f'def assemble(row, relations):\n    return {expression}\n'
+        exec(compile(source, '<row assembler>', 'exec'), self._namespace)
+        self.source = source
+        self._assemble = self._namespace['assemble']
+
+    def project(self, query):
+        """Returns `query` selecting only the columns of the assembler as tuples."""
+        return query.select(*self.columns).tuples()
+
+    def execute(self, query):
+        """Executes a projected query and returns a cursor over its unconverted rows."""
+        return query._database.execute(query)
+
+    def page_values(self, row):
+        return list(row[self._page_start:])
+
+    def assemble(self, rows):
+        rows = list(rows)
+        relations = {}
+        for child_node, key_index in self._many:
+            keys = list({row[key_index] for row in rows} - {None})
+            relation, child_rows = load_relation(child_node, keys)
+            relations[child_node] = relation
+            prefetch_relations(child_rows, child_node, relations)
+        assemble = self._assemble
+        return [assemble(row, relations) for row in rows]
+
+    def _column(self, model, field_name):
+        # Fields of aliased models are distinct columns, so the key contains the model (alias) itself.
+        key = (model, field_name)
+        if key not in self._column_indexes:
+            self._column_indexes[key] = len(self.columns)
+            self.columns.append(getattr(model, field_name))
+        return self._column_indexes[key]
+
+    def _node_expression(self, node):
+        items = []
+        for field_node in node.fields:
+            if QueryCommand.SELECT in field_node.commands:
+                value = f'row[{self._column(node.model, field_node.name)}]'
+                if not isinstance(field_node.field, _RAW_FIELDS):
+                    converter = f'_convert_{len(self._namespace)}'
+                    self._namespace[converter] = field_node.field.python_value
+                    value = f'{converter}({value})'
+                items.append(f'{field_node.name!r}: {value}')
+        for child_node in node.children:
+            if QueryCommand.SELECT not in child_node.commands:
+                continue
+            if not child_node.many:
+                # The related object is part of the row, its primary key is None if there is none.
+                key_index = self._column(child_node.model, child_node.model._meta.primary_key.name)
+                child_expression = self._node_expression(child_node)
+                items.append(f'{child_node.name!r}: {child_expression} if row[{key_index}] is not None else None')
+            else:
+                key_index = self._column(node.model, relation_key(child_node))
+                node_name = f'_node_{len(self._many)}'
+                self._namespace[node_name] = child_node
+                self._many.append((child_node, key_index))
+                items.append(f'{child_node.name!r}: _many({node_name}, row[{key_index}], relations)')
+        return '{' + ', '.join(items) + '}'
+
+
+# The database drivers already return the python values of these fields.
+_RAW_FIELDS = (peewee.IntegerField, peewee.CharField, peewee.TextField)
+
+
+def _many(node, key, relations):
+    return [generate_result_object(child_object, node, relations)
+            for child_object in relations[node].objects.get(key, ())]
@@ -1,68 +1,164 @@
+import operator
+import time
+from collections import OrderedDict
 from enum import Enum
+from functools import reduce
 
 import peewee
 
-from server import parser
-from server.model_register import ModelType
+from server import fast_parser, metrics, parser
+from server.cursor import order_keys
+from server.query import recursion
 from server.query.tree import QueryTree
+from server.statistics import sample
 
 
 class QueryBuilder:
-    def __init__(self, mr):
+    def __init__(self, mr, statistics=None):
         self.mr = mr
+        self.statistics = statistics
 
         self.used_models = None
         self.query_tree = None
         self.query = None
+        self.page_keys = None
+        self.estimated_rows = None
+        self.sample = None
 
     def __call__(self, cql_query):
         ### REMOVE used_models, query from self
 
         self.used_models = []
+        self._nodes = []
+        self._filter_nodes = []
 
-        parsed_query = parser.parse(cql_query, parser.Query)
+        with metrics.stage('parse'):
+            parsed_query = fast_parser.parse(cql_query)
+        start = time.perf_counter()
         model = self.mr[parsed_query.model.name]
         self.query_tree = QueryTree(model)
         self.used_models.append(model)
 
         self.query = model.select()
+        self.sample = parsed_query.sample
+        sample_condition = None
+        if self.sample is not None:
+            self.query, sample_condition = self._sample_root(model, self.sample)
 
-        selection_fields = [
-            (s.values, None) if isinstance(s, parser.FieldName) else (s.field.values, s.aggregator)
-            for s in parsed_query.select
-        ]
-
-        selections = []
-        for field_arr, aggregator in selection_fields:
-            selection = self._add_to_node(self.query_tree.root, field_arr, QueryCommand.SELECT)
-            if aggregator is None:
-                selections.append(selection)
-            elif aggregator is parser.SumAggregator:
-                selections.append(peewee.fn.Sum(selection).alias('sum_aggregation'))
-            elif aggregator is parser.AvgAggregator:
-                selections.append(peewee.fn.Avg(selection).alias('avg_aggregation'))
-            elif aggregator is parser.CountAggregator:
-                selections.append(peewee.fn.Count(selection).alias('count_aggregation'))
-            elif aggregator is parser.MinAggregator:
-                selections.append(peewee.fn.Min(selection).alias('min_aggregation'))
-            elif aggregator is parser.MaxAggregator:
-                selections.append(peewee.fn.Max(selection).alias('max_aggregation'))
-
-        group_by_fields = [field.values for field in parsed_query.group_by] if parsed_query.group_by is not None else []
-        order_by_fields = [field.values for field in parsed_query.order_by] if parsed_query.order_by is not None else []
-        group_by = [self._add_to_node(self.query_tree.root, field_arr, QueryCommand.GROUPBY) for field_arr in group_by_fields]
-        order_by = [self._add_to_node(self.query_tree.root, field_arr, QueryCommand.ORDERBY) for field_arr in order_by_fields]
-
-        where_expression = self._build_expression(parsed_query.where.expression) if parsed_query.where is not None else None
+        # Aggregations are not projected, their fields are selected like the other fields. Sums and counts over a
+        # sample are therefore not scaled here, clients scale them with the sample scale of the response.
+        selection_fields = [s if isinstance(s, parser.FieldName) else s.field for s in parsed_query.select]
+        for field_name in selection_fields:
+            self._add_to_node(self.query_tree.root, field_name.values, QueryCommand.SELECT, field_name.depths)
+
+        group_by_fields = parsed_query.group_by if parsed_query.group_by is not None else []
+        order_by_fields = parsed_query.order_by if parsed_query.order_by is not None else []
+        group_by = [self._add_to_node(self.query_tree.root, field.values, QueryCommand.GROUPBY, field.depths)
+                    for field in group_by_fields]
+        order_by = [self._add_to_node(self.query_tree.root, field.values, QueryCommand.ORDERBY, field.depths)
+                    for field in order_by_fields]
+
+        # The rows of the root model which match the conditions, or the groups. The fields of the other nodes are
+        # loaded with one query per node, so they do not change the number of rows.
+        if self.statistics is not None:
+            self.estimated_rows = self.statistics.estimate_rows(
+                model, parsed_query.where.expression if parsed_query.where is not None else None, group_by_fields)
+            if self.estimated_rows is not None and self.sample is not None:
+                self.estimated_rows *= self.sample.percentage / 100
+
+        branches = self._mark_semi_joins()
+        where_expression = self._build_where(parsed_query.where.expression if parsed_query.where is not None else None,
+                                             branches)
+        if sample_condition is not None:
+            where_expression = sample_condition if where_expression is None else where_expression & sample_condition
+        for node in self._nodes:
+            if not node.semi_join:
+                for source, target, on in node.joins:
+                    self.query = self.query.join_from(source, target, on=on)
+
+        # The primary key of the root model makes the order unique, so the keys can be used for keyset pagination.
+        # The `RowAssembler` selects their values after the selected fields and returns the rows as tuples.
+        self.page_keys = order_by + [model._meta.primary_key]
 
         self.query = self.query \
             .group_by(*group_by) \
-            .order_by(*order_by)\
-            .where(where_expression) \
-            .limit(50)
+            .order_by(*order_keys(self.page_keys))\
+            .where(where_expression)
 
+        metrics.add_time('build', time.perf_counter() - start)
         return self.query, self.query_tree
 
+    def _sample_root(self, model, parsed_sample):
+        """Returns the query of the root model which reads only a sample of its table, and the condition which
+        samples the rows on databases without `TABLESAMPLE`, which also ignore the seed."""
+        if isinstance(model._meta.database, peewee.PostgresqlDatabase):
+            table = sample(model, parsed_sample.percentage, SAMPLE_METHODS[parsed_sample.method], parsed_sample.seed)
+            return model.select().from_(table), None
+        # peewee overloads % with LIKE, so the modulo is an explicit expression.
+        random_part = peewee.fn.ABS(peewee.Expression(peewee.fn.RANDOM(), '%', 1000000))
+        return model.select(), random_part < parsed_sample.percentage * 10000
+
+    def _mark_semi_joins(self):
+        """Marks the 1:n and n:m nodes which are not used to group or order, and all nodes below them, as semi
+        joins and returns their branches as semi joins without conditions."""
+        # Joining them would repeat the row of the root model for every related row, and for the product of the
+        # related rows of sibling branches. Their selected fields are loaded separately with one query per node.
+        branches = OrderedDict()
+        branch_roots = {}
+        for node in self._nodes:
+            if node.parent.semi_join:
+                node.semi_join = True
+                branch_roots[node] = branch_roots[node.parent]
+                branches[branch_roots[node]].append(node)
+            elif node.many and not {QueryCommand.GROUPBY, QueryCommand.ORDERBY} & set(node.commands):
+                node.semi_join = True
+                branch_roots[node] = node
+                branches[node] = [node]
+        return [({root}, nodes, []) for root, nodes in branches.items()]
+
+    def _build_where(self, expression, semi_joins):
+        # Semi joined nodes are checked with EXISTS subqueries, which only keep the rows of the root model with a
+        # related row, like the inner joins did. Conjuncts on the same relations share a subquery, so that all of
+        # them have to hold for the same related row, just like with a join.
+        conditions = []
+        for conjunct in _conjuncts(expression) if expression is not None else ():
+            self._filter_nodes = []
+            condition = self._build_expression(conjunct)
+            if not self._filter_nodes:
+                conditions.append(condition)
+                continue
+            roots = {node for node in self._filter_nodes if not node.parent.semi_join}
+            semi_join = (roots, self._filter_nodes, [condition])
+            for other in [other for other in semi_joins if other[0] & roots]:
+                semi_joins.remove(other)
+                semi_join = (other[0] | semi_join[0], other[1] + semi_join[1], other[2] + semi_join[2])
+            semi_joins.append(semi_join)
+        conditions.extend(self._exists(nodes, node_conditions) for _, nodes, node_conditions in semi_joins)
+        if not conditions:
+            return None
+        # Combined from the right, like the parser nests the operators.
+        return reduce(lambda second, first: first & second, reversed(conditions))
+
+    def _exists(self, nodes, conditions):
+        subquery = None
+        from_model = None
+        correlations = []
+        for node in list(OrderedDict.fromkeys(nodes)):
+            joins = node.joins
+            if not node.parent.semi_join:
+                # The first join of a root connects the subquery to the outer query.
+                _, target, on = joins[0]
+                if subquery is None:
+                    subquery = target.select(peewee.SQL('1'))
+                    from_model = target
+                else:
+                    subquery = subquery.join_from(from_model, target, peewee.JOIN.CROSS)
+                correlations.append(on)
+                joins = joins[1:]
+            for source, target, on in joins:
+                subquery = subquery.join_from(source, target, on=on)
+        return peewee.fn.EXISTS(subquery.where(reduce(operator.and_, correlations + conditions)))
+
     def _build_expression(self, expression):
         if expression.is_logical_expression:
             assert expression.logical_operator in [parser.AndOperator, parser.OrOperator, parser.XorOperator]
@@ -79,14 +175,16 @@ class QueryBuilder:
             assert expression.comparator in [parser.EqComparator, parser.GeqComparator, parser.LeqComparator, parser.GreaterComparator, parser.LessComparator, parser.NeqComparator]
 
             if isinstance(expression.first, parser.FieldName):
-                first = self._add_to_node(self.query_tree.root, expression.first.values, QueryCommand.WHERE)
+                first = self._add_to_node(self.query_tree.root, expression.first.values, QueryCommand.WHERE,
+                                          expression.first.depths)
                 first_is_field = True
             else:
                 first = expression.first.value
                 first_is_field = False
 
             if isinstance(expression.second, parser.FieldName):
-                second = self._add_to_node(self.query_tree.root, expression.second.values, QueryCommand.WHERE)
+                second = self._add_to_node(self.query_tree.root, expression.second.values, QueryCommand.WHERE,
+                                           expression.second.depths)
             else:
                 second = expression.second.value
 
@@ -103,82 +201,108 @@ class QueryBuilder:
             elif expression.comparator is parser.NeqComparator:
                 return first != second if first_is_field else second != first
 
-    def _add_to_node(self, node, field_arr, query_command):
+    def _add_to_node(self, node, field_arr, query_command, depths=None):
         field_head, *field_arr = field_arr
+        depth, *depths = depths if depths else [None] * (len(field_arr) + 1)
 
-        model_fields = node.model._meta.fields
-        model_backrefs = {backref.backref: backref for backref in node.model._meta.backrefs.keys()}
-        if field_head in model_fields and not isinstance(model_fields[field_head], peewee.ForeignKeyField):
+        model_fields = self.mr.fields(node.model)
+        relation = self.mr.relation(node.model, field_head)
+        if relation is None:
+            # Transitive relations like `ancestors` follow a self-referencing relation up to a default depth.
+            relation = self.mr.recursive_relation(node.model, field_head)
+            if relation is not None and depth is None:
+                depth = recursion.DEFAULT_DEPTH
+        if field_head in model_fields:
             # field_head is of type field
             assert len(field_arr) == 0, f'Field {field_head} of model {node.model._name} has no children.'
+            assert depth is None, f'Field {field_head} of model {node.model._name} is not a relation.'
             field_node = node.get_field(field_head)
             if not field_node:
                 field_node = node.add_field(field_head, getattr(node.model, field_head))
             if query_command not in field_node.commands:
                 field_node.commands.append(query_command)
             return field_node.field
-        elif field_head in model_fields and isinstance(model_fields[field_head], peewee.ForeignKeyField):
-            # field_head is of type relation n:1
-            child_node = node.get_child(field_head)
-            if not child_node:
-                field = model_fields[field_head]
-                join_model = field.rel_model
-                if join_model not in self.used_models:
-                    self.used_models.append(join_model)
-                else:
-                    join_model = join_model.alias()
-                self.query = self.query.join_from(node.model, join_model, on=(field == getattr(join_model, join_model._meta.primary_key.name)))
-                child_node = node.add_child(field_head, join_model)
-            if query_command not in child_node.commands:
-                child_node.commands.append(query_command)
-            if len(field_arr) == 0:
-                return child_node.model
-            return self._add_to_node(child_node, field_arr, query_command)
-        elif field_head in model_backrefs and model_backrefs[field_head].model._type is ModelType.MODEL:
-            # field_head is of type relation 1:n
-            child_node = node.get_child(field_head)
-            if not child_node:
-                join_model = model_backrefs[field_head].model
-                if join_model not in self.used_models:
-                    self.used_models.append(join_model)
-                else:
-                    join_model = join_model.alias()
-                join_field = getattr(join_model, model_backrefs[field_head].name)
-                self.query = self.query.join_from(node.model, join_model, on=(join_field))
-                child_node = node.add_child(field_head, join_model)
-            if query_command not in child_node.commands:
-                child_node.commands.append(query_command)
-            if len(field_arr) == 0:
-                return child_node.model
-            return self._add_to_node(child_node, field_arr, query_command)
-        elif field_head in model_backrefs and model_backrefs[field_head].model._type is ModelType.NM_RELATION:
-            # field_head is of type relation n:m
-            child_node = node.get_child(field_head)
-            if not child_node:
-                join_field_1 = model_backrefs[field_head]
-                join_relation = model_backrefs[field_head].model
-                join_field_2 = join_relation._other_field(join_field_1)
-                join_model = join_field_2.rel_model
-                if join_relation not in self.used_models:
-                    self.used_models.append(join_relation)
-                else:
-                    join_relation = join_relation.alias()
-                    join_field_1 = getattr(join_relation, join_field_1.name)
-                    join_field_2 = getattr(join_relation, join_field_2.name)
-                if join_model not in self.used_models:
-                    self.used_models.append(join_model)
-                else:
-                    join_model = join_model.alias()
-                self.query = self.query.join_from(node.model, join_relation, on=(join_field_1))
-                self.query = self.query.join_from(join_relation, join_model, on=(join_field_2 == getattr(join_model, join_model._meta.primary_key.name)))
-                child_node = node.add_child(field_head, join_model, shadow_name=join_field_2.name)
-            if query_command not in child_node.commands:
-                child_node.commands.append(query_command)
-            if len(field_arr) == 0:
-                return child_node.model
-            return self._add_to_node(child_node, field_arr, query_command)
-        else:
+        elif relation is None:
             raise AssertionError(f'Field {field_head} of model {node.model._name} does not exist.')
+        if depth is not None:
+            assert recursion.is_recursive(relation), \
+                f'Relation {field_head} of model {node.model._name} is not recursive.'
+            assert 1 <= depth <= recursion.MAX_DEPTH, \
+                f'The depth of {field_head} has to be between 1 and {recursion.MAX_DEPTH}.'
+
+        child_node = node.get_child(field_head)
+        if child_node:
+            assert child_node.depth == depth, f'Relation {field_head} is used with different depths.'
+        else:
+            # Nodes of WHERE conditions are added after the semi joins were marked.
+            semi_join = query_command is QueryCommand.WHERE and (node.semi_join or depth is not None or
+                                                                 relation.kind != 'n:1')
+            child_node = self._add_child(node, relation, semi_join, depth)
+        if child_node.semi_join:
+            self._filter_nodes.append(child_node)
+        if query_command not in child_node.commands:
+            child_node.commands.append(query_command)
+        if len(field_arr) == 0:
+            return child_node.model
+        return self._add_to_node(child_node, field_arr, query_command, depths)
+
+    def _add_child(self, node, relation, semi_join=False, depth=None):
+        # The joins are added to the query when the tree is complete, or to EXISTS subqueries for semi joins.
+        join_model, joins = self._relation_joins(node, relation, depth)
+        child_node = node.add_child(relation.name, join_model, shadow_name=relation.shadow_name, relation=relation,
+                                    depth=depth)
+        child_node.joins = joins
+        child_node.semi_join = semi_join
+        self._nodes.append(child_node)
+        return child_node
+
+    def _relation_joins(self, node, relation, depth=None):
+        """Returns the model joined for `relation` and the joins from `node` to it as (source, target, on)."""
+        if depth is not None:
+            # The models reachable within `depth` steps are the rows of a recursive CTE, which starts at the
+            # primary key of the (outer) row of `node`.
+            edge_model, _, _ = recursion.edges(relation)
+            if edge_model not in self.used_models:
+                self.used_models.append(edge_model)
+            join_model = self._use_model(relation.target)
+            reachable = recursion.reachable(
+                relation, depth, lambda start: start == recursion.OuterField(_primary_key(node.model)),
+                name=f'{relation.name}_closure')
+            return join_model, [(node.model, join_model, _primary_key(join_model).in_(reachable))]
+        if relation.kind == 'n:1':
+            join_model = self._use_model(relation.target)
+            return join_model, [(node.model, join_model, getattr(node.model, relation.field.name) == _primary_key(join_model))]
+        elif relation.kind == '1:n':
+            join_model = self._use_model(relation.target)
+            join_field = getattr(join_model, relation.field.name)
+            return join_model, [(node.model, join_model, join_field == _primary_key(node.model))]
+        join_relation = self._use_model(relation.join_model)
+        join_field_1 = getattr(join_relation, relation.field.name)
+        join_field_2 = getattr(join_relation, relation.join_field.name)
+        join_model = self._use_model(relation.target)
+        return join_model, [(node.model, join_relation, join_field_1 == _primary_key(node.model)),
+                            (join_relation, join_model, join_field_2 == _primary_key(join_model))]
+
+    def _use_model(self, model):
+        # Every model is joined under its own name once, further joins of the same model need an alias.
+        if model not in self.used_models:
+            self.used_models.append(model)
+            return model
+        return model.alias()
+
+
+SAMPLE_METHODS = {method: name for name, method in fast_parser.SAMPLE_METHODS.items()}
+
+
+def _primary_key(model):
+    return getattr(model, model._meta.primary_key.name)
+
+
+def _conjuncts(expression):
+    while expression.is_logical_expression and expression.logical_operator is parser.AndOperator:
+        yield expression.first
+        expression = expression.second
+    yield expression
 
 
 class QueryCommand(Enum):
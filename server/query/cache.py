@@ -0,0 +1,232 @@
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from server.query.assembler import RowAssembler
+from server.query.builder import QueryBuilder, QueryCommand
+
+
+CompiledQuery = namedtuple('CompiledQuery', ['query', 'query_tree', 'used_models', 'page_keys', 'tables', 'assembler',
+                                             'estimated_rows', 'sample'])
+
+_string_regex = re.compile(r'(["\'])(?:(?=(\\?))\2.)*?\1')
+_whitespace_regex = re.compile(r'\s+')
+
+
+def normalize_cql(cql_query):
+    # Keywords, identifiers and string literals are case sensitive in CQL, so only whitespace outside of string
+    # literals is normalized. Runs of whitespace become a single space but are not removed: whether there is
+    # whitespace between two characters can decide whether a query is valid, e.g. in `MODEL : commit`.
+    parts = []
+    position = 0
+    for match in _string_regex.finditer(cql_query):
+        parts.append(_normalize_whitespace(cql_query[position:match.start()]))
+        parts.append(match.group(0))
+        position = match.end()
+    parts.append(_normalize_whitespace(cql_query[position:]))
+    return ''.join(parts).strip()
+
+
+def _normalize_whitespace(text):
+    return _whitespace_regex.sub(' ', text)
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        assert maxsize > 0, 'maxsize must be positive.'
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def stats(self):
+        return {
+            'size': len(self._items),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class CompiledQueryCache:
+    """Caches parsed and built queries keyed by the normalized CQL text. The queries are projected to tuple rows
+    for their `RowAssembler`.
+
+    The cached peewee query is only used as a template, every lookup returns a fresh clone which can be executed
+    independently. The query tree is shared and must not be modified. With `statistics`, a compiled query carries the
+    number of rows estimated when it was compiled.
+    """
+
+    def __init__(self, mr, maxsize=256, statistics=None):
+        self.mr = mr
+        self.statistics = statistics
+        self._cache = LRUCache(maxsize)
+
+    def __call__(self, cql_query):
+        key = normalize_cql(cql_query)
+        compiled = self._cache.get(key)
+        if compiled is None:
+            compiled = self._compile(cql_query)
+            self._cache.put(key, compiled)
+        return compiled._replace(query=compiled.query.clone())
+
+    def _compile(self, cql_query):
+        query_builder = QueryBuilder(self.mr, self.statistics)
+        query, query_tree = query_builder(cql_query)
+        used_models = tuple(query_builder.used_models)
+        tables = frozenset(model._meta.table_name for model in used_models)
+        assembler = RowAssembler(query_tree, query_builder.page_keys)
+        return CompiledQuery(assembler.project(query), query_tree, used_models, tuple(query_builder.page_keys), tables,
+                             assembler, query_builder.estimated_rows, query_builder.sample)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+def _selected_paths(query_tree):
+    paths = []
+    for node in query_tree.node_iter():
+        if node is query_tree.root or QueryCommand.SELECT not in node.commands:
+            continue
+        path = []
+        while node is not query_tree.root:
+            path.append(node.name if getattr(node, 'depth', None) is None else f'{node.name}(depth<={node.depth})')
+            node = node.parent
+        paths.append('.'.join(reversed(path)))
+    return tuple(paths)
+
+
+_ResultEntry = namedtuple('_ResultEntry', ['value', 'size', 'tables', 'versions', 'expires'])
+
+
+class ResultCache:
+    """Caches query results up to a total size of `max_bytes`, least recently used entries are evicted first.
+
+    Every entry is tagged with the tables it was read from. `invalidate` bumps the version of tables after they
+    were changed, which drops all entries read from them. Entries also expire `ttl` seconds after they were stored.
+    """
+
+    def __init__(self, max_bytes, ttl=300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._versions = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(query, query_tree):
+        """The key of a query is its SQL with parameters and the selected fields, which do not all appear in the
+        SQL."""
+        sql, params = query.sql()
+        return sql, tuple(params), _selected_paths(query_tree)
+
+    def versions(self, tables):
+        """Returns the current versions of `tables`, which have to be passed to `put`. Fetch them before the query
+        is executed, so a result read before an invalidation is not stored afterwards."""
+        with self._lock:
+            return tuple(self._versions.get(table, 0) for table in sorted(tables))
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def put(self, key, value, size, tables, versions):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if versions != tuple(self._versions.get(table, 0) for table in sorted(tables)):
+                return
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = _ResultEntry(value, size, frozenset(tables), versions, time.monotonic() + self.ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def invalidate(self, tables=None):
+        """Drops the entries read from any of `tables` and bumps their versions. Drops all entries if `tables` is
+        `None`. Returns the number of dropped entries."""
+        with self._lock:
+            if tables is None:
+                tables = set(self._versions) | {table for entry in self._items.values() for table in entry.tables}
+            tables = set(tables)
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+            keys = [key for key, entry in self._items.items() if entry.tables & tables]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def _remove(self, key):
+        self._bytes -= self._items.pop(key).size
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / requests if requests else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'versions': dict(self._versions),
+            }
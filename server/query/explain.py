@@ -0,0 +1,51 @@
+import json
+
+from peewee import PostgresqlDatabase
+
+from server.query.builder import SAMPLE_METHODS
+
+
+def explain(query):
+    """Returns the plan of `query` as returned by Postgres `EXPLAIN (FORMAT JSON)`, or `None` for other databases,
+    which do not estimate costs."""
+    database = query._database
+    if not isinstance(database, PostgresqlDatabase):
+        return None
+    sql, params = query.sql()
+    cursor = database.execute_sql('EXPLAIN (FORMAT JSON) ' + sql, params)
+    plan = cursor.fetchone()[0]
+    # psycopg2 parses json columns, other drivers return the text.
+    return json.loads(plan) if isinstance(plan, str) else plan
+
+
+def plan_estimate(plan):
+    """Returns the total cost and the number of rows Postgres estimates for the top node of `plan`."""
+    if not plan:
+        return None, None
+    top = plan[0]['Plan']
+    return top['Total Cost'], top['Plan Rows']
+
+
+def describe_sample(sample):
+    """Returns the `SAMPLE:` clause of a query as a dict, or `None`."""
+    if sample is None:
+        return None
+    return {'percentage': sample.percentage, 'method': SAMPLE_METHODS[sample.method], 'seed': sample.seed,
+            'scale': 100 / sample.percentage}
+
+
+def describe_tree(node):
+    """Returns the joins of a query tree as nested dicts."""
+    return {
+        'name': node.name,
+        'model': node.model._name,
+        'relation': node.relation.kind if node.relation is not None else None,
+        'exists': node.semi_join,
+        'depth': node.depth,
+        'commands': [command.name for command in node.commands],
+        'fields': [
+            {'name': field_node.name, 'commands': [command.name for command in field_node.commands]}
+            for field_node in node.fields
+        ],
+        'children': [describe_tree(child_node) for child_node in node.children],
+    }
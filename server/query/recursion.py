@@ -0,0 +1,125 @@
+"""Transitive closures of self-referencing relations, like all ancestors of a commit or all forks of a project, as
+recursive CTEs."""
+import peewee
+
+
+DEFAULT_DEPTH = 100
+MAX_DEPTH = 1000
+
+
+def is_recursive(relation):
+    return relation.target is relation.model
+
+
+def edges(relation):
+    """Returns the model whose rows are the edges of `relation`, and the fields with the start and the end of an
+    edge."""
+    if relation.kind == 'n:m':
+        return relation.join_model, relation.field, relation.join_field
+    elif relation.kind == '1:n':
+        return relation.target, relation.field, relation.target._meta.primary_key
+    return relation.model, relation.model._meta.primary_key, relation.field
+
+
+def closure(relation, depth, start_condition, name='closure'):
+    """Returns a CTE `name(start, id, depth)` with the primary keys of all models which can be reached from a start
+    within `depth` steps of `relation`, each with the smallest number of steps. `start_condition` is called with the
+    start field of the edges and returns the condition which selects the first edges, e.g.
+    `lambda start: start.in_(keys)`.
+
+    A recursive CTE which selects a row per reached model would find a model once for every path length, and a
+    cycle once for every step up to `depth`. Instead the models reached from a start are visited breadth first: the
+    recursive CTE `<name>_levels` has one row per start and step, whose JSON object `visited` maps every model
+    reached so far to its number of steps. A step only follows the edges of the models reached by the previous step
+    and only adds models which were not reached yet, so every model is found once per start and cycles end as soon
+    as they are closed.
+    """
+    postgres = isinstance(relation.model._meta.database, peewee.PostgresqlDatabase)
+    group_object, each = ('jsonb_object_agg', 'jsonb_each_text') if postgres else ('json_group_object', 'json_each')
+    edge_model, start_field, end_field = edges(relation)
+
+    first = edge_model.alias()
+    first_start = getattr(first, start_field.name)
+    first_end = getattr(first, end_field.name)
+    first_edges = first \
+        .select(first_start.alias('start'), first_end.alias('id')) \
+        .where(start_condition(first_start) & first_end.is_null(False)) \
+        .distinct() \
+        .alias('first_edges')
+    seed = peewee.Select([first_edges], [
+        first_edges.c.start, getattr(peewee.fn, group_object)(first_edges.c.id.cast('TEXT'), 1), peewee.Value(1)
+    ]).group_by(first_edges.c.start)
+    levels = seed.cte(f'{name}_levels', recursive=True, columns=('start', 'visited', 'depth'))
+
+    def visited(cte, alias):
+        """Returns the entries of `cte.visited` as a table `alias`, and their model keys and number of steps."""
+        entries = getattr(peewee.fn, each)(cte.c.visited).alias(alias)
+        return entries, peewee.Entity(alias, 'key').cast('BIGINT'), peewee.Entity(alias, 'value').cast('INTEGER')
+
+    entries, key, steps = visited(levels, 'frontier')
+    frontier = peewee.Select([entries], [key]).where(steps == levels.c.depth)
+    entries, key, steps = visited(levels, 'known')
+    step = edge_model.alias()
+    step_end = getattr(step, end_field.name)
+    reached = step \
+        .select(step_end.alias('id'), (levels.c.depth + 1).alias('depth')) \
+        .where(getattr(step, start_field.name).in_(frontier) & step_end.is_null(False) &
+               step_end.not_in(peewee.Select([entries], [key]))) \
+        .distinct()
+    all_reached = (peewee.Select([entries], [key.alias('id'), steps.alias('depth')]) + reached).alias('reached')
+    recursive = peewee.Select([levels], [
+        levels.c.start,
+        peewee.Select([all_reached], [
+            getattr(peewee.fn, group_object)(all_reached.c.id.cast('TEXT'), all_reached.c.depth)
+        ]),
+        levels.c.depth + 1,
+    ]).where((levels.c.depth < depth) & peewee.fn.EXISTS(frontier))
+    levels = levels.union_all(recursive)
+
+    # Every model with the row of the step which reached it. The definition of a CTE can not have its own WITH
+    # clause in peewee, a subquery can.
+    entries, key, steps = visited(levels, 'reached')
+    found = peewee.Select([levels, entries], [levels.c.start.alias('start'), key.alias('id'), steps.alias('depth')]) \
+        .where(steps == levels.c.depth) \
+        .with_cte(levels) \
+        .alias(f'{name}_found')
+    return peewee.Select([found], [found.c.start, found.c.id, found.c.depth]) \
+        .cte(name, columns=('start', 'id', 'depth'))
+
+
+class OuterField(peewee.ColumnBase):
+    """A field of a model of an enclosing query, for correlated CTEs.
+
+    Peewee renders a CTE with its own table aliases, so a field used directly would get a new alias instead of
+    the one of the enclosing query.
+    """
+
+    def __init__(self, field):
+        super().__init__()
+        self.field = field
+
+    def __sql__(self, ctx):
+        # Fields of models are rendered with the alias of the model's table.
+        source = self.field.source if isinstance(self.field, peewee.FieldAlias) else self.field.model._meta.table
+        alias = ctx.alias_manager.get(source, any_depth=True)
+        return ctx.sql(peewee.Entity(alias, self.field.column_name))
+
+
+def reachable(relation, depth, start_condition, name='closure'):
+    """Returns a subquery with the primary keys of all models reachable within `depth` steps."""
+    cte = closure(relation, depth, start_condition, name)
+    return cte.select_from(cte.c.id)
+
+
+def load_closure(relation, depth, keys):
+    """Returns a query for the models reachable from the primary keys `keys` within `depth` steps. The key of the
+    start is selected as `_prefetch_key`, the nearest models come first."""
+    target = relation.target
+    primary_key = target._meta.primary_key
+    cte = closure(relation, depth, lambda start: start.in_(keys))
+    return target \
+        .select(target, cte.c.start.alias('_prefetch_key')) \
+        .join(cte, on=(primary_key == cte.c.id)) \
+        .order_by(cte.c.depth, primary_key) \
+        .with_cte(cte) \
+        .objects()
@@ -1,22 +1,123 @@
-import peewee
+from collections import defaultdict, namedtuple
+from itertools import islice
 
+from server.query import recursion
 from server.query.builder import QueryCommand
 
 
-def generate_result_object(query_object, query_tree_node):
+PrefetchedRelation = namedtuple('PrefetchedRelation', ['key', 'objects', 'many'])
+
+
+def generate_result_objects(query, query_tree):
+    rows = list(query)
+    relations = prefetch_relations(rows, query_tree.root)
+    return [generate_result_object(row, query_tree.root, relations) for row in rows]
+
+
+def iter_result_chunks(rows, generate, chunk_size=500):
+    """Generates lists of at most `chunk_size` result objects, which `generate` creates from a list of rows. The
+    relations are prefetched per chunk, so only one chunk of rows is kept in memory."""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield generate(chunk)
+
+
+def generate_result_object(query_object, query_tree_node, relations):
     result = {}
     for field_node in query_tree_node.fields:
         if QueryCommand.SELECT in field_node.commands:
             result[field_node.name] = getattr(query_object, field_node.name)
     for child_node in query_tree_node.children:
         if QueryCommand.SELECT in child_node.commands:
-            child_object = getattr(query_object, child_node.name)
-            if isinstance(child_object, peewee.Model):
-                result[child_node.name] = generate_result_object(child_object, child_node)
-            elif isinstance(child_object, peewee.SelectQuery) and child_node.shadow_name is None:
-                result[child_node.name] = [generate_result_object(child_query, child_node) for child_query in child_object]
-            elif isinstance(child_object, peewee.SelectQuery) and child_node.shadow_name is not None:
+            relation = relations[child_node]
+            key = query_object.__data__.get(relation.key)
+            if relation.many:
                 result[child_node.name] = [
-                    generate_result_object(getattr(child_query, child_node.shadow_name), child_node) for
-                    child_query in child_object]
+                    generate_result_object(child_object, child_node, relations)
+                    for child_object in relation.objects.get(key, ())]
+            else:
+                child_object = relation.objects.get(key)
+                result[child_node.name] = generate_result_object(child_object, child_node, relations) \
+                    if child_object is not None else None
     return result
+
+
+def prefetch_relations(rows, query_tree_node, relations=None):
+    """Loads the selected relations of all rows with one query per node of the query tree.
+
+    Returns a dict which maps each selected child node to a `PrefetchedRelation`, or adds them to `relations`. The
+    related objects of a row are looked up with the value of the field `key` of the row.
+    """
+    relations = {} if relations is None else relations
+    pending = [(query_tree_node, rows)]
+    while pending:
+        node, node_rows = pending.pop()
+        for child_node in node.children:
+            if QueryCommand.SELECT not in child_node.commands:
+                continue
+            relation, child_rows = load_relation(child_node, _keys(node_rows, relation_key(child_node)))
+            relations[child_node] = relation
+            pending.append((child_node, child_rows))
+    return relations
+
+
+def relation_key(child_node):
+    """Returns the name of the field of the parent model whose values identify the related objects."""
+    relation = child_node.relation
+    if child_node.depth is not None:
+        return relation.model._meta.primary_key.name
+    return relation.field.name if relation.kind == 'n:1' else relation.field.rel_field.name
+
+
+def load_relation(child_node, keys):
+    """Loads the objects of the relation of `child_node` which belong to the parent keys `keys`."""
+    relation = child_node.relation
+    if child_node.depth is not None:
+        objects = defaultdict(list)
+        child_rows = []
+        if keys:
+            for child_object in recursion.load_closure(relation, child_node.depth, keys):
+                objects[child_object._prefetch_key].append(child_object)
+                child_rows.append(child_object)
+        return PrefetchedRelation(relation.model._meta.primary_key.name, objects, True), child_rows
+
+    if relation.kind == 'n:1':
+        field = relation.field
+        rel_field = field.rel_field
+        objects = {}
+        if keys:
+            query = field.rel_model.select().where(rel_field.in_(keys))
+            objects = {child_object.__data__[rel_field.name]: child_object for child_object in query}
+        return PrefetchedRelation(field.name, objects, False), list(objects.values())
+
+    backref = relation.field
+    objects = defaultdict(list)
+    child_rows = []
+    if keys and relation.kind == '1:n':
+        query = backref.model.select().where(backref.in_(keys))
+        for child_object in query:
+            objects[child_object.__data__[backref.name]].append(child_object)
+            child_rows.append(child_object)
+    elif keys:
+        # n:m, joined through the relation model
+        other_field = relation.join_field
+        join_model = relation.target
+        query = join_model \
+            .select(join_model, backref.alias('_prefetch_key')) \
+            .join(backref.model, on=(other_field == other_field.rel_field)) \
+            .where(backref.in_(keys)) \
+            .objects()
+        for child_object in query:
+            objects[child_object._prefetch_key].append(child_object)
+            child_rows.append(child_object)
+    return PrefetchedRelation(backref.rel_field.name, objects, True), child_rows
+
+
+def _keys(rows, field_name):
+    keys = {row.__data__.get(field_name) for row in rows}
+    keys.discard(None)
+    return list(keys)
+
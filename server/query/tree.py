@@ -1,8 +1,15 @@
 class QueryTreeNode:
-    def __init__(self, name, model, shadow_name=None, parent=None):
+    def __init__(self, name, model, shadow_name=None, parent=None, relation=None, depth=None):
         self.name = name
         self.model = model
         self.shadow_name = shadow_name
+        self.relation = relation
+        # The depth bound of a node which follows its recursive relation transitively, e.g. `ancestors(depth<=10)`.
+        self.depth = depth
+        # The joins (source, target, on) from the parent. Semi joined nodes are not joined to the query, but
+        # checked with EXISTS subqueries.
+        self.joins = []
+        self.semi_join = False
         assert parent is None or isinstance(parent, QueryTreeNode)
         self.parent = parent
         if parent is not None:
@@ -11,8 +18,8 @@ class QueryTreeNode:
         self.fields = []
         self.commands = []
 
-    def add_child(self, name, model, shadow_name=None):
-        return QueryTreeNode(name, model, shadow_name=shadow_name, parent=self)
+    def add_child(self, name, model, shadow_name=None, relation=None, depth=None):
+        return QueryTreeNode(name, model, shadow_name=shadow_name, parent=self, relation=relation, depth=depth)
 
     def add_field(self, name, field):
         return QueryTreeFieldNode(name, field, self)
@@ -33,6 +40,11 @@ class QueryTreeNode:
     def is_root(self):
         return self.parent is None
 
+    @property
+    def many(self):
+        """True if the node contains a list of related objects for each object of the parent node."""
+        return self.depth is not None or self.relation.kind != 'n:1'
+
     def __iter__(self):
         yield self
         for field in self.fields:
@@ -0,0 +1,394 @@
+"""Statistics of the fields of the models, like the ones the Postgres planner keeps: the fraction of null values, an
+estimate of the number of distinct values, the smallest and largest value, the most common values with their
+frequencies and an equi-depth histogram of the other values.
+
+On Postgres the statistics are read from `pg_stats`, which is cheap, and read again once a table was analyzed again.
+Tables without statistics, and all tables of other databases, are sampled: at most `sample_rows` rows are read with
+`TABLESAMPLE SYSTEM` (or a random order) and the statistics are computed from them. The statistics are kept in a
+snapshot file, so a restarted server has them right away.
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter, namedtuple
+from functools import reduce
+
+from peewee import SQL, EnclosedNodeList, NodeList, PostgresqlDatabase, Value, fn
+
+from server import parser
+
+
+# Frequencies are fractions of all rows of the table, including the rows with a null value. Values are stored as
+# they appear in JSON, e.g. timestamps as strings.
+FieldStatistics = namedtuple('FieldStatistics', ['null_fraction', 'distinct', 'min', 'max', 'most_common',
+                                                 'histogram'])
+
+# `source` is `pg_stats` or `sample`, `analyzed_at` the time Postgres last analyzed the table, if known.
+TableStatistics = namedtuple('TableStatistics', ['rows', 'fields', 'source', 'analyzed_at', 'updated_at'])
+
+# The selectivities of conditions without statistics, the defaults of the Postgres planner.
+DEFAULT_EQ_SELECTIVITY = 0.005
+DEFAULT_RANGE_SELECTIVITY = 1 / 3
+
+_NUMERIC_TYPES = {'AUTO': int, 'BIGAUTO': int, 'INT': int, 'BIGINT': int, 'SMALLINT': int, 'FLOAT': float,
+                  'DOUBLE': float, 'DECIMAL': float}
+
+# Fields with at most this many distinct values are shown as bar charts.
+_CHART_DISTINCT_LIMIT = 20
+
+
+def sample(model, percent, method='SYSTEM', seed=None):
+    """Returns the table of `model` to select from, on Postgres only `percent` percent of it (`TABLESAMPLE`): of its
+    pages with the method `SYSTEM`, of its rows with `BERNOULLI`. With a `seed` the same sample is read again as
+    long as the table does not change. Other databases and a `percent` of `None` read the whole table."""
+    if percent is None or not isinstance(model._meta.database, PostgresqlDatabase):
+        return model
+    nodes = [model._meta.table, SQL(f'TABLESAMPLE {method}'), EnclosedNodeList([Value(percent)])]
+    if seed is not None:
+        nodes.extend([SQL('REPEATABLE'), EnclosedNodeList([Value(seed)])])
+    return NodeList(nodes)
+
+
+class Statistics:
+    """The statistics of the fields of the models of `mr`, see `refresh`. With `snapshot_path` they are stored in
+    that file after every refresh and loaded from it on start."""
+
+    def __init__(self, mr, snapshot_path=None, sample_rows=30000, histogram_buckets=10, most_common=10):
+        self.mr = mr
+        self.snapshot_path = snapshot_path
+        self.sample_rows = sample_rows
+        self.histogram_buckets = histogram_buckets
+        self.most_common = most_common
+        self.tables = {}
+        # Incremented whenever the statistics change, e.g. to serialize `/meta` again.
+        self.version = 0
+        self.refreshes = 0
+        self.refresh_error = None
+        self._stale = set()
+        self._lock = threading.Lock()
+        self._refresher = None
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            self._load_snapshot()
+
+    def table(self, model_name):
+        return self.tables.get(model_name)
+
+    def field(self, model_name, field_name):
+        table = self.tables.get(model_name)
+        return table.fields.get(field_name) if table is not None else None
+
+    def invalidate(self, tables=None):
+        """Marks the statistics of the models read from `tables` as stale, all if `tables` is `None`. Returns the
+        names of the models."""
+        with self._lock:
+            names = [name for name, model in self.mr.items() if tables is None or model._meta.table_name in tables]
+            self._stale.update(names)
+            return names
+
+    def refresh(self, max_age=None):
+        """Computes the statistics of the models which have none, are stale, were analyzed by Postgres since they
+        were read, or were sampled more than `max_age` seconds ago. Returns the names of the refreshed models."""
+        refreshed = []
+        for model_name, model in self.mr.items():
+            current = self.tables.get(model_name)
+            postgres = isinstance(model._meta.database, PostgresqlDatabase)
+            rows, analyzed_at = _table_size(model) if postgres else (None, None)
+            if current is not None and model_name not in self._stale:
+                if current.source == 'pg_stats' and current.analyzed_at == analyzed_at:
+                    continue
+                if current.source == 'sample' and (max_age is None or time.time() - current.updated_at < max_age):
+                    continue
+            # Clear the mark first, so an invalidation during the refresh is not lost.
+            with self._lock:
+                self._stale.discard(model_name)
+            table = self._read_pg_stats(model, rows, analyzed_at) if postgres else None
+            if table is None:
+                table = self._sample(model, rows, analyzed_at)
+            with self._lock:
+                self.tables = dict(self.tables, **{model_name: table})
+                self.version += 1
+            refreshed.append(model_name)
+        if refreshed:
+            self.refreshes += 1
+            self._save_snapshot()
+        return refreshed
+
+    def start_refreshing(self, connection, interval=600, max_age=86400):
+        """Refreshes the statistics in a background thread every `interval` seconds, see `refresh`. `connection`
+        returns a context manager which provides a database connection. Does nothing if the thread is running
+        already."""
+        def run():
+            while True:
+                try:
+                    with connection():
+                        self.refresh(max_age)
+                    self.refresh_error = None
+                except Exception as e:
+                    # The old statistics are kept until the next try.
+                    self.refresh_error = str(e)
+                time.sleep(interval)
+
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=run, name='statistics', daemon=True)
+                self._refresher.start()
+
+    def describe(self, model_name, field_name):
+        """Returns the statistics of a field as a dict for `/meta`, with the kind of chart which suits its values:
+        `bar` for few distinct values, `histogram` for ordered values, or `None`."""
+        table = self.tables.get(model_name)
+        statistics = table.fields.get(field_name) if table is not None else None
+        if statistics is None:
+            return None
+        if statistics.distinct <= _CHART_DISTINCT_LIMIT:
+            chart = 'bar'
+        elif statistics.histogram:
+            chart = 'histogram'
+        else:
+            chart = None
+        return dict(statistics._asdict(), chart=chart)
+
+    def stats(self):
+        return {
+            'tables': {name: {'rows': table.rows, 'source': table.source, 'updated_at': table.updated_at}
+                       for name, table in self.tables.items()},
+            'stale': sorted(self._stale),
+            'refreshes': self.refreshes,
+            'refresh_error': self.refresh_error,
+        }
+
+    def estimate_rows(self, model, expression=None, group_by=()):
+        """Estimates the number of rows of `model` which match the CQL expression `expression`, or the number of
+        groups of the `FieldName`s `group_by`. Returns `None` without statistics of the model."""
+        table = self.tables.get(model._name)
+        if table is None:
+            return None
+        rows = table.rows * (self.selectivity(model, expression) if expression is not None else 1.0)
+        if group_by:
+            groups = [self._field_statistics(model, field_name.values) for field_name in group_by]
+            if all(statistics is not None for statistics in groups):
+                rows = min(rows, reduce(lambda product, statistics: product * max(statistics.distinct, 1),
+                                        groups, 1))
+        return rows
+
+    def selectivity(self, model, expression):
+        """Estimates the fraction of the rows of `model` which match the CQL expression `expression`. Conditions on
+        related models use the statistics of the related fields. Conditions are assumed to be independent."""
+        if expression.is_logical_expression:
+            first = self.selectivity(model, expression.first)
+            second = self.selectivity(model, expression.second)
+            if expression.logical_operator is parser.AndOperator:
+                return first * second
+            elif expression.logical_operator is parser.OrOperator:
+                return first + second - first * second
+            return first + second - 2 * first * second
+
+        comparator = expression.comparator
+        if isinstance(expression.first, parser.FieldName) and not isinstance(expression.second, parser.FieldName):
+            field_name, value = expression.first, expression.second.value
+        elif isinstance(expression.second, parser.FieldName) and not isinstance(expression.first, parser.FieldName):
+            field_name, value = expression.second, expression.first.value
+            comparator = _MIRRORED.get(comparator, comparator)
+        else:
+            field_name, value = None, None
+        statistics = self._field_statistics(model, field_name.values) if field_name is not None else None
+
+        if comparator in (parser.EqComparator, parser.NeqComparator):
+            equal = _equal_selectivity(statistics, value) if statistics is not None else DEFAULT_EQ_SELECTIVITY
+            if comparator is parser.EqComparator:
+                return equal
+            non_null = 1 - statistics.null_fraction if statistics is not None else 1.0
+            return max(non_null - equal, 0.0)
+        if statistics is None:
+            return DEFAULT_RANGE_SELECTIVITY
+        try:
+            return _range_selectivity(statistics, comparator, value)
+        except TypeError:
+            # E.g. a string compared with a number.
+            return DEFAULT_RANGE_SELECTIVITY
+
+    def _field_statistics(self, model, path):
+        *relations, name = path
+        for relation_name in relations:
+            relation = self.mr.relation(model, relation_name) or self.mr.recursive_relation(model, relation_name)
+            if relation is None:
+                return None
+            model = relation.target
+        return self.field(model._name, name)
+
+    def _read_pg_stats(self, model, rows, analyzed_at):
+        """Reads the statistics of `model` from `pg_stats`, or returns `None` if the table was not analyzed yet."""
+        database = model._meta.database
+        cursor = database.execute_sql(
+            'SELECT attname, null_frac, n_distinct, most_common_vals::text::text[], most_common_freqs, '
+            'histogram_bounds::text::text[] FROM pg_stats '
+            'WHERE schemaname = COALESCE(%s, current_schema()) AND tablename = %s',
+            (model._meta.schema, model._meta.table_name))
+        columns = {row[0]: row[1:] for row in cursor.fetchall()}
+        if not columns or rows is None:
+            return None
+        fields = {}
+        for field_name, field in self.mr.fields(model).items():
+            if field.column_name not in columns:
+                continue
+            null_fraction, distinct, values, frequencies, histogram = columns[field.column_name]
+            convert = _NUMERIC_TYPES.get(field.field_type, str)
+            most_common = [[convert(value), frequency] for value, frequency in zip(values or [], frequencies or [])]
+            histogram = [convert(value) for value in histogram or []]
+            # A negative n_distinct is the negated number of distinct values per row.
+            distinct = -distinct * rows if distinct < 0 else distinct
+            candidates = histogram[:1] + histogram[-1:] + [value for value, _ in most_common]
+            fields[field_name] = FieldStatistics(
+                null_fraction, distinct, min(candidates) if candidates else None,
+                max(candidates) if candidates else None, most_common, histogram)
+        return TableStatistics(rows, fields, 'pg_stats', analyzed_at, time.time())
+
+    def _sample(self, model, rows, analyzed_at):
+        if rows is None or rows < 0:
+            rows = model.select().count()
+        field_items = list(self.mr.fields(model).items())
+        query = model.select(*[field for _, field in field_items])
+        if rows > self.sample_rows:
+            if isinstance(model._meta.database, PostgresqlDatabase):
+                query = query.from_(sample(model, 100 * self.sample_rows / rows))
+            else:
+                query = query.order_by(fn.Random()).limit(self.sample_rows)
+        sampled = list(query.tuples())
+        fields = {}
+        for i, (field_name, _) in enumerate(field_items):
+            fields[field_name] = self._compute(
+                [_json_value(row[i]) for row in sampled], max(rows, len(sampled)))
+        return TableStatistics(max(rows, len(sampled)), fields, 'sample', analyzed_at, time.time())
+
+    def _compute(self, values, rows):
+        """Computes the statistics of a column with `rows` rows from the sampled values `values`."""
+        sample_size = len(values)
+        non_null = [value for value in values if value is not None]
+        if not non_null:
+            return FieldStatistics(1.0 if sample_size else 0.0, 0, None, None, [], [])
+        null_fraction = 1 - len(non_null) / sample_size
+        counts = Counter(non_null)
+        # The estimator of Haas and Stokes (Duj1), which Postgres uses as well.
+        seen_once = sum(1 for count in counts.values() if count == 1)
+        total = rows * (1 - null_fraction)
+        if len(non_null) >= total:
+            distinct = len(counts)
+        elif seen_once == len(non_null):
+            distinct = total
+        else:
+            n = len(non_null)
+            distinct = n * len(counts) / (n - seen_once + seen_once * n / total)
+
+        # Like Postgres, values are only common if they were seen more than once.
+        common = [(value, count) for value, count in counts.most_common(self.most_common) if count > 1]
+        most_common = [[value, count / sample_size] for value, count in common]
+        try:
+            ordered = sorted(non_null)
+        except TypeError:
+            return FieldStatistics(null_fraction, distinct, None, None, most_common, [])
+        common_values = {value for value, _ in common}
+        rest = [value for value in ordered if value not in common_values]
+        histogram = []
+        if len(rest) > 1 and not isinstance(rest[0], bool):
+            buckets = min(self.histogram_buckets, len(rest) - 1)
+            histogram = [rest[round(i * (len(rest) - 1) / buckets)] for i in range(buckets + 1)]
+        return FieldStatistics(null_fraction, distinct, ordered[0], ordered[-1], most_common, histogram)
+
+    def _load_snapshot(self):
+        with open(self.snapshot_path, encoding='utf-8') as file:
+            snapshot = json.load(file)
+        self.tables = {
+            name: TableStatistics(table['rows'], {field_name: FieldStatistics(**statistics)
+                                                  for field_name, statistics in table['fields'].items()},
+                                  table['source'], table['analyzed_at'], table['updated_at'])
+            for name, table in snapshot['tables'].items() if name in self.mr
+        }
+        self.version += 1
+
+    def _save_snapshot(self):
+        if self.snapshot_path is None:
+            return
+        tables = {
+            name: dict(table._asdict(), fields={field_name: statistics._asdict()
+                                                for field_name, statistics in table.fields.items()})
+            for name, table in self.tables.items()
+        }
+        temporary_path = f'{self.snapshot_path}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump({'tables': tables}, file)
+        os.replace(temporary_path, self.snapshot_path)
+
+
+_MIRRORED = {
+    parser.GreaterComparator: parser.LessComparator,
+    parser.LessComparator: parser.GreaterComparator,
+    parser.GeqComparator: parser.LeqComparator,
+    parser.LeqComparator: parser.GeqComparator,
+}
+
+
+def _table_size(model):
+    """Returns the number of rows Postgres estimates for the table of `model` and when it was last analyzed."""
+    cursor = model._meta.database.execute_sql(
+        'SELECT c.reltuples, GREATEST(s.last_analyze, s.last_autoanalyze) FROM pg_class c '
+        'LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid WHERE c.oid = to_regclass(%s)',
+        (model._meta.table_name if model._meta.schema is None else f'{model._meta.schema}.{model._meta.table_name}',))
+    row = cursor.fetchone()
+    if row is None:
+        return None, None
+    return row[0], _json_value(row[1])
+
+
+def _equal_selectivity(statistics, value):
+    for common_value, frequency in statistics.most_common:
+        if common_value == value:
+            return frequency
+    # The other values share the remaining rows evenly.
+    rest = 1 - statistics.null_fraction - sum(frequency for _, frequency in statistics.most_common)
+    others = statistics.distinct - len(statistics.most_common)
+    return max(rest, 0.0) / others if others >= 1 else 0.0
+
+
+def _range_selectivity(statistics, comparator, value):
+    def matches(other):
+        if comparator is parser.LessComparator:
+            return other < value
+        elif comparator is parser.LeqComparator:
+            return other <= value
+        elif comparator is parser.GreaterComparator:
+            return other > value
+        return other >= value
+
+    selectivity = sum(frequency for common_value, frequency in statistics.most_common if matches(common_value))
+    histogram = statistics.histogram
+    rest = 1 - statistics.null_fraction - sum(frequency for _, frequency in statistics.most_common)
+    if len(histogram) < 2:
+        if statistics.min is not None and not any(matches(bound) for bound in (statistics.min, statistics.max)):
+            return selectivity
+        return selectivity + max(rest, 0.0) * DEFAULT_RANGE_SELECTIVITY
+    # The fraction of the histogram below the value, every bucket holds the same number of values.
+    if comparator in (parser.LessComparator, parser.GeqComparator):
+        i = bisect_left(histogram, value)
+    else:
+        i = bisect_right(histogram, value)
+    if i == 0:
+        below = 0.0
+    elif i == len(histogram):
+        below = 1.0
+    else:
+        low, high = histogram[i - 1], histogram[i]
+        if isinstance(value, (int, float)) and isinstance(low, (int, float)) and high != low:
+            within = (value - low) / (high - low)
+        else:
+            within = 0.5
+        below = (i - 1 + within) / (len(histogram) - 1)
+    fraction = below if comparator in (parser.LessComparator, parser.LeqComparator) else 1 - below
+    return selectivity + max(rest, 0.0) * fraction
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
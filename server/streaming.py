@@ -0,0 +1,68 @@
+import asyncio
+import queue
+import threading
+
+
+_END = object()
+
+
+def stream_in_thread(produce, executor, max_chunks=8, timeout=60):
+    """Runs the blocking generator function `produce` on a worker thread of the `BoundedExecutor` `executor` and
+    returns an async generator function which yields the produced chunks.
+
+    The producer is submitted right away, so an `ExecutorSaturated` is raised while the view can still answer
+    with an error. At most `max_chunks` chunks are buffered, the producer waits while the buffer is full. It stops
+    as soon as the async generator is closed, e.g. when the client disconnects, or if no chunk was taken from the
+    full buffer for `timeout` seconds, e.g. if the body is never sent. The producer is closed when it stops, so it
+    can release its cursor and connection.
+    """
+    chunks = queue.Queue(max_chunks)
+    cancelled = threading.Event()
+
+    def put(chunk):
+        waited = 0
+        while not cancelled.is_set() and waited < timeout:
+            try:
+                chunks.put(chunk, timeout=0.5)
+                return True
+            except queue.Full:
+                waited += 0.5
+        cancelled.set()
+        return False
+
+    def get():
+        while not cancelled.is_set():
+            try:
+                return chunks.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return _END
+
+    def run():
+        chunk_iterator = produce()
+        try:
+            for chunk in chunk_iterator:
+                if not put(chunk):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            chunk_iterator.close()
+            put(_END)
+
+    executor.submit(run)
+
+    async def body():
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, get)
+                if chunk is _END:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            cancelled.set()
+
+    return body
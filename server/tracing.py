@@ -0,0 +1,68 @@
+import heapq
+import threading
+from collections import deque
+from datetime import datetime
+
+
+class SlowQueryLog:
+    """Keeps the last `size` requests which took at least `threshold` seconds."""
+
+    def __init__(self, size=50, threshold=1.0):
+        self.threshold = threshold
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, path, cql_query, duration, request_metrics):
+        if duration < self.threshold:
+            return False
+        entry = {
+            'time': datetime.now().isoformat(),
+            'endpoint': endpoint,
+            'path': path,
+            'cql': cql_query,
+            'duration': duration,
+            'stages': dict(request_metrics.stages),
+            'statements': [
+                {'sql': statement.sql, 'duration': statement.duration, 'rows': statement.rows}
+                for statement in request_metrics.statements
+            ],
+        }
+        with self._lock:
+            self._entries.append(entry)
+        return True
+
+    def slowest(self, count=None):
+        """Returns the recorded requests, the slowest first."""
+        with self._lock:
+            entries = list(self._entries)
+        if count is None:
+            count = len(entries)
+        return heapq.nlargest(count, entries, key=lambda entry: entry['duration'])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def trace_requested(req):
+    """Tracing is enabled with the parameter `trace=1` or the header `X-Trace: 1`."""
+    return req.params.get('trace') == '1' or req.headers.get('X-Trace') == '1'
+
+
+def format_trace(request_metrics):
+    statements = request_metrics.statements
+    return {
+        'statements': [
+            {
+                'sql': statement.sql,
+                'params': statement.params,
+                'duration': statement.duration,
+                'rows': statement.rows,
+                'offset': statement.start - request_metrics.start,
+            }
+            for statement in statements
+        ],
+        'statement_count': len(statements),
+        'sql_duration': sum(statement.duration for statement in statements),
+        'stages': dict(request_metrics.stages),
+    }
@@ -1,119 +1,780 @@
+import asyncio
+import functools
 import json
+import math
+import time
+from collections import namedtuple
+from contextlib import closing
 from datetime import datetime
 
 import os
 
 import responder
 from peewee import DoesNotExist
+from playhouse.pool import MaxConnectionsExceeded
 from playhouse.shortcuts import model_to_dict
 
-from server.model_register import ModelType
-from server.models import mr
-from server.query.builder import QueryBuilder
-from server.query.result import generate_result_object
+from server import metrics
+from server.admission import BudgetExhausted, CostBudgets, QueryTooExpensive
+from server.cursor import paginate, seek, split_page
+from server.database import db, iterate
+from server.analysis import describe_context, describe_query
+from server.completion import Completer
+from server.executor import BoundedExecutor, ExecutorSaturated
+from server.graph import DIRECTIONS, GraphIndex, GraphSource
+from server.loader import RelationLoader
+from server.models import CommitRelationship, Followers, Project, User, mr
+from server.precomputed import PrecomputedBody
+from server.query.cache import CompiledQueryCache, LRUCache, ResultCache
+from server.query.explain import describe_sample, describe_tree, explain, plan_estimate
+from server.query.result import iter_result_chunks
+from server.statistics import Statistics
+from server.streaming import stream_in_thread
+from server.tracing import SlowQueryLog, format_trace, trace_requested
 
 api = responder.API()
 
+statistics = Statistics(mr, snapshot_path=os.environ.get('STATISTICS_SNAPSHOT'),
+                        sample_rows=int(os.environ.get('STATISTICS_SAMPLE_ROWS', 30000)))
+statistics_refresh = float(os.environ.get('STATISTICS_REFRESH', 600))
+statistics_max_age = float(os.environ.get('STATISTICS_MAX_AGE', 86400))
+compiled_queries = CompiledQueryCache(mr, maxsize=int(os.environ.get('QUERY_CACHE_SIZE', 256)), statistics=statistics)
+query_costs = LRUCache(maxsize=int(os.environ.get('QUERY_CACHE_SIZE', 256)))
+cost_budgets = CostBudgets(max_cost=float(os.environ.get('QUERY_MAX_COST', 1e8)),
+                           budget=float(os.environ.get('QUERY_COST_BUDGET', 1e9)),
+                           window=float(os.environ.get('QUERY_COST_WINDOW', 60)))
+query_results = ResultCache(max_bytes=int(os.environ.get('RESULT_CACHE_BYTES', 64 * 1024 * 1024)),
+                            ttl=int(os.environ.get('RESULT_CACHE_TTL', 300)))
+relation_loader = RelationLoader(mr, limit=int(os.environ.get('MODEL_RELATION_LIMIT', 20)))
+executor = BoundedExecutor(max_workers=int(os.environ.get('DB_WORKERS', 8)),
+                           max_queue=int(os.environ.get('DB_QUEUE_SIZE', 32)))
+# Streams hold a worker, a connection and a cursor while the client reads, so they get workers of their own.
+stream_executor = BoundedExecutor(max_workers=int(os.environ.get('STREAM_WORKERS', 4)),
+                                  max_queue=int(os.environ.get('STREAM_QUEUE_SIZE', 4)))
+
+metric_registry = metrics.Registry()
+request_duration = metric_registry.histogram(
+    'http_request_duration_seconds', 'Duration of requests.', ['endpoint', 'status'])
+stage_duration = metric_registry.histogram(
+    'http_request_stage_duration_seconds', 'Duration of the stages of requests.', ['endpoint', 'stage'])
+returned_rows = metric_registry.counter('rows_returned_total', 'Number of returned result objects.', ['endpoint'])
+sql_statements = metric_registry.counter('sql_statements_total', 'Number of executed SQL statements.', ['endpoint'])
+GRAPH_SOURCES = {
+    # Outgoing edges point from a commit to its parents and from a user to the users they follow.
+    'commits': GraphSource(CommitRelationship.child, CommitRelationship.parent, incremental=True),
+    'followers': GraphSource(Followers.follower, Followers.user, incremental=False),
+}
+graph_index = GraphIndex({name: GRAPH_SOURCES[name] for name in os.environ.get('GRAPH_INDEX', '').split(',')
+                          if name in GRAPH_SOURCES},
+                         snapshot_dir=os.environ.get('GRAPH_SNAPSHOT_DIR'))
+completer = Completer(mr, value_fields=[(User, 'login'), (User, 'company'), (User, 'city'), (User, 'location'),
+                                         (Project, 'name')])
+completion_sample_percent = float(os.environ.get('COMPLETION_SAMPLE_PERCENT', 1))
+completion_values = int(os.environ.get('COMPLETION_VALUES', 10000))
+completion_refresh = float(os.environ.get('COMPLETION_REFRESH', 3600))
+slow_queries = SlowQueryLog(size=int(os.environ.get('SLOW_QUERY_LOG_SIZE', 50)),
+                            threshold=float(os.environ.get('SLOW_QUERY_THRESHOLD', 1.0)))
+
+QUERY_PAGE_SIZE = 50
+STREAM_CHUNK_SIZE = 500
+MODEL_PAGE_SIZE = 1000
+MAX_GRAPH_HOPS = 10
+max_page_size = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+max_batch_size = int(os.environ.get('QUERY_BATCH_SIZE', 50))
+batch_concurrency = int(os.environ.get('QUERY_BATCH_CONCURRENCY', 4))
+meta_max_age = int(os.environ.get('META_MAX_AGE', 300))
+
+
+def offload(view):
+    """Runs a view, which queries the database, on the bounded executor instead of the event loop. The view gets
+    a pooled connection, which is released when the view returns."""
+    @functools.wraps(view)
+    def with_connection(req, resp, *args, **kwargs):
+        try:
+            with db.request_connection():
+                view(req, resp, *args, **kwargs)
+        except MaxConnectionsExceeded as e:
+            service_unavailable(resp, e)
+    return executor.offload(with_connection, service_unavailable)
+
+
+def instrument(view):
+    """Records the duration of a view and its stages, the returned rows and the executed SQL statements in the
+    metrics of the endpoint, and sends the durations in the `Server-Timing` header. Slow requests are added to the
+    slow query log. If tracing is requested, JSON results are returned as `{"result": ..., "trace": ...}`."""
+    endpoint = view.__name__
+
+    @functools.wraps(view)
+    def instrumented_view(req, resp, *args, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        with metrics.track_request() as request_metrics, db.count_statements() as statements:
+            try:
+                view(req, resp, *args, **kwargs)
+                failed = False
+            finally:
+                record_request(endpoint, req, resp, time.perf_counter() - start, request_metrics, statements.count,
+                               failed, req.params.get('q'))
+        if trace_requested(req):
+            add_trace(resp, request_metrics)
+    return instrumented_view
+
+
+def record_request(endpoint, req, resp, duration, request_metrics, statement_count, failed, cql_query):
+    """Records a finished request in the metrics of `endpoint` and, if it was slow, in the slow query log, and sends
+    the durations of its stages in the `Server-Timing` header."""
+    status = api.status_codes.HTTP_500 if failed else resp.status_code or api.status_codes.HTTP_200
+    request_duration.observe(duration, endpoint=endpoint, status=status)
+    for stage_name, seconds in request_metrics.stages.items():
+        stage_duration.observe(seconds, endpoint=endpoint, stage=stage_name)
+    returned_rows.inc(request_metrics.rows, endpoint=endpoint)
+    sql_statements.inc(statement_count, endpoint=endpoint)
+    request_metrics.add_time('total', duration)
+    resp.headers['Server-Timing'] = request_metrics.server_timing()
+    slow_queries.record(endpoint, req.url.path, cql_query, duration, request_metrics)
+
+
+def add_trace(resp, request_metrics):
+    """Wraps a JSON response into an object together with the SQL trace of the request."""
+    content = resp.content
+    if content is None or not resp.headers.get('Content-Type', '').startswith('application/json'):
+        return
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    trace = json.dumps(format_trace(request_metrics), cls=JsonEncoder).encode('utf-8')
+    resp.content = b'{"result":' + content + b',"trace":' + trace + b'}'
+
+
+def service_unavailable(resp, error):
+    resp.headers['Retry-After'] = '1'
+    error_response(resp, api.status_codes.HTTP_503, str(error))
+
 
 @api.route('/models')
+@instrument
 def model_list(req, resp):
-    resp.media = list(mr.keys())
+    model_list_body.respond(req, resp)
 
 
 @api.route('/models/{model_name}')
+@offload
+@instrument
 def multiple_models(req, resp, model_name):
     model_name = model_name.lower()
     if model_name in mr:
         model = mr[model_name]
-        query = model.select().limit(1000)
-        json_response(resp, [model_to_dict(item, recurse=False) for item in query])
+        primary_key = model._meta.primary_key
+        try:
+            cursor, limit = page_params(req, MODEL_PAGE_SIZE)
+            query = paginate(model.select().order_by(primary_key), [primary_key], cursor, limit)
+        except ValueError as e:
+            error_response(resp, api.status_codes.HTTP_400, str(e))
+            return
+        items, next_cursor = split_page(query, limit, lambda item: [getattr(item, primary_key.name)])
+        set_next_cursor(resp, next_cursor)
+        metrics.add_rows(len(items))
+        json_response(resp, [model_to_dict(item, recurse=False) for item in items])
     else:
         resp.status_code = api.status_codes.HTTP_404
 
 
 @api.route('/models/{model_name}/{id_}')
+@offload
+@instrument
 def model_single(req, resp, model_name, id_):
     model_name = model_name.lower()
     if model_name in mr:
         model = mr[model_name]
         try:
-            query = model.get_by_id(id_)
-            json_response(resp, mr.query_dict(query, 1))
+            expand = relation_loader.parse_expand(model, req.params.get('expand'))
+            limit = relation_loader.clamp_limit(req.params.get('limit'))
+        except ValueError as e:
+            error_response(resp, api.status_codes.HTTP_400, str(e))
+            return
+        try:
+            result = relation_loader.load(model, id_, expand, limit)
+            metrics.add_rows(1)
+            json_response(resp, result)
             return
         except (ValueError, DoesNotExist):
             pass
     resp.status_code = api.status_codes.HTTP_404
 
 
+@api.route('/models/{model_name}/{id_}/{relation_name}')
+@offload
+@instrument
+def model_relation(req, resp, model_name, id_, relation_name):
+    model_name = model_name.lower()
+    if model_name not in mr:
+        resp.status_code = api.status_codes.HTTP_404
+        return
+    model = mr[model_name]
+    try:
+        page = relation_loader.load_page(model, id_, relation_name, req.params.get('cursor'), req.params.get('limit'))
+    except ValueError as e:
+        error_response(resp, api.status_codes.HTTP_400, str(e))
+        return
+    metrics.add_rows(len(page['items']))
+    json_response(resp, page)
+
+
 @api.route('/meta')
+@instrument
 def meta(req, resp):
-    resp.media = []
+    statistics.start_refreshing(db.request_connection, statistics_refresh, statistics_max_age)
+    meta_body(statistics.version).respond(req, resp)
+
+
+@api.route('/example_meta')
+@instrument
+def example_meta(req, resp):
+    example_meta_body.respond(req, resp)
+
+
+def meta_description():
+    description = []
     for model_name, model in mr.items():
         model_meta = {'model': model_name, 'fields': [], 'relations': []}
-        for field_name, field in model._meta.fields.items():
-            field_type = field.__class__.__name__
-            if field_type == 'ForeignKeyField':
-                continue
-            field_dict = {'name': field_name, 'type': field_type}
+        table = statistics.table(model_name)
+        if table is not None:
+            model_meta['rows'] = table.rows
+        for field_name, field in mr.fields(model).items():
+            field_dict = {'name': field_name, 'type': field.__class__.__name__}
             if field.primary_key:
                 field_dict['primary_key'] = True
             if field.unique:
                 field_dict['unique'] = True
+            field_statistics = statistics.describe(model_name, field_name)
+            if field_statistics is not None:
+                field_dict['statistics'] = field_statistics
             model_meta['fields'].append(field_dict)
 
-        for field_name, field in model._meta.fields.items():
-            field_type = field.__class__.__name__
-            if field_type != 'ForeignKeyField':
-                continue
-
-            assert hasattr(field.rel_model, '_name')
-            assert hasattr(field.rel_model, '_type') and field.rel_model._type is ModelType.MODEL
+        for relation_name, relation in mr.relations(model).items():
+            model_meta['relations'].append({'name': relation_name, 'type': relation.kind,
+                                            'rel_model': relation.target._name})
+        for relation_name, relation in mr.recursive_relations(model).items():
+            # Transitive relations follow a self-referencing relation, their type is the type of that relation.
+            model_meta['relations'].append({'name': relation_name, 'type': relation.kind,
+                                            'rel_model': relation.target._name, 'recursive': True})
 
-            rel_model = field.rel_model._name
-            model_meta['relations'].append({'name': field_name, 'type': 'n:1', 'rel_model': rel_model})
-        for backref, backref_model in model._meta.backrefs.items():
-            assert hasattr(backref_model, '_name')
-            assert hasattr(backref_model, '_type')
-            assert backref_model._type is ModelType.MODEL or backref_model._type is ModelType.NM_RELATION
+        description.append(model_meta)
+    return description
 
-            backref_name = backref_model._name
-            backref_type = backref_model._type
 
-            relation_dict = {'name': backref.backref}
-            if backref_type is ModelType.MODEL:
-                relation_dict['type'] = '1:n'
-                relation_dict['rel_model'] = backref_name
-            else:
-                relation_dict['type'] = 'n:m'
-                relation_dict['rel_model'] = backref_model._other_field(backref).rel_model._name
-            model_meta['relations'].append(relation_dict)
+@functools.lru_cache(maxsize=1)
+def meta_body(statistics_version):
+    return PrecomputedBody(json.dumps(meta_description()), max_age=meta_max_age)
 
-        resp.media.append(model_meta)
 
-
-@api.route('/example_meta')
-def example_meta(req, resp):
+def example_meta_description():
     dir = os.path.dirname(os.path.realpath(__file__))
     file = os.path.join(dir, 'example_meta.json')
 
     with open(file, encoding='utf-8') as f:
-        resp.media = json.load(f)
+        return json.load(f)
+
+
+# The models can not change while the server runs, so these bodies are serialized once, `/meta` again once the
+# statistics changed.
+model_list_body = PrecomputedBody(json.dumps(list(mr.keys())), max_age=meta_max_age)
+example_meta_body = PrecomputedBody(json.dumps(example_meta_description()), max_age=meta_max_age)
 
 
 @api.route('/query')
+@offload
+@instrument
 def query(req, resp):
     if 'q' not in req.params:
         return
     cql_query = req.params['q']
-    query_builder = QueryBuilder(mr)
-    query, query_tree = query_builder(cql_query)
+    try:
+        compiled = compiled_queries(cql_query)
+    except SyntaxError as e:
+        error_response(resp, api.status_codes.HTTP_400, str(e))
+        return
+    flag_approximate(resp, compiled)
+    if req.params.get('stream') == '1' or 'application/x-ndjson' in req.headers.get('Accept', ''):
+        stream_query(req, resp, compiled)
+        return
+    try:
+        cursor, limit = page_params(req, QUERY_PAGE_SIZE)
+        query = paginate(compiled.query, compiled.page_keys, cursor, limit)
+    except ValueError as e:
+        error_response(resp, api.status_codes.HTTP_400, str(e))
+        return
+
+    try:
+        content, next_cursor, statement_count = read_page(client_id(req), compiled, query, limit)
+    except (QueryTooExpensive, BudgetExhausted) as e:
+        admission_error(resp, e)
+        return
+    if statement_count is None:
+        resp.headers['X-Cache'] = 'hit'
+    else:
+        resp.headers['X-Cache'] = 'miss'
+        resp.headers['X-SQL-Statements'] = str(statement_count)
+
+    set_next_cursor(resp, next_cursor)
+    resp.headers['Content-Type'] = 'application/json'
+    resp.content = content
+
+
+def flag_approximate(resp, compiled):
+    """Flags the results of a query with a `SAMPLE:` clause as approximate."""
+    if compiled.sample is not None:
+        resp.headers['X-Approximate'] = 'true'
+        resp.headers['X-Sample-Scale'] = str(sample_scale(compiled))
+
+
+def sample_scale(compiled):
+    """Returns the factor which scales sums and counts over the sample of a query up to the whole table."""
+    return 100 / compiled.sample.percentage if compiled.sample is not None else None
+
+
+def read_page(client, compiled, query, limit):
+    """Returns the JSON content of the page `query` of a compiled query, the cursor of the next page and the number
+    of executed statements, `None` if the page was cached. Raises `QueryTooExpensive` or `BudgetExhausted` if the
+    client may not run the query."""
+    key = query_results.key(query, compiled.query_tree)
+    cached = query_results.get(key)
+    if cached is not None:
+        content, next_cursor = cached
+        return content, next_cursor, None
+    cost_budgets.admit(client, estimate_cost(query))
+    versions = query_results.versions(compiled.tables)
+    with db.count_statements() as statements:
+        rows, next_cursor = split_page(compiled.assembler.execute(query), limit, compiled.assembler.page_values)
+        with metrics.stage('assemble'):
+            result = compiled.assembler.assemble(rows)
+    with metrics.stage('serialize'):
+        content = json.dumps(result, cls=JsonEncoder).encode('utf-8')
+    metrics.add_rows(len(result))
+    query_results.put(key, (content, next_cursor), len(content), compiled.tables, versions)
+    return content, next_cursor, statements.count
+
+
+def stream_query(req, resp, compiled):
+    """Streams all result objects of a query (or the ones after `cursor`, at most `limit`) while they are read
+    from a server-side cursor. Sends one JSON object per line for `Accept: application/x-ndjson`, otherwise a JSON
+    array."""
+    ndjson = 'application/x-ndjson' in req.headers.get('Accept', '')
+    query = compiled.query
+    try:
+        if 'cursor' in req.params:
+            query = seek(query, compiled.page_keys, req.params['cursor'])
+        if 'limit' in req.params:
+            query = query.limit(int(req.params['limit']))
+    except ValueError as e:
+        error_response(resp, api.status_codes.HTTP_400, str(e))
+        return
+    if not admit_query(req, resp, query):
+        return
+
+    def produce():
+        # The cursor is closed before the connection is returned, also if the stream is closed early.
+        with db.request_connection(), closing(iterate(query, STREAM_CHUNK_SIZE)) as rows:
+            first = True
+            try:
+                for result_objects in iter_result_chunks(rows, compiled.assembler.assemble, STREAM_CHUNK_SIZE):
+                    lines = [json.dumps(obj, cls=JsonEncoder) for obj in result_objects]
+                    if ndjson:
+                        yield ''.join(line + '\n' for line in lines).encode('utf-8')
+                    else:
+                        yield (('[' if first else ',') + ','.join(lines)).encode('utf-8')
+                    first = False
+            except Exception as e:
+                # The status code has already been sent, so the error is reported at the end of the body.
+                error = json.dumps({'error': str(e)})
+                yield (error + '\n' if ndjson else ('[' if first else ',') + error + ']').encode('utf-8')
+                return
+            if not ndjson:
+                yield b'[]' if first else b']'
+
+    try:
+        body = stream_in_thread(produce, stream_executor)
+    except ExecutorSaturated as e:
+        service_unavailable(resp, e)
+        return
+    resp.headers['Content-Type'] = 'application/x-ndjson' if ndjson else 'application/json'
+    resp.stream(body)
+
+
+# A query of a batch which is ready to run: the page `query` of a compiled query, and `key`, the key of the page
+# in the result cache, which identifies identical pages.
+BatchQuery = namedtuple('BatchQuery', ['key', 'compiled', 'query', 'limit'])
+
+
+@api.route('/query/batch', methods=['POST'])
+async def query_batch(req, resp):
+    """Reads a page of every query of `{"queries": [<cql-query> or {"q": ..., "cursor": ..., "limit": ...}, ...]}`
+    and returns them as `{"results": [...]}` in the same order. Every result has its own `status`, so a failed query
+    does not fail the batch."""
+    body = await req.media() if await req.content else None
+    items = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, (str, dict)) for item in items):
+        error_response(resp, api.status_codes.HTTP_400,
+                       'queries must be a list of CQL queries or of objects with q, cursor and limit.')
+        return
+    if len(items) > max_batch_size:
+        error_response(resp, api.status_codes.HTTP_400, f'A batch may contain at most {max_batch_size} queries.')
+        return
+
+    request_metrics = metrics.RequestMetrics()
+    failed = True
+    try:
+        await run_batch(req, resp, items, request_metrics)
+        failed = False
+    finally:
+        cql_queries = '\n'.join(item if isinstance(item, str) else str(item.get('q')) for item in items)
+        record_request('query_batch', req, resp, time.perf_counter() - request_metrics.start, request_metrics,
+                       len(request_metrics.statements), failed, cql_queries)
+    if trace_requested(req):
+        add_trace(resp, request_metrics)
+
+
+async def run_batch(req, resp, items, request_metrics):
+    try:
+        planned, planning_metrics = await executor.run(tracked, plan_batch, items)
+    except ExecutorSaturated as e:
+        service_unavailable(resp, e)
+        return
+    request_metrics.merge(planning_metrics)
+    client = client_id(req)
+    # At most `batch_concurrency` queries of a batch hold a worker and a connection, so a batch can not take all of
+    # them from the other requests.
+    semaphore = asyncio.Semaphore(batch_concurrency)
+
+    async def run(batch_query):
+        async with semaphore:
+            try:
+                item, item_metrics = await executor.run(tracked, run_batch_query, client, batch_query)
+            except ExecutorSaturated as e:
+                return batch_error(api.status_codes.HTTP_503, e)
+            request_metrics.merge(item_metrics)
+            return item
+
+    # Identical pages, e.g. of two charts with the same query, are read once.
+    pages = {}
+    for batch_query in planned:
+        if isinstance(batch_query, BatchQuery) and batch_query.key not in pages:
+            pages[batch_query.key] = run(batch_query)
+    contents = dict(zip(pages.keys(), await asyncio.gather(*pages.values())))
+    results = [contents[batch_query.key] if isinstance(batch_query, BatchQuery) else batch_query
+               for batch_query in planned]
+    resp.headers['Content-Type'] = 'application/json'
+    resp.content = b'{"results":[' + b','.join(results) + b']}'
 
-    json_response(resp, [generate_result_object(row, query_tree.root) for row in query])
+
+def tracked(func, *args):
+    """Runs `func(*args)` with its own request metrics, for the parts of a request which run on worker threads.
+    Returns the result and the metrics."""
+    with metrics.track_request() as request_metrics:
+        return func(*args), request_metrics
+
+
+def plan_batch(items):
+    """Compiles the queries of a batch. Returns a `BatchQuery` for every valid query, the error result otherwise."""
+    planned = []
+    for item in items:
+        if isinstance(item, str):
+            item = {'q': item}
+        try:
+            if not isinstance(item.get('q'), str):
+                raise ValueError('The query q is missing.')
+            compiled = compiled_queries(item['q'])
+            limit = max(1, min(int(item.get('limit', QUERY_PAGE_SIZE)), max_page_size))
+            query = paginate(compiled.query, compiled.page_keys, item.get('cursor'), limit)
+            planned.append(BatchQuery(query_results.key(query, compiled.query_tree), compiled, query, limit))
+        except Exception as e:
+            planned.append(batch_error(api.status_codes.HTTP_400, e))
+    return planned
+
+
+def run_batch_query(client, batch_query):
+    """Reads the page of a query of a batch and returns its result."""
+    try:
+        with db.request_connection():
+            content, next_cursor, statement_count = read_page(client, batch_query.compiled, batch_query.query,
+                                                              batch_query.limit)
+    except QueryTooExpensive as e:
+        return batch_error(api.status_codes.HTTP_400, e)
+    except BudgetExhausted as e:
+        return batch_error(api.status_codes.HTTP_429, e, retry_after=math.ceil(e.retry_after))
+    except MaxConnectionsExceeded as e:
+        return batch_error(api.status_codes.HTTP_503, e)
+    except Exception as e:
+        return batch_error(api.status_codes.HTTP_500, e)
+    header = {'status': api.status_codes.HTTP_200, 'next_cursor': next_cursor,
+              'cache': 'hit' if statement_count is None else 'miss'}
+    if batch_query.compiled.sample is not None:
+        header.update(approximate=True, sample_scale=sample_scale(batch_query.compiled))
+    # The cached content is embedded as it is.
+    header = json.dumps(header)
+    return header[:-1].encode('utf-8') + b',"result":' + content + b'}'
+
+
+def batch_error(status, error, **fields):
+    return json.dumps(dict({'status': status, 'error': str(error)}, **fields)).encode('utf-8')
+
+
+@api.route('/query/explain')
+@offload
+@instrument
+def query_explain(req, resp):
+    if 'q' not in req.params:
+        error_response(resp, api.status_codes.HTTP_400, 'The parameter q is missing.')
+        return
+    statistics.start_refreshing(db.request_connection, statistics_refresh, statistics_max_age)
+    try:
+        compiled = compiled_queries(req.params['q'])
+    except SyntaxError as e:
+        error_response(resp, api.status_codes.HTTP_400, str(e))
+        return
+    try:
+        cursor, limit = page_params(req, QUERY_PAGE_SIZE)
+        query = paginate(compiled.query, compiled.page_keys, cursor, limit)
+    except ValueError as e:
+        error_response(resp, api.status_codes.HTTP_400, str(e))
+        return
+
+    sql, params = query.sql()
+    plan = explain(query)
+    cost, rows = plan_estimate(plan)
+    json_response(resp, {
+        'sql': sql,
+        'params': params,
+        'tables': sorted(compiled.tables),
+        'tree': describe_tree(compiled.query_tree.root),
+        'cost': cost,
+        'rows': rows,
+        'estimated_rows': compiled.estimated_rows,
+        'sample': describe_sample(compiled.sample),
+        'plan': plan,
+        'budget': dict(cost_budgets.stats(), remaining=cost_budgets.remaining(client_id(req))),
+    })
+
+
+def client_id(req):
+    """Identifies the client of a request for its cost budget by the header `X-Client-Id` or its address."""
+    client_header = req.headers.get('X-Client-Id')
+    if client_header:
+        return client_header
+    return req.client.host if req.client is not None else None
+
+
+def estimate_cost(query):
+    """Returns the estimated cost of a query. The estimates are cached by SQL and parameters, since the literals
+    of the conditions and the limit of a page are parameters, which change the cost."""
+    sql, params = query.sql()
+    key = (sql, tuple(params))
+    estimate = query_costs.get(key)
+    if estimate is None:
+        with metrics.stage('explain'):
+            estimate = plan_estimate(explain(query))
+        query_costs.put(key, estimate)
+    return estimate[0]
+
+
+def admit_query(req, resp, query):
+    """Charges the estimated cost of `query` to the budget of the client. Sets an error response and returns
+    `False` if the query must not run."""
+    try:
+        cost_budgets.admit(client_id(req), estimate_cost(query))
+    except (QueryTooExpensive, BudgetExhausted) as e:
+        admission_error(resp, e)
+        return False
+    return True
+
+
+def admission_error(resp, error):
+    if isinstance(error, BudgetExhausted):
+        resp.headers['Retry-After'] = str(math.ceil(error.retry_after))
+        error_response(resp, api.status_codes.HTTP_429, str(error))
+    else:
+        error_response(resp, api.status_codes.HTTP_400, str(error))
+
+
+@api.route('/query/cache')
+def query_cache(req, resp):
+    resp.media = compiled_queries.stats()
+
+
+@api.route('/query/results')
+def query_results_stats(req, resp):
+    resp.media = query_results.stats()
+
+
+@api.route('/query/results/invalidate', methods=['POST'])
+async def invalidate_query_results(req, resp):
+    """Drops the cached results which were read from the given tables, e.g. after they were loaded again. Expects
+    `{"tables": [...]}`, without tables all results are dropped."""
+    body = await req.media() if await req.content else {}
+    tables = body.get('tables') if isinstance(body, dict) else None
+    if tables is not None and (not isinstance(tables, list) or not all(isinstance(t, str) for t in tables)):
+        error_response(resp, api.status_codes.HTTP_400, 'tables must be a list of table names.')
+        return
+    resp.media = {'invalidated': query_results.invalidate(tables), 'graphs': graph_index.invalidate(tables),
+                  'statistics': statistics.invalidate(tables)}
+
+
+@api.route('/statistics')
+def statistics_stats(req, resp):
+    resp.media = statistics.stats()
+
+
+@api.route('/metrics')
+def metrics_text(req, resp):
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    resp.content = metric_registry.render()
+
+
+@api.route('/debug/slow_queries')
+def slow_query_log(req, resp):
+    resp.media = slow_queries.slowest()
+
+
+@api.route('/complete')
+@instrument
+def complete(req, resp):
+    """Completes the CQL query `q` at the position `offset`. The value indexes are loaded in the background after
+    the first request. Requests with the same `session` reuse the previous analysis of the query."""
+    completer.start_loading(db.request_connection, completion_sample_percent, completion_values, completion_refresh)
+    try:
+        offset = int(req.params['offset']) if 'offset' in req.params else None
+        limit = max(1, min(int(req.params.get('limit', 10)), 100))
+    except ValueError as e:
+        error_response(resp, api.status_codes.HTTP_400, str(e))
+        return
+    json_response(resp, completer.complete(req.params.get('q', ''), offset, limit, req.params.get('session')))
+
+
+@api.route('/query/analyze')
+@instrument
+def query_analyze(req, resp):
+    """Parses the partial CQL query `q` with error recovery and returns the query so far, the syntax errors and the
+    context at the position `offset`. Requests with the same `session` reuse the previous analysis."""
+    try:
+        offset = int(req.params['offset']) if 'offset' in req.params else None
+    except ValueError as e:
+        error_response(resp, api.status_codes.HTTP_400, str(e))
+        return
+    analysis = completer.analyzer.analyze(req.params.get('q', ''), offset, req.params.get('session'))
+    json_response(resp, {
+        'query': describe_query(analysis.query),
+        'errors': [dict(error._asdict()) for error in analysis.errors],
+        'context': dict(analysis.context._asdict(), description=describe_context(analysis.context)),
+        'reused': {'tokens': analysis.reused_tokens, 'clauses': analysis.reused_clauses},
+    })
+
+
+@api.route('/graph')
+def graph_stats(req, resp):
+    resp.media = graph_index.stats()
+
+
+def graph_view(view):
+    """Passes the graph `name` of the graph index to a view, instead of its name. Responds with 404 if the graph
+    is not enabled and with 400 for invalid parameters."""
+    @functools.wraps(view)
+    def with_graph(req, resp, name, **kwargs):
+        if name not in graph_index:
+            error_response(resp, api.status_codes.HTTP_404, f'The graph {name} is not enabled.')
+            return
+        try:
+            direction = req.params.get('direction', 'out')
+            if direction not in DIRECTIONS:
+                raise ValueError(f'direction must be one of {", ".join(DIRECTIONS)}.')
+            view(req, resp, graph_index.get(name), direction, **kwargs)
+        except ValueError as e:
+            error_response(resp, api.status_codes.HTTP_400, str(e))
+    return with_graph
+
+
+def node_param(req, name):
+    if name not in req.params:
+        raise ValueError(f'The parameter {name} is missing.')
+    return int(req.params[name])
+
+
+@api.route('/graph/{name}/nodes/{id_}')
+@offload
+@instrument
+@graph_view
+def graph_neighbourhood(req, resp, graph, direction, id_):
+    hops = int(req.params.get('hops', 1))
+    if not 1 <= hops <= MAX_GRAPH_HOPS:
+        raise ValueError(f'hops must be between 1 and {MAX_GRAPH_HOPS}.')
+    _, limit = page_params(req, max_page_size)
+    node_id = int(id_)
+    neighbourhood = graph.neighbourhood(node_id, hops, direction, limit)
+    metrics.add_rows(len(neighbourhood))
+    json_response(resp, {
+        'id': node_id,
+        'out_degree': graph.degree(node_id, 'out'),
+        'in_degree': graph.degree(node_id, 'in'),
+        'neighbours': [{'id': neighbour_id, 'distance': distance} for neighbour_id, distance in neighbourhood.items()],
+    })
+
+
+@api.route('/graph/{name}/path')
+@offload
+@instrument
+@graph_view
+def graph_path(req, resp, graph, direction):
+    max_hops = int(req.params['max_hops']) if 'max_hops' in req.params else None
+    path = graph.shortest_path(node_param(req, 'from'), node_param(req, 'to'), direction, max_hops)
+    json_response(resp, {'path': path})
+
+
+@api.route('/graph/{name}/common_ancestors')
+@offload
+@instrument
+@graph_view
+def graph_common_ancestors(req, resp, graph, direction):
+    json_response(resp, {
+        'common_ancestors': graph.common_ancestors(node_param(req, 'first'), node_param(req, 'second'), direction)})
+
+
+@api.route('/graph/{name}/top')
+@offload
+@instrument
+@graph_view
+def graph_top_degree(req, resp, graph, direction):
+    _, limit = page_params(req, 10)
+    json_response(resp, [{'id': node_id, 'degree': degree} for node_id, degree in graph.top_degree(limit, direction)])
+
+
+@api.route('/executor')
+def executor_stats(req, resp):
+    resp.media = dict(executor.stats(), streams=stream_executor.stats())
+
+
+@api.route('/pool')
+def pool_stats(req, resp):
+    resp.media = db.pool_stats()
+
+
+def page_params(req, default_size):
+    """Returns the cursor and the page size of a request. The page size is limited to `max_page_size`."""
+    limit = int(req.params.get('limit', default_size))
+    return req.params.get('cursor'), max(1, min(limit, max_page_size))
+
+
+def set_next_cursor(resp, cursor):
+    if cursor is not None:
+        resp.headers['X-Next-Cursor'] = cursor
 
 
 def json_response(resp, obj):
     resp.headers.update({"Content-Type": "application/json"})
-    resp.content = json.dumps(obj, cls=JsonEncoder)
+    with metrics.stage('serialize'):
+        resp.content = json.dumps(obj, cls=JsonEncoder)
+
+
+def error_response(resp, status_code, message):
+    resp.status_code = status_code
+    resp.media = {'error': message}
 
 
 class JsonEncoder(json.JSONEncoder):
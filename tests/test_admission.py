@@ -0,0 +1,30 @@
+import pytest
+
+from server.admission import BudgetExhausted, CostBudgets, QueryTooExpensive
+
+
+def test_max_cost():
+    budgets = CostBudgets(max_cost=100)
+    budgets.admit('a', 100)
+    budgets.admit('a', None)
+    with pytest.raises(QueryTooExpensive):
+        budgets.admit('a', 101)
+    assert budgets.stats()['admitted'] == 2 and budgets.stats()['rejected'] == 1
+
+def test_budget():
+    budgets = CostBudgets(budget=100, window=1000)
+    budgets.admit('a', 60)
+    with pytest.raises(BudgetExhausted) as e:
+        budgets.admit('a', 60)
+    assert 190 < e.value.retry_after <= 200
+    budgets.admit('b', 60)
+    assert budgets.remaining('a') == pytest.approx(40, abs=1)
+    with pytest.raises(QueryTooExpensive):
+        budgets.admit('c', 101)
+
+def test_max_clients():
+    budgets = CostBudgets(budget=100, max_clients=2)
+    for client in 'abc':
+        budgets.admit(client, 50)
+    assert budgets.stats()['clients'] == 2
+    assert budgets.remaining('a') == 100
@@ -0,0 +1,54 @@
+import random
+
+from server.analysis import Analyzer, describe_context, describe_query, retokenize, _tokenize
+
+
+QUERY = 'MODEL: commit SELECT: (sha, author.login, SUM: additions) WHERE: sha == "a b" AND (id > 3 OR author.city != \'x\')'
+
+
+def test_retokenize():
+    random_ = random.Random(4)
+    alphabet = ' ()."\'=<abc102:,'
+    for _ in range(500):
+        text = QUERY
+        tokens = list(_tokenize(text))
+        for _ in range(3):
+            start = random_.randrange(len(text) + 1)
+            end = random_.randrange(start, min(len(text), start + 5) + 1)
+            insert = ''.join(random_.choice(alphabet) for _ in range(random_.randrange(4)))
+            new_text = text[:start] + insert + text[end:]
+            tokens, _ = retokenize(text, tokens, new_text)
+            text = new_text
+            assert tokens == list(_tokenize(text))
+
+def test_session_reuse():
+    analyzer = Analyzer()
+    first = analyzer.analyze(QUERY, session='s')
+    assert first.errors == [] and first.reused_tokens == 0 and first.reused_clauses == 0
+    second = analyzer.analyze(QUERY.replace('sha ==', 'sha !='), session='s')
+    assert second.reused_clauses == 2 and second.reused_tokens == len(second.tokens) - 2
+    assert describe_query(second.query)['where']['first']['comparator'] == '!='
+    assert analyzer.analyze(QUERY).reused_clauses == 0
+
+def test_error_recovery():
+    analysis = Analyzer().analyze('MODEL: commit SELECT: (sha, author., SUM: additions WHERE: sha == "a" AND id >')
+    query = describe_query(analysis.query)
+    assert query['model'] == 'commit'
+    assert query['select'] == [{'field': 'sha'}, {'aggregator': 'SUM', 'field': 'additions'}]
+    assert query['where'] == {'comparator': '==', 'first': {'field': 'sha'}, 'second': {'value': 'a'}}
+    assert [(error.start, error.end) for error in analysis.errors] == [(35, 36), (78, 78)]
+    assert [error.message for error in Analyzer().analyze('MODEL: commit').errors] == \
+        ['The query has no SELECT: clause.']
+    assert Analyzer().analyze('MODEL: commit SELECT: (sha) MODEL: user').errors[0].message == 'Unexpected MODEL:.'
+
+def test_context():
+    analyzer = Analyzer()
+    context = analyzer.analyze('MODEL: commit SELECT: (sha, author.lo').context
+    assert (context.kind, context.model, context.path, context.prefix) == ('field', 'commit', ['author'], 'lo')
+    assert describe_context(context) == 'field inside SELECT: after `author.`'
+    context = analyzer.analyze('MODEL: commit SELECT: (sha) WHERE: author.city == "Lo').context
+    assert (context.kind, context.field, context.prefix) == ('value', ['author', 'city'], '"Lo')
+    assert analyzer.analyze('MODEL: commit SELECT: (sha) ').context.commands == \
+        ['GROUPBY:', 'ORDERBY:', 'WHERE:', 'SAMPLE:']
+    analysis = analyzer.analyze('MODEL: commit SELECT: (sha) SAMPLE: 0.5 BERNOULLI SEED 3')
+    assert describe_query(analysis.query)['sample'] == {'percentage': 0.5, 'method': 'BERNOULLI', 'seed': 3}
@@ -0,0 +1,62 @@
+from datetime import datetime
+
+from peewee import SqliteDatabase
+
+from benchmarks import dataset
+from server.models import Comment, Commit, User, mr
+from server.query.builder import QueryBuilder
+from server.query.cache import CompiledQueryCache
+from server.query.result import generate_result_objects
+
+
+def generate():
+    database = SqliteDatabase(':memory:')
+    # The columns of the existing tables can contain NULL although the fields are declared as not null.
+    nullable = [Comment.author, Commit.created_at, User.city]
+    for field in nullable:
+        field.null = True
+    try:
+        dataset.bind(database)
+    finally:
+        for field in nullable:
+            field.null = False
+    dataset.generate(database, scale=0.1)
+    Comment.update(author=None).where(Comment.id.in_(range(3, 101, 3))).execute()
+    Commit.update(created_at=None).where(Commit.id.in_(range(5, 201, 5))).execute()
+    User.update(city=None).where(User.id.in_(range(2, 21, 2))).execute()
+
+
+def assert_same_results(cql_query):
+    query, query_tree = QueryBuilder(mr)(cql_query)
+    expected = generate_result_objects(query, query_tree)
+    compiled = CompiledQueryCache(mr)(cql_query)
+    assembler = compiled.assembler
+    assert expected and assembler.assemble(assembler.execute(compiled.query)) == expected
+    return expected
+
+
+def test_nested_selections():
+    generate()
+    result = assert_same_results('MODEL: comment SELECT: (body, line, commit.sha, commit.author.login, '
+                                 'commit.committer.city, commit.projects.name, commit.projects.owner.login)')
+    assert all(obj['commit']['projects'] and obj['commit']['projects'][0]['owner'] for obj in result)
+    assert_same_results('MODEL: project SELECT: (name, owner.login, commits.sha, commits.comments.body, '
+                        'commits.comments.author.login, forks(depth<=2).name)')
+
+def test_converted_fields():
+    generate()
+    result = assert_same_results('MODEL: commit SELECT: (sha, created_at, author.created_at, comments.created_at)')
+    assert all(isinstance(obj['author']['created_at'], datetime) for obj in result)
+    assert {type(obj['created_at']) for obj in result} == {datetime, type(None)}
+    assert all(isinstance(comment['created_at'], datetime) for obj in result for comment in obj['comments'])
+    result = assert_same_results('MODEL: user SELECT: (login, city) ORDERBY: (city)')
+    assert result[-1]['city'] is None and result[0]['city'] is not None
+
+def test_null_relations():
+    generate()
+    result = assert_same_results('MODEL: commit SELECT: (sha, comments.line, comments.author.login)')
+    authors = [comment['author'] for obj in result for comment in obj['comments']]
+    assert None in authors and any(author is not None for author in authors)
+    # Inner joins of n:1 relations drop the rows without a related object.
+    result = assert_same_results('MODEL: comment SELECT: (line, author.login)')
+    assert len(result) == Comment.select().where(Comment.author.is_null(False)).count()
@@ -0,0 +1,33 @@
+from peewee import SqliteDatabase
+
+from benchmarks import dataset
+from benchmarks.suite import STAGES, compare
+from server.models import Commit, CommitRelationship, Project
+
+
+def generate(seed):
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    tables = dataset.generate(database, scale=0.05, seed=seed)
+    return tables, [commit.sha for commit in Commit.select().order_by(Commit.id)]
+
+
+def test_dataset_is_seeded():
+    tables, shas = generate(1)
+    assert tables['commits'] == 100 and tables['users'] == 10
+    assert generate(1) == (tables, shas)
+    assert generate(2)[1] != shas
+    # Parents are always older than their children, so the commits form a DAG.
+    assert not CommitRelationship.select().where(CommitRelationship.parent >= CommitRelationship.child).exists()
+    assert Project.select().where(Project.forked_from == Project.id).count() >= 1
+
+def test_compare():
+    def results(seconds, count=10):
+        return {'scale': 1, 'seed': 0, 'queries': {'q': dict({'results': count}, **{s: seconds for s in STAGES})}}
+
+    assert compare(results(0.0019), results(0.001)) == []
+    assert len(compare(results(0.0021), results(0.001))) == len(STAGES)
+    # Differences below the minimum difference are noise.
+    assert compare(results(0.00003), results(0.00001)) == []
+    assert compare(results(0.001, count=9), results(0.001)) == ['q: 9 results instead of 10']
+    assert len(compare(dict(results(0.001), seed=1), results(0.001))) == 1
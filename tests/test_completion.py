@@ -0,0 +1,46 @@
+from peewee import SqliteDatabase
+
+from benchmarks import dataset
+from server.completion import Completer, PrefixIndex
+from server.models import Project, User, mr
+
+
+def texts(result):
+    return [completion['text'] for completion in result['completions']]
+
+
+def test_prefix_index():
+    index = PrefixIndex({'abc': 1, 'abd': 3, 'b': 5, 'abe': 3, 'a': 2}, size=2, precomputed_length=1)
+    assert index.complete('', limit=2) == ['b', 'abd']
+    assert index.complete('a', limit=2) == ['abd', 'abe']
+    assert index.complete('ab', limit=5) == ['abd', 'abe', 'abc']
+    assert index.complete('x') == [] and index.complete('abcd') == []
+
+def test_complete_paths():
+    completer = Completer(mr)
+    assert texts(completer.complete('MO')) == ['MODEL:']
+    assert texts(completer.complete('MODEL: co')) == ['comment', 'commit']
+    assert texts(completer.complete('MODEL: commit S')) == ['SELECT:']
+    result = completer.complete('MODEL: commit SELECT: (sha, author.lo')
+    assert (result['start'], result['end']) == (35, 37) and texts(result) == ['location', 'login']
+    assert texts(completer.complete('MODEL: commit SELECT: (sha, an')) == ['ancestors']
+    assert texts(completer.complete('MODEL: commit SELECT: (sha, parents.parents.author.comm'))[0] == 'comments'
+    assert texts(completer.complete('MODEL: commit SELECT: (sha) ')) == ['GROUPBY:', 'ORDERBY:', 'WHERE:', 'SAMPLE:']
+    assert texts(completer.complete('MODEL: commit SELECT: (sha) WHERE: sha == "a" ')) == \
+        ['AND', 'OR', 'XOR', 'SAMPLE:']
+    assert texts(completer.complete('MODEL: commit SELECT: (sha) WHERE: sha == "a" AND pro')) == ['projects']
+    result = completer.complete('MODEL: commit SELECT: (sh) WHERE: sha == "a"', offset=25)
+    assert (result['start'], result['end']) == (23, 25) and texts(result) == ['sha']
+    assert texts(completer.complete('MODEL: commit SELECT: (sha) WHERE: sha = ')) == []
+
+def test_complete_values():
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    completer = Completer(mr, value_fields=[(User, 'city'), (Project, 'name')])
+    assert texts(completer.complete('MODEL: commit SELECT: (sha) WHERE: author.city == "Lo')) == []
+    completer.load_values()
+    result = completer.complete('MODEL: commit SELECT: (sha) WHERE: author.city == "Lo')
+    assert result['start'] == 50 and texts(result) == ['"London"']
+    assert texts(completer.complete("MODEL: user SELECT: (login) WHERE: city == 'Pots")) == ["'Potsdam'"]
+    assert '"project0"' in texts(completer.complete('MODEL: commit SELECT: (sha) WHERE: projects.name == '))
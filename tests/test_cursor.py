@@ -0,0 +1,72 @@
+from datetime import datetime
+
+import pytest
+from peewee import SqliteDatabase
+
+from benchmarks import dataset
+from server.cursor import decode_cursor, encode_cursor, paginate, seek, split_page
+from server.models import User, mr
+from server.query.cache import CompiledQueryCache
+
+
+def test_cursor_tokens():
+    values = [3, 'a b', None, 1.5, datetime(2019, 1, 2, 3, 4, 5)]
+    token = encode_cursor(values)
+    assert '=' not in token and '+' not in token and '/' not in token
+    assert decode_cursor(token) == [3, 'a b', None, 1.5, '2019-01-02 03:04:05']
+    with pytest.raises(TypeError):
+        encode_cursor([object()])
+    # Tampered tokens, tokens of other data and tokens which are no base64 at all.
+    for token in [token[:-3], token[1:], encode_cursor([1])[:-1] + '!', 'eyJhIjoxfQ', 'bm90IGpzb24', '%%%', '']:
+        with pytest.raises(ValueError):
+            decode_cursor(token)
+
+def test_seek_checks_the_cursor():
+    keys = [User.city, User.id]
+    for values in [[1], ['Berlin', 1, 2], ['Berlin', None]]:
+        with pytest.raises(ValueError):
+            seek(User.select(), keys, encode_cursor(values))
+
+def test_paginate():
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    query = User.select().order_by(User.id)
+    # One more row than the page size shows whether there is another page.
+    assert len(list(paginate(query, [User.id], limit=4))) == 5
+    rows, cursor = split_page(paginate(query, [User.id], limit=4), 4, lambda user: [user.id])
+    assert [user.id for user in rows] == [1, 2, 3, 4] and decode_cursor(cursor) == [4]
+    rows, cursor = split_page(paginate(query, [User.id], cursor, limit=6), 6, lambda user: [user.id])
+    assert [user.id for user in rows] == [5, 6, 7, 8, 9, 10] and cursor is None
+    assert split_page([], 4, lambda user: [user.id]) == ([], None)
+
+def test_pages_of_nullable_keys():
+    database = SqliteDatabase(':memory:')
+    # The columns of the existing tables can contain NULL although the fields are declared as not null.
+    User.city.null = User.company.null = True
+    try:
+        dataset.bind(database)
+    finally:
+        User.city.null = User.company.null = False
+    dataset.generate(database, scale=0.1)
+    User.update(city=None).where(User.id.in_(range(3, 21, 3))).execute()
+    User.update(company=None).where(User.id.in_(range(4, 21, 4))).execute()
+
+    for text in ['MODEL: user SELECT: (id, city) ORDERBY: (city)',
+                 'MODEL: user SELECT: (id, city, company) ORDERBY: (company, city)']:
+        compiled = CompiledQueryCache(mr)(text)
+        assembler = compiled.assembler
+        expected = [row['id'] for row in assembler.assemble(assembler.execute(compiled.query))]
+        assert len(expected) == 20
+
+        ids = []
+        cursor = None
+        while True:
+            query = paginate(compiled.query, compiled.page_keys, cursor, limit=3)
+            rows, cursor = split_page(assembler.execute(query), 3, assembler.page_values)
+            ids.extend(row['id'] for row in assembler.assemble(rows))
+            if cursor is None:
+                break
+        assert ids == expected
+        # NULL comes last.
+        assert User.get_by_id(ids[-1]).city is None
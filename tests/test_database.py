@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+from playhouse.pool import MaxConnectionsExceeded
+
+from benchmarks import dataset
+from server.database import CountingSqliteDatabase, iterate
+from server.models import User
+
+
+def pool(tmp_path, **kwargs):
+    database = CountingSqliteDatabase(str(tmp_path / 'pool.db'), check_same_thread=False, **kwargs)
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    database.close()
+    return database
+
+
+def test_connection_is_returned_when_the_view_raises(tmp_path):
+    database = pool(tmp_path, max_connections=2)
+    with pytest.raises(RuntimeError):
+        with database.request_connection():
+            User.get_by_id(1)
+            raise RuntimeError('view failed')
+    assert database.is_closed()
+    stats = database.pool_stats()
+    assert (stats['in_use'], stats['idle']) == (0, 1)
+
+    # A connection which broke during the request is discarded instead of being returned.
+    with pytest.raises(RuntimeError):
+        with database.request_connection():
+            database.connection().close()
+            raise RuntimeError('connection lost')
+    stats = database.pool_stats()
+    assert (stats['in_use'], stats['idle']) == (0, 0)
+    with database.request_connection():
+        assert User.select().count() == 10
+
+def test_pool_timeout(tmp_path):
+    database = pool(tmp_path, max_connections=1, timeout=0.05)
+    checked_out = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with database.request_connection():
+            checked_out.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    checked_out.wait()
+    try:
+        with pytest.raises(MaxConnectionsExceeded):
+            with database.request_connection():
+                pass
+    finally:
+        release.set()
+        thread.join()
+    stats = database.pool_stats()
+    assert (stats['waits'], stats['timeouts'], stats['in_use']) == (1, 1, 0)
+    with database.request_connection():
+        assert User.select().count() == 10
+
+def test_count_statements(tmp_path):
+    database = pool(tmp_path)
+    with database.request_connection(), database.count_statements() as outer:
+        User.get_by_id(1)
+        with database.count_statements() as inner:
+            assert len(list(iterate(User.select()))) == 10
+    assert (outer.count, inner.count) == (2, 1)
@@ -0,0 +1,44 @@
+import asyncio
+import threading
+
+import pytest
+
+from server.executor import BoundedExecutor, ExecutorSaturated
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_run():
+    executor = BoundedExecutor(max_workers=2, max_queue=2)
+    assert _run(executor.run(lambda a, b: threading.current_thread().name + a + b, '-', b='x')).startswith('db-worker')
+    with pytest.raises(ZeroDivisionError):
+        _run(executor.run(lambda: 1 / 0))
+    stats = executor.stats()
+    assert stats['completed'] == 2 and stats['running'] == 0 and stats['queued'] == 0
+    executor.shutdown()
+
+def test_saturated():
+    executor = BoundedExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+
+    async def saturate():
+        running = asyncio.ensure_future(executor.run(release.wait))
+        queued = asyncio.ensure_future(executor.run(release.wait))
+        await asyncio.sleep(0.01)
+        with pytest.raises(ExecutorSaturated):
+            await executor.run(release.wait)
+        assert executor.stats()['queued'] == 1 and executor.stats()['running'] == 1
+        release.set()
+        await running
+        await queued
+
+    _run(saturate())
+    stats = executor.stats()
+    assert stats['rejected'] == 1 and stats['completed'] == 2 and stats['max_queued'] == 1
+    executor.shutdown()
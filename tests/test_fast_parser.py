@@ -0,0 +1,158 @@
+import pypeg2
+import pytest
+
+from server import fast_parser, parser
+
+
+def _dump(thing):
+    if isinstance(thing, parser.FieldName):
+        return 'field', thing.values, thing.depths
+    elif isinstance(thing, (parser.Integer, parser.String)):
+        return 'value', thing.value
+    elif isinstance(thing, parser.Aggregation):
+        return 'aggregation', thing.aggregator, _dump(thing.field)
+    elif isinstance(thing, (parser.Expression, parser.Comparision)):
+        if hasattr(thing, '_expression') and not hasattr(thing, '_helper'):
+            # pyPEG keeps a node for brackets without a following operator, the fast parser drops it.
+            return _dump(thing._expression)
+        if thing.is_comparision:
+            return 'comparision', thing.comparator, _dump(thing.first), _dump(thing.second)
+        return 'logical', thing.logical_operator, _dump(thing.first), _dump(thing.second)
+    elif isinstance(thing, parser.Where):
+        return 'where', _dump(thing.expression)
+    elif isinstance(thing, parser.Sample):
+        return 'sample', thing.percentage, thing.method, thing.seed
+    elif isinstance(thing, list):
+        return [_dump(t) for t in thing]
+    elif isinstance(thing, parser.Query):
+        return (thing.model.name, _dump(thing.select),
+                _dump(thing.group_by) if thing.group_by is not None else None,
+                _dump(thing.order_by) if thing.order_by is not None else None,
+                _dump(thing.where) if thing.where is not None else None,
+                _dump(thing.sample) if thing.sample is not None else None)
+    raise TypeError(thing)
+
+
+def _assert_same(text, thing):
+    assert _dump(fast_parser.parse(text, thing)) == _dump(pypeg2.parse(text, thing))
+
+
+def test_tokenize():
+    tokens = fast_parser.tokenize('MODEL: commit WHERE: a.b != "x\\"y" OR c < -12')
+    assert [(t.type, t.value) for t in tokens] == [
+        ('command', 'MODEL:'), ('identifier', 'commit'), ('command', 'WHERE:'), ('identifier', 'a'),
+        ('punctuation', '.'), ('identifier', 'b'), ('comparator', '!='), ('string', '"x\\"y"'),
+        ('identifier', 'OR'), ('identifier', 'c'), ('comparator', '<'), ('integer', '-12'), ('end', ''),
+    ]
+    assert tokens[1].start == 7 and tokens[1].end == 13
+    with pytest.raises(SyntaxError):
+        fast_parser.tokenize('MODEL: commit; DROP')
+    tokens = fast_parser.tokenize('a == "x\\"y', partial=True)
+    assert tokens[-2] == ('partial_string', '"x\\"y', 5, 10)
+    with pytest.raises(SyntaxError):
+        fast_parser.tokenize('a == "x')
+
+def test_field_name():
+    assert fast_parser.parse('abc.def.ghi', parser.FieldName).values == ['abc', 'def', 'ghi']
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('abc,def', parser.FieldName)
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('abc.', parser.FieldName)
+
+def test_depth():
+    for text in ['parents(depth<=3)', 'parents(depth<=3).author.login', 'a.b(depth <= 10).c(depth<=1)']:
+        _assert_same(text, parser.FieldName)
+    assert fast_parser.parse('a.b(depth<=10).c', parser.FieldName).depths == [None, 10, None]
+    _assert_same('ancestors(depth<=2).sha == "abc" AND ancestors.id > 2', parser.Expression)
+    for text in ['parents(depth<3)', 'parents(depth<=)', 'parents(level<=3)', 'parents(depth<=3']:
+        with pytest.raises(SyntaxError):
+            fast_parser.parse(text, parser.FieldName)
+
+def test_comparision():
+    for text in ['abc == abc', 'abc <= "test string"', 'abc != 1', '\'test string\' > abc', '12 < abc',
+                 'model.abc != "test_string"']:
+        _assert_same(text, parser.Comparision)
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('1 == 2', parser.Comparision)
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('abc == 0', parser.Comparision)
+
+def test_expression():
+    for text in [
+        'test == abc',
+        '((test == abc))',
+        'test.test >= abc AND abc.test.test == abc OR abc == abc',
+        'test.test >= abc AND (abc.test.test == abc OR abc == abc)',
+        '(test.test >= abc AND abc.test.test == abc) OR abc == abc',
+        'abc.test == abc AND ((abc.test <= abc OR abc2.test2 >= abc) OR test.abc == abc)',
+        'a == 1 XOR (b == 2) AND c == "x"',
+    ]:
+        _assert_same(text, parser.Expression)
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('(a == 1', parser.Expression)
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('a == 1)', parser.Expression)
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('a == 1 AND', parser.Expression)
+
+def test_long_expression():
+    text = ' AND '.join(f'field{i} == {i + 1}' for i in range(5000))
+    expression = fast_parser.parse(text, parser.Expression)
+    for i in range(4999):
+        assert expression.logical_operator is parser.AndOperator
+        assert expression.first.first.values == [f'field{i}']
+        expression = expression.second
+    assert expression.is_comparision
+
+    text = '(' * 5000 + 'a == 1' + ')' * 5000
+    assert fast_parser.parse(text, parser.Expression).is_comparision
+
+def test_query():
+    for text in [
+        '''
+        MODEL: modelname
+        SELECT: (
+            abc,
+            field2,
+            abc.field3,
+            SUM: field.field
+            )
+        GROUPBY: (
+            field2.abc2 )
+        ORDERBY: (
+            field2 )
+        WHERE: abc <= "asfd" AND (abc.field != 2)
+        ''',
+        '''
+        MODEL: modelname
+        SELECT: (abc, MIN: field4)
+        GROUPBY: (field2.abc2)
+        WHERE: abc.abc == def OR ((abc <= "asfd") AND (abc.field != 2))
+        ''',
+        'MODEL: commit SELECT: (id, sha, children.id, children.sha, author.login) '
+        'WHERE: author.login >= \'a\' AND author.login <= \'b\'',
+        'MODEL: commit SELECT: (sha) SAMPLE: 10',
+        'MODEL: commit SELECT: (sha) WHERE: id > 3 SAMPLE: 0.5 BERNOULLI SEED 42',
+        'MODEL: commit SELECT: (sha) SAMPLE: 100',
+        'MODEL: commit SELECT: (sha) SAMPLE: 100.0 SYSTEM',
+        'MODEL: commit SELECT: (sha) SAMPLE: 0.01',
+    ]:
+        _assert_same(text, parser.Query)
+
+    query = fast_parser.parse('MODEL: commit SELECT: (sha)')
+    assert query.group_by is None and query.order_by is None and query.where is None
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('MODEL: commit')
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('MODEL: commit SELECT: (sha) WHERE: sha == "a" GROUPBY: (sha)')
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('MODEL: commit SELECT: ()')
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('MODEL: commit SELECT: (sha) SAMPLE: 10 SEED')
+    with pytest.raises(SyntaxError):
+        fast_parser.parse('MODEL: commit SELECT: (sha) SAMPLE: 10 WHERE: id > 3')
+    # Both parsers only accept percentages greater than 0 and at most 100.
+    for percentage in ['0', '0.0', '100.5', '101', '1000']:
+        for parse in [fast_parser.parse, lambda text: parser.parse(text, parser.Query)]:
+            with pytest.raises(SyntaxError):
+                parse(f'MODEL: commit SELECT: (sha) SAMPLE: {percentage}')
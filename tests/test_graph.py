@@ -0,0 +1,151 @@
+import random
+import threading
+
+from peewee import SqliteDatabase
+
+from benchmarks import dataset
+from server.graph import CSRGraph, GraphIndex, GraphSource
+from server.models import CommitRelationship, Followers
+
+
+# 1 <- 2 <- 3 <- 5, 1 <- 4 <- 5 (a merge), 6 <- 7
+EDGES = [(2, 1), (3, 2), (4, 1), (5, 3), (5, 4), (7, 6), (5, 3)]
+
+
+def random_edges(rnd, node_count, acyclic):
+    edges = set()
+    for _ in range(rnd.randint(1, 2 * node_count)):
+        source, target = rnd.randint(1, node_count), rnd.randint(1, node_count)
+        if not acyclic or source > target:
+            edges.add((source, target))
+    return edges
+
+
+def all_common_ancestors(graph, first_id, second_id, direction):
+    """The common ancestors which are no ancestors of other common ancestors, from the complete histories."""
+    common = graph._reachable([graph._index(first_id)], direction) & \
+        graph._reachable([graph._index(second_id)], direction)
+    redundant = graph._reachable([n for i in common for n in graph._neighbours(i, direction)], direction)
+    return sorted(graph.ids[i] for i in common - redundant)
+
+
+def test_csr_graph():
+    graph = CSRGraph.from_edges(EDGES)
+    assert (graph.node_count, graph.edge_count) == (7, 6)
+    assert sorted(graph.edges()) == sorted(set(EDGES))
+    assert graph.degree(5) == 2 and graph.degree(1, 'in') == 2 and graph.degree(3, 'both') == 2
+    assert 8 not in graph and graph.degree(8) == 0
+    assert graph.top_degree(1, 'in') == [(1, 2)]
+
+def test_traversals():
+    graph = CSRGraph.from_edges(EDGES)
+    assert list(graph.neighbourhood(5, hops=2).items()) == [(3, 1), (4, 1), (2, 2), (1, 2)]
+    assert list(graph.neighbourhood(5, hops=3, limit=3)) == [3, 4, 2]
+    assert graph.shortest_path(5, 1) == [5, 4, 1]
+    assert graph.shortest_path(1, 5) is None and graph.shortest_path(1, 5, 'in') == [1, 4, 5]
+    assert graph.shortest_path(5, 1, max_hops=1) is None
+    assert graph.shortest_path(5, 6, 'both') is None
+    assert graph.common_ancestors(3, 4) == [1]
+    assert graph.common_ancestors(5, 3) == [3]
+    assert graph.common_ancestors(5, 7) == []
+
+def test_common_ancestors():
+    rnd = random.Random(3)
+    for _ in range(200):
+        graph = CSRGraph.from_edges(random_edges(rnd, rnd.randint(2, 40), acyclic=rnd.random() < 0.7) or EDGES)
+        for direction in ['out', 'in', 'both']:
+            for _ in range(10):
+                first_id, second_id = rnd.choice(graph.ids), rnd.choice(graph.ids)
+                assert graph.common_ancestors(first_id, second_id, direction) == \
+                    all_common_ancestors(graph, first_id, second_id, direction)
+
+def test_generations():
+    graph = CSRGraph.from_edges(EDGES)
+    assert list(graph.generations()) == [1, 2, 3, 2, 4, 1, 2]
+    assert list(graph.generations('in')) == [4, 3, 2, 2, 1, 2, 1]
+    assert graph.generations('both') is None
+    assert CSRGraph.from_edges(EDGES + [(1, 5)]).generations() is None
+
+def test_with_edges():
+    rnd = random.Random(5)
+    for _ in range(200):
+        node_count = rnd.randint(2, 40)
+        acyclic = rnd.random() < 0.7
+        edges = random_edges(rnd, node_count, acyclic) or {(2, 1)}
+        graph = CSRGraph.from_edges(edges)
+        graph.generations('out')
+        graph.generations('in')
+        new_edges = random_edges(rnd, node_count + 10, acyclic)
+        if rnd.random() < 0.5:
+            # Only new nodes, which extend the arrays.
+            new_edges = {(source, target) for source, target in new_edges if source > max(graph.ids)}
+        extended = graph.with_edges(new_edges, 5)
+        expected = CSRGraph.from_edges(edges | new_edges)
+        for name in ['ids', 'offsets', 'targets', 'reverse_offsets', 'reverse_targets']:
+            assert list(getattr(extended, name)) == list(getattr(expected, name))
+        for direction in ['out', 'in']:
+            generations, expected_generations = extended.generations(direction), expected.generations(direction)
+            assert (generations is None and expected_generations is None) or \
+                list(generations) == list(expected_generations)
+
+def test_snapshot(tmp_path):
+    graph = CSRGraph.from_edges(EDGES, watermark=7)
+    graph.save(str(tmp_path / 'graph.csr'))
+    loaded = CSRGraph.load(str(tmp_path / 'graph.csr'))
+    assert loaded.watermark == 7 and sorted(loaded.edges()) == sorted(graph.edges())
+    assert loaded.shortest_path(5, 1) == [5, 4, 1] and loaded.top_degree(1, 'in') == [(1, 2)]
+    assert sorted(loaded.with_edges([(8, 7)], 8).edges()) == sorted(set(EDGES) | {(8, 7)})
+
+def test_graph_index(tmp_path):
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    graph_index = GraphIndex({
+        'commits': GraphSource(CommitRelationship.child, CommitRelationship.parent, incremental=True),
+        'followers': GraphSource(Followers.follower, Followers.user, incremental=False),
+    }, snapshot_dir=str(tmp_path))
+    commits = graph_index.get('commits')
+    assert commits.edge_count == CommitRelationship.select().count()
+    assert commits.watermark == 100 and (tmp_path / 'commits.csr').exists()
+
+    CommitRelationship.insert(parent=100, child=101).execute()
+    assert graph_index.get('commits') is commits
+    assert graph_index.invalidate({'commit_parents'}) == ['commits']
+    refreshed = graph_index.get('commits')
+    assert refreshed.edge_count == commits.edge_count + 1 and refreshed.shortest_path(101, 100) == [101, 100]
+    assert graph_index.stats()['refreshes'] == 1
+
+    # A new index starts from the snapshot and only loads newer edges.
+    graph_index = GraphIndex(graph_index.sources, snapshot_dir=str(tmp_path))
+    assert graph_index.get('commits').edge_count == refreshed.edge_count and graph_index.stats()['loads'] == 0
+
+def test_graph_index_refresh_keeps_the_old_graph(tmp_path):
+    # The refresh reads the table in another thread, so it needs a database which is not private to a connection.
+    database = SqliteDatabase(str(tmp_path / 'graph.db'), check_same_thread=False)
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    graph_index = GraphIndex({
+        'commits': GraphSource(CommitRelationship.child, CommitRelationship.parent, incremental=True),
+    })
+    commits = graph_index.get('commits')
+    CommitRelationship.insert(parent=100, child=101).execute()
+    graph_index.invalidate()
+
+    reading, release = threading.Event(), threading.Event()
+    read_edges = graph_index._read_edges
+
+    def blocked_read_edges(*args, **kwargs):
+        reading.set()
+        release.wait(5)
+        return read_edges(*args, **kwargs)
+
+    graph_index._read_edges = blocked_read_edges
+    refreshed = []
+    refresh = threading.Thread(target=lambda: refreshed.append(graph_index.get('commits')))
+    refresh.start()
+    assert reading.wait(5)
+    # The graph is served while it is refreshed, the stats do not wait either.
+    assert graph_index.get('commits') is commits and graph_index.stats()['refreshes'] == 1
+    release.set()
+    refresh.join(5)
+    assert refreshed[0].edge_count == commits.edge_count + 1 and graph_index.get('commits') is refreshed[0]
@@ -0,0 +1,86 @@
+import pytest
+from peewee import SqliteDatabase
+
+from benchmarks import dataset
+from server.cursor import decode_cursor
+from server.loader import RelationLoader
+from server.models import Commit, Followers, Project, ProjectCommitRelationship, User, mr
+
+
+def generate():
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.2)
+
+
+def test_parse_expand():
+    loader = RelationLoader(mr)
+    assert loader.parse_expand(Commit) == {name: {} for name in mr.relations(Commit)}
+    assert loader.parse_expand(Project, ' commits.author , commits.projects,owner,, ') == \
+        {'commits': {'author': {}, 'projects': {}}, 'owner': {}}
+    assert loader.parse_expand(Project, 'owner.*') == {'owner': {name: {} for name in mr.relations(User)}}
+    assert loader.parse_expand(Project, '') == {}
+    for expand in ['owner.nothing', 'login', '*.owner', 'commits.author.projects.owner']:
+        with pytest.raises(ValueError):
+            loader.parse_expand(Project, expand)
+
+def test_clamp_limit():
+    loader = RelationLoader(mr, limit=20, max_limit=100)
+    assert [loader.clamp_limit(limit) for limit in [None, '5', '0', '-3', 1000]] == [20, 5, 1, 1, 100]
+    with pytest.raises(ValueError):
+        loader.clamp_limit('many')
+
+def test_load():
+    generate()
+    loader = RelationLoader(mr)
+    project = Project.get_by_id(2)
+    result = loader.load(Project, 2, loader.parse_expand(Project, 'owner,commits.author,members'), limit=5)
+    assert result['name'] == project.name and result['owner']['login'] == project.owner.login
+    assert 'owner' not in result['_relations']
+    commit_ids = [relation.commit_id for relation in project.commits.order_by(ProjectCommitRelationship.commit)]
+    assert [commit['id'] for commit in result['commits']] == commit_ids[:5]
+    assert all(commit['author']['id'] == Commit.get_by_id(commit['id']).author_id for commit in result['commits'])
+    assert result['_relations']['commits']['count'] == len(commit_ids)
+    assert decode_cursor(result['_relations']['commits']['cursor']) == [commit_ids[4]]
+    members = result['_relations']['members']
+    assert members['count'] == len(result['members']) <= 5 and members['cursor'] is None
+
+    with pytest.raises(Project.DoesNotExist):
+        loader.load(Project, 1000)
+
+def test_lists_are_capped_per_parent():
+    generate()
+    loader = RelationLoader(mr)
+    result = loader.load(User, 1, loader.parse_expand(User, 'follows.follows'), limit=3)
+    follows = {user.id: [followed.user_id for followed in Followers.select().where(Followers.follower == user.id)
+                         .order_by(Followers.user)] for user in User.select()}
+    assert [user['id'] for user in result['follows']] == follows[1][:3]
+    for user in result['follows']:
+        assert [followed['id'] for followed in user['follows']] == follows[user['id']][:3]
+        relation = user['_relations']['follows']
+        assert relation['count'] == len(follows[user['id']])
+        assert (relation['cursor'] is not None) == (relation['count'] > 3)
+    # Parents without related objects have empty lists.
+    lonely = next(user_id for user_id, followed in follows.items() if not followed)
+    result = loader.load(User, lonely, loader.parse_expand(User, 'follows'), limit=3)
+    assert result['follows'] == [] and result['_relations']['follows'] == {'count': 0, 'cursor': None}
+
+def test_load_page_continues_the_list():
+    generate()
+    loader = RelationLoader(mr)
+    result = loader.load(Project, 1, loader.parse_expand(Project, 'commits'), limit=10)
+    ids = [commit['id'] for commit in result['commits']]
+    cursor = result['_relations']['commits']['cursor']
+    while cursor is not None:
+        page = loader.load_page(Project, 1, 'commits', cursor, limit=25)
+        assert len(page['items']) <= 25
+        ids.extend(commit['id'] for commit in page['items'])
+        cursor = page['cursor']
+    assert ids == [relation.commit_id for relation in ProjectCommitRelationship.select()
+                   .where(ProjectCommitRelationship.project == 1).order_by(ProjectCommitRelationship.commit)]
+    assert loader.load_page(Project, 1000, 'commits') == {'items': [], 'cursor': None}
+    for relation_name in ['owner', 'nothing']:
+        with pytest.raises(ValueError):
+            loader.load_page(Project, 1, relation_name)
+    with pytest.raises(ValueError):
+        loader.load_page(Project, 1, 'commits', 'tampered')
@@ -0,0 +1,45 @@
+from server import metrics
+
+
+def test_stages():
+    with metrics.stage('outside'):
+        pass
+    with metrics.track_request() as request_metrics:
+        with metrics.stage('parse'):
+            pass
+        metrics.add_time('sql', 0.001)
+        metrics.add_time('sql', 0.002)
+        metrics.add_rows(3)
+    assert metrics.current() is None
+    assert list(request_metrics.stages) == ['parse', 'sql'] and request_metrics.rows == 3
+    assert request_metrics.server_timing().endswith('sql;dur=3.000')
+
+def test_merge():
+    request_metrics = metrics.RequestMetrics()
+    request_metrics.add_time('sql', 0.001)
+    with metrics.track_request() as worker_metrics:
+        metrics.add_statement('SELECT 1', None, 0.0, 0.002)
+        metrics.add_rows(2)
+    request_metrics.merge(worker_metrics)
+    assert request_metrics.stages['sql'] == 0.003 and request_metrics.rows == 2
+    assert [statement.sql for statement in request_metrics.statements] == ['SELECT 1']
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.counter('rows_total', 'Rows.', ['endpoint'])
+    histogram = registry.histogram('duration_seconds', 'Duration.', ['endpoint'], buckets=(0.1, 1.0))
+    counter.inc(2, endpoint='query')
+    histogram.observe(0.1, endpoint='query')
+    histogram.observe(5, endpoint='query')
+    assert registry.render().splitlines() == [
+        '# HELP rows_total Rows.',
+        '# TYPE rows_total counter',
+        'rows_total{endpoint="query"} 2',
+        '# HELP duration_seconds Duration.',
+        '# TYPE duration_seconds histogram',
+        'duration_seconds_bucket{endpoint="query",le="0.1"} 1',
+        'duration_seconds_bucket{endpoint="query",le="1.0"} 1',
+        'duration_seconds_bucket{endpoint="query",le="+Inf"} 2',
+        'duration_seconds_sum{endpoint="query"} 5.1',
+        'duration_seconds_count{endpoint="query"} 2',
+    ]
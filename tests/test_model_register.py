@@ -0,0 +1,71 @@
+import peewee
+from peewee import SqliteDatabase
+
+from benchmarks import dataset
+from server.model_register import ModelType
+from server.models import mr
+
+
+def derived_relations(model):
+    """The relations of a model as `(kind, target, foreign key)` by name, derived from the fields and backrefs of
+    the model like before the relation index."""
+    relations = {}
+    for field_name, field in model._meta.fields.items():
+        if isinstance(field, peewee.ForeignKeyField):
+            relations[field_name] = ('n:1', field.rel_model, field)
+    for backref, backref_model in model._meta.backrefs.items():
+        if backref_model._type is ModelType.MODEL:
+            relations[backref.backref] = ('1:n', backref_model, backref)
+        elif backref_model._type is ModelType.NM_RELATION:
+            relations[backref.backref] = ('n:m', backref_model._other_field(backref).rel_model, backref)
+    return relations
+
+
+def derived_query_dict(query, depth=0):
+    """`ModelRegister.query_dict` before the relation index."""
+    model = mr[query._meta.model._name]
+    result = {}
+    for field_name, field in model._meta.fields.items():
+        if not isinstance(field, peewee.ForeignKeyField):
+            result[field_name] = query.__data__.get(field_name)
+    if depth > 0:
+        for field_name, field in model._meta.fields.items():
+            if not isinstance(field, peewee.ForeignKeyField):
+                continue
+            if query.__data__.get(field_name):
+                result[field_name] = derived_query_dict(getattr(query, field_name), depth - 1)
+            else:
+                result[field_name] = None
+        for backref, backref_model in model._meta.backrefs.items():
+            if backref_model._type is ModelType.MODEL:
+                result[backref.backref] = [derived_query_dict(related, depth - 1)
+                                           for related in getattr(query, backref.backref)]
+            elif backref_model._type is ModelType.NM_RELATION:
+                other_field = backref_model._other_field(backref).name
+                result[backref.backref] = [derived_query_dict(getattr(related, other_field), depth - 1)
+                                           for related in getattr(query, backref.backref)]
+    return result
+
+
+def test_relations():
+    for model in mr.values():
+        relations = mr.relations(model)
+        assert {name: (relation.kind, relation.target, relation.field) for name, relation in relations.items()} \
+            == derived_relations(model)
+        assert all(relation.name == name and relation.model is model for name, relation in relations.items())
+        assert all(mr.relation(model, name) is relation for name, relation in relations.items())
+        assert list(mr.fields(model)) == [name for name, field in model._meta.fields.items()
+                                          if not isinstance(field, peewee.ForeignKeyField)]
+    commits = mr.relation(mr['project'], 'commits')
+    assert (commits.join_model._name, commits.shadow_name) == ('project_commit_relationship', 'commit')
+    assert mr.relation(mr['project'], 'owner').join_model is None and mr.relation(mr['project'], 'nothing') is None
+
+def test_query_dict():
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    for model in mr.values():
+        objects = list(model.select().order_by(model._meta.primary_key).limit(2))
+        assert objects
+        for depth in range(3):
+            assert [mr.query_dict(obj, depth) for obj in objects] == [derived_query_dict(obj, depth) for obj in objects]
@@ -0,0 +1,45 @@
+import gzip
+import json
+
+import responder
+
+from server.precomputed import PrecomputedBody
+
+
+def test_precomputed_body():
+    body = PrecomputedBody('{"a": 1}', max_age=60)
+    assert gzip.decompress(body.gzipped) == b'{"a": 1}'
+    assert body.etag != PrecomputedBody('{"a": 2}').etag
+    assert body.cache_control == 'public, max-age=60'
+
+def test_not_modified():
+    body = PrecomputedBody('[]')
+    assert not body.not_modified(None)
+    assert not body.not_modified('"other"')
+    assert body.not_modified(body.etag)
+    assert body.not_modified(body.gzip_etag)
+    assert body.not_modified(f'"other", W/{body.etag}')
+    assert body.not_modified('*')
+
+def test_respond():
+    api = responder.API()
+    bodies = {'small': PrecomputedBody('[1]'), 'large': PrecomputedBody(json.dumps(list(range(1000))))}
+
+    @api.route('/{name}')
+    def view(req, resp, name):
+        bodies[name].respond(req, resp)
+
+    for name, body in bodies.items():
+        for encoding in ['gzip', 'identity']:
+            response = api.requests.get(f'/{name}', headers={'Accept-Encoding': encoding})
+            # Compressed once, by the body or the middleware, and Vary is not repeated.
+            assert response.content == body.content
+            assert response.headers.get_list('Vary') in ([], ['Accept-Encoding'])
+            if encoding == 'gzip':
+                assert response.headers['Content-Encoding'] == 'gzip' and response.headers['ETag'] == body.gzip_etag
+                assert response.headers['Vary'] == 'Accept-Encoding'
+            else:
+                assert 'Content-Encoding' not in response.headers and response.headers['ETag'] == body.etag
+            response = api.requests.get(f'/{name}', headers={'Accept-Encoding': encoding,
+                                                             'If-None-Match': response.headers['ETag']})
+            assert response.status_code == 304 and response.content == b''
@@ -0,0 +1,153 @@
+import pytest
+from peewee import PostgresqlDatabase, SqliteDatabase, fn
+
+from benchmarks import dataset
+from server.models import Comment, Commit, CommitRelationship, Project, ProjectCommitRelationship, mr
+from server.query.builder import QueryBuilder
+from server.query import recursion
+from server.query.cache import CompiledQueryCache, normalize_cql
+
+
+def build(cql_query):
+    query, query_tree = QueryBuilder(mr)(cql_query)
+    return query.sql()[0], query_tree
+
+
+def test_filter_only_relations_are_semi_joined():
+    sql, query_tree = build("MODEL: commit SELECT: (sha) WHERE: projects.name == 'a' AND comments.body == 'b'")
+    assert sql.count('EXISTS') == 2 and ' JOIN "project_commits"' not in sql.split('WHERE')[0]
+    assert all(node.semi_join for node in query_tree.root.children)
+
+def test_ordered_and_n_1_relations_are_joined():
+    sql, query_tree = build("MODEL: commit SELECT: (sha, projects.name) ORDERBY: (projects.name) WHERE: "
+                            "projects.name == 'a' AND author.login == 'b'")
+    assert 'EXISTS' not in sql
+    assert not any(node.semi_join for node in query_tree.root.children)
+
+def test_selected_relations_are_not_joined():
+    sql, query_tree = build('MODEL: project SELECT: (name, owner.login, commits.sha, members.login, issues.id)')
+    assert sql.count('EXISTS') == 3 and sql.split('WHERE')[0].count('JOIN') == 1
+    assert [node.name for node in query_tree.root.children if node.semi_join] == ['commits', 'members', 'issues']
+
+def test_selected_relations_share_a_subquery_with_their_conditions():
+    sql, _ = build("MODEL: commit SELECT: (sha, projects.name, comments.body) WHERE: projects.name == 'a'")
+    assert sql.count('EXISTS') == 2 and sql.count('"project_commits"') == 1
+
+def test_conditions_on_the_same_relation_share_a_subquery():
+    sql, _ = build("MODEL: commit SELECT: (sha) WHERE: projects.name == 'a' AND sha != 'b' AND projects.url == 'c' "
+                   "AND comments.line >= 2")
+    assert sql.count('EXISTS') == 2 and sql.count('"project_commits"') == 1
+
+def test_invalid_queries_are_not_served_from_the_cache():
+    cache = CompiledQueryCache(mr)
+    cache('MODEL: commit SELECT: (sha) WHERE: id >= 3')
+    for text in ['MODEL : commit SELECT: (sha) WHERE: id >= 3', 'MODEL: commit SELECT: (sha) WHERE: id > = 3']:
+        assert normalize_cql(text) != normalize_cql('MODEL: commit SELECT: (sha) WHERE: id >= 3')
+        with pytest.raises(SyntaxError):
+            cache(text)
+
+def test_semi_join_results():
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    query, _ = QueryBuilder(mr)("MODEL: commit SELECT: (sha) WHERE: projects.name == 'project0' OR "
+                                "comments.line >= 250")
+    expected = {relation.commit_id for relation in ProjectCommitRelationship.select().where(
+                    ProjectCommitRelationship.project == 1)} & {comment.commit_id for comment in Comment.select()}
+    expected |= {comment.commit_id for comment in Comment.select().where(Comment.line >= 250)} & \
+        {relation.commit_id for relation in ProjectCommitRelationship.select()}
+    ids = [row.id for row in query.select(Commit.id)]
+    assert len(ids) == len(set(ids))
+    assert set(ids) == expected
+
+def test_sibling_relations_do_not_multiply_rows():
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    compiled = CompiledQueryCache(mr)('MODEL: project SELECT: (name, commits.sha, members.login, issues.id)')
+    assembler = compiled.assembler
+    result = assembler.assemble(assembler.execute(compiled.query))
+    names = [obj['name'] for obj in result]
+    assert len(names) == len(set(names))
+    project = Project.get(Project.name == names[0])
+    assert len(result[0]['commits']) == project.commits.count()
+    assert len(result[0]['members']) == project.members.count()
+
+def test_recursive_relations():
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    parents = {}
+    for relation in CommitRelationship.select():
+        parents.setdefault(relation.commit_id, set()).add(relation.parent_id)
+
+    def ancestors(commit_id, depth):
+        found, frontier = set(), {commit_id}
+        for _ in range(depth):
+            frontier = {parent for child in frontier for parent in parents.get(child, ())}
+            found |= frontier
+        return found
+
+    compiled = CompiledQueryCache(mr)('MODEL: commit SELECT: (id, ancestors(depth<=5).id, ancestors(depth<=5).sha)')
+    assembler = compiled.assembler
+    result = assembler.assemble(assembler.execute(compiled.query))
+    assert result and all({obj['id'] for obj in row['ancestors']} == ancestors(row['id'], 5) for row in result)
+
+    query, _ = QueryBuilder(mr)('MODEL: commit SELECT: (id) WHERE: ancestors.id == 1')
+    assert {row.id for row in query} == {commit_id for commit_id in parents if 1 in ancestors(commit_id, 100)}
+
+def test_recursive_relations_visit_models_once():
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    # A cycle through the whole history, and a project which is its own fork.
+    last = Commit.select(fn.MAX(Commit.id)).scalar()
+    CommitRelationship.insert(child=1, parent=last).execute()
+    Project.update(forked_from=Project.id).where(Project.id == 1).execute()
+    parents = {}
+    for relation in CommitRelationship.select():
+        parents.setdefault(relation.commit_id, set()).add(relation.parent_id)
+
+    steps, frontier = {}, {last}
+    for depth in range(1, recursion.MAX_DEPTH + 1):
+        frontier = {parent for child in frontier for parent in parents.get(child, ()) if parent not in steps}
+        steps.update(dict.fromkeys(frontier, depth))
+    relation = mr.recursive_relation(mr['commit'], 'ancestors')
+    cte = recursion.closure(relation, recursion.MAX_DEPTH, lambda start: start == last)
+    assert len(database.execute(cte.select_from(cte.c.id)).fetchall()) == len(steps)
+    ids = [commit.id for commit in recursion.load_closure(relation, recursion.MAX_DEPTH, [last])]
+    # Every commit once, the nearest first, although the merges reach commits along paths of different lengths.
+    assert sorted(ids) == sorted(steps) and last in ids
+    assert [steps[commit_id] for commit_id in ids] == sorted(steps.values())
+    ids = [commit.id for commit in recursion.load_closure(relation, 3, [last])]
+    assert sorted(ids) == sorted(commit_id for commit_id, depth in steps.items() if depth <= 3)
+
+    compiled = CompiledQueryCache(mr)('MODEL: project SELECT: (id, forks(depth<=1000).id) WHERE: id == 1')
+    assembler = compiled.assembler
+    result = assembler.assemble(assembler.execute(compiled.query))
+    forks = [fork['id'] for fork in result[0]['forks']]
+    assert 1 in forks and len(forks) == len(set(forks))
+
+def test_depth_requires_a_recursive_relation():
+    for text in ['MODEL: commit SELECT: (author(depth<=2).login)', 'MODEL: commit SELECT: (sha(depth<=2))',
+                 'MODEL: commit SELECT: (parents(depth<=1001).sha)',
+                 'MODEL: commit SELECT: (parents(depth<=2).sha, parents.id)']:
+        with pytest.raises(AssertionError):
+            build(text)
+    sql, query_tree = build('MODEL: project SELECT: (name, forks(depth<=3).name)')
+    assert 'WITH RECURSIVE' in sql and query_tree.root.get_child('forks').depth == 3
+
+def test_sample():
+    with PostgresqlDatabase('explorer').bind_ctx(dataset.MODELS):
+        sql, _ = build('MODEL: commit SELECT: (sha, author.login) SAMPLE: 0.5 BERNOULLI SEED 7')
+    assert 'FROM "commits" AS "t1" TABLESAMPLE BERNOULLI (%s) REPEATABLE (%s) INNER JOIN' in sql
+    for text in ['MODEL: commit SELECT: (sha) SAMPLE: 101', 'MODEL: commit SELECT: (sha) SAMPLE: 0.0']:
+        with pytest.raises(SyntaxError):
+            build(text)
+
+    # Without TABLESAMPLE the rows are sampled with a random condition.
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    compiled = CompiledQueryCache(mr)('MODEL: commit SELECT: (sha) WHERE: id > 10 SAMPLE: 50')
+    assert compiled.sample.percentage == 50 and 0 < len(list(compiled.query)) < 90
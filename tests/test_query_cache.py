@@ -0,0 +1,64 @@
+import time
+
+from server.query.cache import LRUCache, ResultCache, normalize_cql
+
+
+def test_normalize_cql():
+    assert normalize_cql('MODEL: commit SELECT: (id, sha)') == 'MODEL: commit SELECT: (id, sha)'
+    assert normalize_cql('''
+    MODEL:   commit
+    SELECT: (
+        id,
+        author.login
+        )
+    WHERE: author.login >= 'a'  AND author.login<= 'b'
+    ''') == "MODEL: commit SELECT: ( id, author.login ) WHERE: author.login >= 'a' AND author.login<= 'b'"
+
+def test_normalize_cql_keeps_strings():
+    assert normalize_cql('WHERE: a == "x  ,  y"') == 'WHERE: a == "x  ,  y"'
+    assert normalize_cql("WHERE: a == 'It''s'") == "WHERE: a == 'It''s'"
+    assert normalize_cql('WHERE: a == "Abc"') != normalize_cql('WHERE: a == "abc"')
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    assert cache.get('a') is None
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    assert cache.stats() == {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 1, 'evictions': 1}
+
+def test_result_cache_eviction():
+    cache = ResultCache(max_bytes=10)
+    cache.put('a', 'A', 4, {'commits'}, cache.versions({'commits'}))
+    cache.put('b', 'B', 4, {'users'}, cache.versions({'users'}))
+    assert cache.get('a') == 'A'
+    cache.put('c', 'C', 4, {'users'}, cache.versions({'users'}))
+    assert cache.get('b') is None and cache.get('a') == 'A' and cache.get('c') == 'C'
+    cache.put('d', 'D', 11, {'users'}, cache.versions({'users'}))
+    assert cache.get('d') is None
+    stats = cache.stats()
+    assert stats['bytes'] == 8 and stats['evictions'] == 1 and stats['hits'] == 3
+
+def test_result_cache_invalidation():
+    cache = ResultCache(max_bytes=100)
+    cache.put('a', 'A', 1, {'commits', 'users'}, cache.versions({'commits', 'users'}))
+    cache.put('b', 'B', 1, {'projects'}, cache.versions({'projects'}))
+    versions = cache.versions({'commits'})
+    assert cache.invalidate(['commits']) == 1
+    assert cache.get('a') is None and cache.get('b') == 'B'
+    # A result read before the invalidation is not stored.
+    cache.put('c', 'C', 1, {'commits'}, versions)
+    assert cache.get('c') is None
+    assert cache.invalidate() == 1
+    assert cache.stats()['size'] == 0 and cache.stats()['versions'] == {'commits': 2, 'projects': 1}
+
+def test_result_cache_ttl():
+    cache = ResultCache(max_bytes=100, ttl=0.01)
+    cache.put('a', 'A', 1, set(), ())
+    assert cache.get('a') == 'A'
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
@@ -0,0 +1,92 @@
+import peewee
+from peewee import SqliteDatabase
+
+from benchmarks import dataset
+from server.models import Project, mr
+from server.query.builder import QueryBuilder, QueryCommand
+from server.query.result import generate_result_objects, iter_result_chunks
+
+
+def lazy_result_object(query_object, query_tree_node):
+    """The result object of a row with its relations loaded lazily by peewee, row by row, like before the
+    relations were loaded in batches."""
+    result = {}
+    for field_node in query_tree_node.fields:
+        if QueryCommand.SELECT in field_node.commands:
+            result[field_node.name] = getattr(query_object, field_node.name)
+    for child_node in query_tree_node.children:
+        if QueryCommand.SELECT in child_node.commands:
+            child_object = getattr(query_object, child_node.name)
+            if isinstance(child_object, peewee.Model):
+                result[child_node.name] = lazy_result_object(child_object, child_node)
+            elif child_node.shadow_name is None:
+                result[child_node.name] = [lazy_result_object(child, child_node) for child in child_object]
+            else:
+                result[child_node.name] = [lazy_result_object(getattr(child, child_node.shadow_name), child_node)
+                                           for child in child_object]
+    return result
+
+
+def generate():
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.2)
+    # A second project of the owner of the first one, without issues, members and commits.
+    owner = Project.get_by_id(1).owner
+    Project.create(url='empty', owner=owner, name='empty', description='', forked_from=1, created_at='2020-01-01')
+    return owner.login
+
+
+def assert_same_results(cql_query):
+    query, query_tree = QueryBuilder(mr)(cql_query)
+    expected = [lazy_result_object(row, query_tree.root) for row in query.clone()]
+    assert expected and generate_result_objects(query, query_tree) == expected
+    return expected
+
+
+def projects_of(result, login):
+    return {project['name']: project for obj in result if obj['login'] == login for project in obj['projects']}
+
+
+def test_n_1_relations():
+    generate()
+    result = assert_same_results('MODEL: project SELECT: (name, owner.login, owner.city, forked_from.name, '
+                                 'forked_from.owner.login)')
+    assert result[-1]['forked_from'] == result[0]['forked_from'] and result[0]['forked_from']['name'] == 'project0'
+    # Relations of different rows to the same object are equal but not shared.
+    assert result[-1]['owner'] == result[0]['owner'] and result[-1]['owner'] is not result[0]['owner']
+
+def test_1_n_relations():
+    login = generate()
+    result = assert_same_results('MODEL: commit SELECT: (sha, comments.body, comments.line, comments.author.login)')
+    assert all(obj['comments'] for obj in result)
+    result = assert_same_results('MODEL: user SELECT: (login, authored_commits.sha, authored_commits.comments.body)')
+    commits = [commit for obj in result for commit in obj['authored_commits']]
+    assert any(commit['comments'] for commit in commits) and any(not commit['comments'] for commit in commits)
+    result = assert_same_results('MODEL: user SELECT: (login, projects.name, projects.issues.id)')
+    assert projects_of(result, login)['empty'] == {'name': 'empty', 'issues': []}
+
+def test_n_m_relations():
+    login = generate()
+    result = assert_same_results('MODEL: project SELECT: (name, members.login, commits.sha, commits.author.login)')
+    # Forks share the commits of the forked project.
+    shas = [commit['sha'] for obj in result for commit in obj['commits']]
+    assert len(set(shas)) < len(shas)
+    result = assert_same_results('MODEL: user SELECT: (login, projects.name, projects.members.login, '
+                                 'projects.commits.sha)')
+    assert projects_of(result, login)['empty'] == {'name': 'empty', 'members': [], 'commits': []}
+    result = assert_same_results('MODEL: user SELECT: (login, follows.login, follows.follows.login)')
+    follows = [followed['login'] for obj in result for followed in obj['follows']]
+    assert len(set(follows)) < len(follows)
+
+def test_no_rows():
+    generate()
+    query, query_tree = QueryBuilder(mr)('MODEL: project SELECT: (name, members.login) WHERE: id > 1000')
+    assert generate_result_objects(query, query_tree) == []
+
+def test_iter_result_chunks():
+    generate()
+    query, query_tree = QueryBuilder(mr)('MODEL: commit SELECT: (sha)')
+    chunks = list(iter_result_chunks(query, lambda rows: [row.sha for row in rows], chunk_size=150))
+    assert [len(chunk) for chunk in chunks] == [150, 150, 100]
+    assert [sha for chunk in chunks for sha in chunk] == [row.sha for row in query.clone()]
@@ -0,0 +1,61 @@
+import pytest
+from peewee import SqliteDatabase
+
+from benchmarks import dataset
+from server import fast_parser
+from server.models import Commit, User, mr
+from server.query.cache import CompiledQueryCache
+from server.statistics import Statistics
+
+
+def where(cql_query):
+    return fast_parser.parse(cql_query).where.expression
+
+
+def test_statistics(tmp_path):
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    statistics = Statistics(mr, snapshot_path=str(tmp_path / 'statistics.json'), sample_rows=50)
+    assert statistics.refresh() == list(mr.keys()) and statistics.refresh() == []
+
+    users = statistics.table('user')
+    assert users.rows == 10 and users.source == 'sample'
+    login = statistics.field('user', 'login')
+    assert (login.null_fraction, login.distinct, login.most_common) == (0.0, 10, [])
+    assert login.histogram[0] == login.min == 'user0' and login.histogram[-1] == login.max
+    city = statistics.describe('user', 'city')
+    assert city['chart'] == 'bar' and sum(frequency for _, frequency in city['most_common']) <= 1
+    # 100 commits, but only 50 of them are sampled.
+    assert statistics.table('commit').rows == 100 and statistics.field('commit', 'sha').distinct == 100
+    assert statistics.describe('commit', 'id')['chart'] == 'histogram'
+
+    assert statistics.invalidate({'users'}) == ['user'] and statistics.refresh() == ['user']
+    # A restarted server starts with the statistics of the snapshot.
+    restarted = Statistics(mr, snapshot_path=str(tmp_path / 'statistics.json'))
+    assert restarted.tables == statistics.tables and restarted.refresh() == []
+
+def test_estimate_rows():
+    database = SqliteDatabase(':memory:')
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    statistics = Statistics(mr)
+    assert statistics.estimate_rows(User) is None
+    statistics.refresh()
+    london = User.select().where(User.city == 'London').count()
+    assert statistics.estimate_rows(User, where('MODEL: user SELECT: (id) WHERE: city == "London"')) == london
+    assert statistics.estimate_rows(User, where('MODEL: user SELECT: (id) WHERE: city != "London"')) == 10 - london
+    # Values which are not common share the rest of the rows.
+    assert statistics.estimate_rows(User, where('MODEL: user SELECT: (id) WHERE: city == "Nowhere"')) <= 1
+    # Ranges are interpolated within the buckets of the histogram.
+    estimate = statistics.estimate_rows(User, where('MODEL: user SELECT: (id) WHERE: 5 >= id'))
+    assert estimate == pytest.approx(5, abs=1)
+    estimate = statistics.estimate_rows(User, where('MODEL: user SELECT: (id) WHERE: id > 2 AND id <= 7'))
+    assert estimate == pytest.approx(5, abs=1)
+    assert statistics.estimate_rows(Commit, where('MODEL: commit SELECT: (id) WHERE: author.city == "London"')) \
+        == 100 * london / 10
+    group_by = fast_parser.parse('MODEL: user SELECT: (city) GROUPBY: (city)').group_by
+    assert statistics.estimate_rows(User, group_by=group_by) == User.select(User.city).distinct().count()
+
+    compiled = CompiledQueryCache(mr, statistics=statistics)('MODEL: user SELECT: (login) WHERE: id >= 3')
+    assert compiled.estimated_rows == pytest.approx(8, abs=1)
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+from contextlib import closing
+
+import pytest
+
+from benchmarks import dataset
+from server.database import CountingSqliteDatabase, iterate
+from server.executor import BoundedExecutor, ExecutorSaturated
+from server.models import User
+from server.streaming import stream_in_thread
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def _read(body, count=None):
+    chunks = []
+    stream = body()
+    try:
+        async for chunk in stream:
+            chunks.append(chunk)
+            if len(chunks) == count:
+                break
+    finally:
+        await stream.aclose()
+    return chunks
+
+
+def _wait_until_idle(executor):
+    deadline = time.monotonic() + 5
+    while executor.stats()['running'] + executor.stats()['queued'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return executor.stats()['running'] + executor.stats()['queued'] == 0
+
+
+def test_stream():
+    executor = BoundedExecutor(max_workers=1, max_queue=0)
+    threads = set()
+
+    def produce():
+        for i in range(20):
+            threads.add(threading.current_thread().name)
+            yield i
+
+    assert _run(_read(stream_in_thread(produce, executor, max_chunks=2))) == list(range(20))
+    assert [name.startswith('db-worker') for name in threads] == [True]
+
+    def fail():
+        yield 1
+        raise RuntimeError('query failed')
+
+    with pytest.raises(RuntimeError):
+        _run(_read(stream_in_thread(fail, executor)))
+    assert _wait_until_idle(executor) and executor.stats()['completed'] == 2
+    executor.shutdown()
+
+def test_streams_are_bounded():
+    executor = BoundedExecutor(max_workers=1, max_queue=0)
+    release = threading.Event()
+
+    def produce():
+        release.wait()
+        yield 1
+
+    body = stream_in_thread(produce, executor)
+    with pytest.raises(ExecutorSaturated):
+        stream_in_thread(produce, executor)
+    release.set()
+    assert _run(_read(body)) == [1]
+    executor.shutdown()
+
+def test_closed_stream_closes_the_cursor(tmp_path):
+    database = CountingSqliteDatabase(str(tmp_path / 'stream.db'), check_same_thread=False)
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    database.close()
+    executor = BoundedExecutor(max_workers=1, max_queue=0)
+    closed = []
+
+    def produce():
+        with database.request_connection(), closing(iterate(User.select(), 2)) as rows:
+            try:
+                for user in rows:
+                    yield user.login
+            finally:
+                closed.append(True)
+
+    # The client disconnects after the first chunk.
+    assert _run(_read(stream_in_thread(produce, executor, max_chunks=1), count=1)) == ['user0']
+    assert _wait_until_idle(executor) and closed == [True]
+    stats = database.pool_stats()
+    assert (stats['in_use'], stats['idle']) == (0, 1)
+
+    # A body which is never read stops after the timeout.
+    closed.clear()
+    stream_in_thread(produce, executor, max_chunks=1, timeout=0.5)
+    assert _wait_until_idle(executor) and closed == [True] and database.pool_stats()['in_use'] == 0
+    executor.shutdown()
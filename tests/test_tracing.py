@@ -0,0 +1,28 @@
+from server import metrics
+from server.tracing import SlowQueryLog, format_trace
+
+
+def tracked_request():
+    with metrics.track_request() as request_metrics:
+        metrics.add_statement('SELECT 1', None, request_metrics.start + 0.5, 0.25)
+        metrics.add_statement('SELECT ?', (2,), request_metrics.start + 1, 0.5)
+    return request_metrics
+
+
+def test_format_trace():
+    trace = format_trace(tracked_request())
+    assert trace['statement_count'] == 2
+    assert trace['sql_duration'] == 0.75
+    assert trace['stages'] == {'sql': 0.75}
+    assert trace['statements'][1] == {'sql': 'SELECT ?', 'params': [2], 'duration': 0.5, 'rows': None, 'offset': 1}
+
+def test_slow_query_log():
+    log = SlowQueryLog(size=2, threshold=1.0)
+    request_metrics = tracked_request()
+    assert not log.record('query', '/query', 'MODEL: user', 0.5, request_metrics)
+    for duration in (3, 1, 2):
+        assert log.record('query', '/query', 'MODEL: user', duration, request_metrics)
+    assert [entry['duration'] for entry in log.slowest()] == [2, 1]
+    assert log.slowest(1)[0]['statements'][0] == {'sql': 'SELECT 1', 'duration': 0.25, 'rows': None}
+    log.clear()
+    assert log.slowest() == []
@@ -0,0 +1,146 @@
+import json
+import threading
+
+import pytest
+
+from benchmarks import dataset
+from server import views
+from server.admission import CostBudgets
+from server.cursor import encode_cursor
+from server.database import CountingSqliteDatabase
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Serves the views from a pooled SQLite database with the synthetic dataset."""
+    database = CountingSqliteDatabase(str(tmp_path / 'views.db'), check_same_thread=False, max_connections=4,
+                                      timeout=0.1)
+    dataset.bind(database)
+    dataset.generate(database, scale=0.05)
+    database.close()
+    monkeypatch.setattr(views, 'db', database)
+    # Cached queries are bound to the database they were compiled for.
+    views.compiled_queries.clear()
+    views.query_results.invalidate()
+    views.query_costs.clear()
+    return database
+
+
+def test_pool_timeout(database):
+    checked_out = threading.Barrier(database._max_connections + 1)
+    release = threading.Event()
+
+    def hold():
+        with database.request_connection():
+            checked_out.wait()
+            release.wait()
+
+    threads = [threading.Thread(target=hold) for _ in range(database._max_connections)]
+    for thread in threads:
+        thread.start()
+    checked_out.wait()
+    try:
+        response = views.api.requests.get('/models/user')
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    assert views.api.requests.get('/pool').json()['timeouts'] == 1
+    assert views.api.requests.get('/models/user').status_code == 200
+
+def test_query_pages(database):
+    text = 'MODEL: user SELECT: (id, city) ORDERBY: (city)'
+    ids = []
+    params = {'q': text, 'limit': 3}
+    while True:
+        response = views.api.requests.get('/query', params=params)
+        assert response.status_code == 200
+        ids.extend(obj['id'] for obj in response.json())
+        if 'X-Next-Cursor' not in response.headers:
+            break
+        params['cursor'] = response.headers['X-Next-Cursor']
+    assert ids == [obj['id'] for obj in views.api.requests.get('/query', params={'q': text, 'limit': 100}).json()]
+    assert sorted(ids) == list(range(1, 11))
+
+    cursor = params['cursor']
+    for invalid in [cursor[:-2], cursor + 'x', 'garbage']:
+        response = views.api.requests.get('/query', params=dict(params, cursor=invalid))
+        assert response.status_code == 400 and 'Invalid cursor' in response.json()['error']
+    assert views.api.requests.get('/models/user', params={'cursor': 'garbage'}).status_code == 400
+
+def test_stream(database):
+    text = 'MODEL: user SELECT: (id, login, projects.name) ORDERBY: (login)'
+    expected = views.api.requests.get('/query', params={'q': text, 'limit': 100}).json()
+    response = views.api.requests.get('/query', params={'q': text, 'stream': '1'})
+    assert response.headers['Content-Type'] == 'application/json' and response.json() == expected
+    response = views.api.requests.get('/query', params={'q': text}, headers={'Accept': 'application/x-ndjson'})
+    assert response.headers['Content-Type'] == 'application/x-ndjson'
+    assert [json.loads(line) for line in response.text.splitlines()] == expected
+
+    response = views.api.requests.get('/query', params={'q': text, 'stream': '1', 'limit': 2})
+    page = response.json()
+    assert page == expected[:2]
+    cursor = encode_cursor([page[-1]['login'], page[-1]['id']])
+    response = views.api.requests.get('/query', params={'q': text, 'stream': '1', 'cursor': cursor})
+    assert response.json() == expected[2:]
+    response = views.api.requests.get('/query', params={'q': text + ' WHERE: id > 1000', 'stream': '1'})
+    assert response.text == '[]'
+    assert views.api.requests.get('/query', params={'q': text, 'stream': '1', 'cursor': 'x'}).status_code == 400
+    assert database.pool_stats()['in_use'] == 0
+
+def test_query_batch(database, monkeypatch):
+    users = 'MODEL: user SELECT: (id, login) ORDERBY: (id)'
+    projects = 'MODEL: project SELECT: (id, name) ORDERBY: (id)'
+    expected_users = views.api.requests.get('/query', params={'q': users, 'limit': 3}).json()
+    views.query_results.invalidate()
+    misses = views.query_results.stats()['misses']
+
+    queries = [users, {'q': users, 'limit': 3}, 'MODEL: nothing', {'limit': 3}, projects, {'q': users, 'limit': 3}]
+    response = views.api.requests.post('/query/batch', json={'queries': queries})
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert [result['status'] for result in results] == [200, 200, 400, 400, 200, 200]
+    # Invalid queries get an error of their own, the other queries are still read.
+    assert 'error' in results[2] and results[3]['error'] == 'The query q is missing.'
+    assert results[1]['result'] == expected_users and results[1]['next_cursor'] is not None
+    assert [obj['id'] for obj in results[4]['result']] == list(range(1, len(results[4]['result']) + 1))
+    # The identical pages are read once, for the first of them.
+    assert results[5] == results[1] and results[1]['cache'] == 'miss'
+    assert views.query_results.stats()['misses'] == misses + 3
+
+    # Another batch gets the pages from the result cache.
+    results = views.api.requests.post('/query/batch', json={'queries': [{'q': users, 'limit': 3}]}).json()['results']
+    assert results[0]['cache'] == 'hit' and results[0]['result'] == expected_users
+    assert views.query_results.stats()['misses'] == misses + 3
+
+    monkeypatch.setattr(views, 'max_batch_size', 2)
+    response = views.api.requests.post('/query/batch', json={'queries': [users, users, projects]})
+    assert response.status_code == 400 and 'at most 2 queries' in response.json()['error']
+    for body in [{'queries': 'MODEL: user'}, {'queries': [1]}, []]:
+        assert views.api.requests.post('/query/batch', json=body).status_code == 400
+
+def test_sample(database):
+    response = views.api.requests.get('/query', params={'q': 'MODEL: user SELECT: (id) SAMPLE: 50 SEED 1'})
+    assert response.status_code == 200
+    assert response.headers['X-Approximate'] == 'true' and float(response.headers['X-Sample-Scale']) == 2
+    for endpoint in ['/query', '/query/explain']:
+        response = views.api.requests.get(endpoint, params={'q': 'MODEL: user SELECT: (id) SAMPLE: 101'})
+        assert response.status_code == 400 and 'percentage greater than 0 and at most 100' in response.json()['error']
+    results = views.api.requests.post('/query/batch', json={'queries': ['MODEL: user SELECT: (id) SAMPLE: 0']}).json()
+    assert results['results'][0]['status'] == 400
+
+def test_cost_estimates_depend_on_the_parameters(database, monkeypatch):
+    # SQLite does not estimate costs, the plan costs as much as the literal of the condition.
+    def explain(query):
+        sql, params = query.sql()
+        return [{'Plan': {'Total Cost': float(params[0]), 'Plan Rows': 1}}]
+
+    monkeypatch.setattr(views, 'explain', explain)
+    monkeypatch.setattr(views, 'cost_budgets', CostBudgets(max_cost=100))
+    cheap = views.api.requests.get('/query', params={'q': 'MODEL: user SELECT: (id) WHERE: id > 5'})
+    assert cheap.status_code == 200 and [obj['id'] for obj in cheap.json()] == list(range(6, 11))
+    # The same SQL with another literal is explained again.
+    expensive = views.api.requests.get('/query', params={'q': 'MODEL: user SELECT: (id) WHERE: id > 500'})
+    assert expensive.status_code == 400 and 'estimated cost 500' in expensive.json()['error']
+    assert len(views.query_costs) == 2